@@ -0,0 +1,388 @@
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import offline
+from email_assistant import cli
+from email_assistant.catalog import load_products_to_chromadb
+from email_assistant.inquiries import InquiryClusters
+from email_assistant.metrics import metrics
+from email_assistant.pipeline import llm_client, run_concurrent, run_sequential
+from email_assistant.services import Services, configure, connect
+from email_assistant.settings import ORDER_EXTRACTION_MODES, ORDER_RESPONSE_MODES, VECTOR_BACKENDS
+from email_assistant.sheets import SheetWriter
+from email_assistant.vectors import open_product_collection
+from email_assistant.workers import run_workers
+
+# End-to-end throughput benchmark of the pipeline on synthetic catalogs and
+# email backlogs, using the offline stand-ins for Sheets, OpenAI and embeddings.
+
+CATEGORIES = ["Men's Clothing", "Women's Clothing", "Accessories", "Bags", "Men's Shoes", "Women's Shoes", "Kid's Clothing", "Loungewear"]
+ADJECTIVES = ["Classic", "Vintage", "Slim", "Oversized", "Cozy", "Elegant", "Casual", "Sporty", "Linen", "Leather", "Wool", "Denim"]
+NOUNS = ["Shirt", "Jacket", "Dress", "Sneakers", "Boots", "Tote", "Scarf", "Sweater", "Jeans", "Hat", "Backpack", "Coat"]
+SEASONS = ["Spring", "Summer", "Fall", "Winter", "All seasons", "Spring, Summer", "Fall, Winter"]
+GREETINGS = ["Hi", "Hello", "Hey there", "Dear team", "Good morning"]
+SIGN_OFFS = ["", " Thanks!", " Thank you.", " Best regards", " Kind regards, thanks in advance."]
+
+# Questions about popular products most repeated inquiries ask, reworded
+POPULAR_QUESTIONS = 5
+
+# === Synthetic data ===
+def generate_catalog(n_products, seed=0):
+    rng = random.Random(seed)
+    rows = [["product_id", "name", "category", "description", "seasons", "price", "stock"]]
+    for i in range(n_products):
+        name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)}"
+        rows.append([
+            f"PRD{i:05d}",
+            name,
+            rng.choice(CATEGORIES),
+            f"A {name.lower()} with a {rng.choice(['relaxed', 'tailored', 'modern', 'timeless'])} fit, "
+            f"made of {rng.choice(['cotton', 'wool', 'linen', 'leather', 'recycled polyester'])}.",
+            rng.choice(SEASONS),
+            round(rng.uniform(9, 199), 2),
+            rng.choice([0, 0, 1, 2, 5, 10, 20, 50]),
+        ])
+    return rows
+
+def generate_emails(n_emails, catalog, seed=0, order_share=0.5, repeated_share=0.0):
+    rng = random.Random(seed + 1)
+    products = catalog[1:]
+    popular = [(product[1], rng.choice(SEASONS).lower()) for product in rng.sample(products, POPULAR_QUESTIONS)]
+    rows = [["email_id", "subject", "message"]]
+    for i in range(n_emails):
+        if rng.random() < order_share:
+            lines = [
+                f"{rng.randint(1, 4)} x {product[1]} [{product[0]}]"
+                for product in rng.sample(products, rng.randint(1, 3))
+            ]
+            rows.append([f"E{i:06d}", "New order", f"Hello, I would like to buy {' and '.join(lines)}. Thank you!"])
+        elif rng.random() < repeated_share:
+            name, season = rng.choice(popular)
+            rows.append([
+                f"E{i:06d}",
+                "Question about a product",
+                f"{rng.choice(GREETINGS)}, is the {name} good for {season}? What material is it made of?{rng.choice(SIGN_OFFS)}",
+            ])
+        else:
+            product = rng.choice(products)
+            rows.append([
+                f"E{i:06d}",
+                "Question about a product",
+                f"Hi, is the {product[1]} good for {rng.choice(SEASONS).lower()}? What material is it made of?",
+            ])
+    return rows
+
+def generate_spreadsheet(n_products, n_emails, seed=0, repeated_share=0.0):
+    catalog = generate_catalog(n_products, seed)
+    return {"products": catalog, "emails": generate_emails(n_emails, catalog, seed, repeated_share=repeated_share)}
+
+def write_dataset(directory, n_products, n_emails, seed=0, repeated_share=0.0):
+    spreadsheet = offline.CsvSpreadsheet(directory)
+    for title, values in generate_spreadsheet(n_products, n_emails, seed, repeated_share).items():
+        worksheet = spreadsheet.add_worksheet(title, rows=len(values), cols=len(values[0]))
+        worksheet.update(values, "A1")
+
+# === Benchmark scenario ===
+def run_scenario(n_products, n_emails, mode, latency, concurrency, seed=0, extraction="two-step", order_response="llm", workers=0, models="",
+                 inquiry_dedup=True, repeated_share=0.0):
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="benchmark-"))
+    if mode == "workers":
+        return run_workers_scenario(
+            n_products, n_emails, latency, concurrency, seed, extraction, order_response, workers, models, inquiry_dedup, repeated_share
+        )
+
+    spreadsheet = offline.InMemorySpreadsheet(generate_spreadsheet(n_products, n_emails, seed, repeated_share))
+    argv = ["--chroma-path", "", "--no-cache", "--concurrency", str(concurrency), "--rpm", "1000000", "--tpm", "1000000000"]
+    if mode == "async":
+        argv.append("--async")
+    argv += ["--extraction", extraction, "--order-response", order_response, "--models", models]
+    args = cli.parse_args(argv)
+
+    metrics.reset()
+    # No LLM cache, local classifier or dead-letter queue; clusters start empty: only the near-duplicates
+    # within the backlog are answered once
+    services = Services(
+        model_routes=args.models,
+        embedding_function=offline.HashingEmbeddingFunction(),
+        inquiry_clusters=InquiryClusters(args.inquiry_clusters_path) if inquiry_dedup else None,
+        order_extraction=extraction,
+        order_response=order_response
+    )
+    openai_client = offline.FakeAsyncOpenAI(latency=latency)
+    llm = llm_client(openai_client, args, services)
+
+    writer = SheetWriter(spreadsheet, max_rows=args.flush_rows, flush_interval=args.flush_interval)
+    started = time.perf_counter()
+    if mode == "async":
+        asyncio.run(run_concurrent(spreadsheet, llm, writer, args, services))
+    else:
+        # The sequential run answers emails classified by a previous run
+        asyncio.run(run_sequential(spreadsheet, llm, writer, args, services))
+        writer.flush()
+        asyncio.run(run_sequential(spreadsheet, llm, writer, args, services))
+    writer.close()
+    elapsed = time.perf_counter() - started
+
+    summary = metrics.summary()
+    return {
+        "mode": mode,
+        "workers": workers,
+        "extraction": extraction,
+        "order_response": order_response,
+        "models": models,
+        "inquiry_dedup": inquiry_dedup,
+        "repeated_share": repeated_share,
+        "inquiry_answers_reused": summary["counters"].get("inquiry_clusters:reused", 0),
+        "products": n_products,
+        "emails": n_emails,
+        "seconds": elapsed,
+        "emails_per_second": n_emails / elapsed,
+        "stages": summary["stages"],
+        "slowest_stage": summary["slowest_stage"],
+        "tokens_per_email": summary["tokens_per_email"],
+        "cost_per_email": summary["cost_per_email"],
+        "model_calls": dict(openai_client.model_calls),
+        "escalations": sum(value for name, value in summary["counters"].items() if name.startswith("escalations:")),
+        "api_calls": {
+            "openai": sum(openai_client.calls.values()),
+            "sheets": sum(spreadsheet.api_calls.values()),
+            "chroma": summary["calls"]["chroma"],
+        },
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def run_workers_scenario(n_products, n_emails, latency, concurrency, seed, extraction, order_response, workers, models,
+                         inquiry_dedup, repeated_share):
+    # Worker processes need a spreadsheet they can all open: the dataset is written as CSV files
+    write_dataset("data", n_products, n_emails, seed, repeated_share)
+    args = cli.parse_args([
+        "--offline", "data", "--workers", str(workers), "--fake-llm-latency", str(latency), "--no-cache",
+        "--concurrency", str(concurrency), "--rpm", "1000000", "--tpm", "1000000000", "--trace-dir", "",
+        "--extraction", extraction, "--order-response", order_response, "--models", models,
+    ] + ([] if inquiry_dedup else ["--no-inquiry-dedup"]))
+    args.use_async = True
+    spreadsheet, _ = connect(args)
+    services = configure(args)
+    metrics.reset()
+
+    writer = SheetWriter(spreadsheet, max_rows=args.flush_rows, flush_interval=args.flush_interval)
+    started = time.perf_counter()
+    run_workers(spreadsheet, writer, args, services)
+    writer.close()
+    services.close()
+    elapsed = time.perf_counter() - started
+
+    # Stage timings stay in the worker processes, only the throughput is compared
+    return {
+        "mode": "workers",
+        "workers": workers,
+        "extraction": extraction,
+        "order_response": order_response,
+        "models": models,
+        "inquiry_dedup": inquiry_dedup,
+        "repeated_share": repeated_share,
+        "inquiry_answers_reused": None,
+        "products": n_products,
+        "emails": n_emails,
+        "seconds": elapsed,
+        "emails_per_second": n_emails / elapsed,
+        "stages": {},
+        "slowest_stage": None,
+        "tokens_per_email": 0,
+        "cost_per_email": 0.0,
+        "model_calls": {},
+        "escalations": 0,
+        "api_calls": {"sheets (coordinator)": sum(spreadsheet.api_calls.values())},
+        "peak_memory_mb": max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        ) / 1024,
+    }
+
+def run_isolated(**scenario):
+    return run_in_fresh_process(run_scenario, **scenario)
+
+def run_in_fresh_process(function, **kwargs):
+    # A fresh process per scenario keeps peak memory and the in-memory Chroma apart
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, **kwargs).result()
+
+# === Vector backend benchmark ===
+def generate_queries(n_queries, seed=0):
+    rng = random.Random(seed + 2)
+    texts = [f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS).lower()} for {rng.choice(SEASONS).lower()}" for _ in range(n_queries)]
+    # Category and stock pre-filter, as for alternatives in stock
+    filters = [{"$and": [{"category": rng.choice(CATEGORIES)}, {"stock": {"$gt": 0}}]} for _ in range(n_queries)]
+    return texts, filters
+
+def build_vector_index(backend, path, n_products, seed):
+    logging.getLogger().setLevel(logging.WARNING)
+    catalog = generate_catalog(n_products, seed)
+    df_products = pd.DataFrame(catalog[1:], columns=catalog[0])
+    started = time.perf_counter()
+    load_products_to_chromadb(df_products, open_product_collection(path, backend, offline.HashingEmbeddingFunction()))
+    return time.perf_counter() - started
+
+def query_vector_index(backend, path, n_queries, seed, batch_size=32):
+    logging.getLogger().setLevel(logging.WARNING)
+    embedding_function = offline.HashingEmbeddingFunction()
+    texts, filters = generate_queries(n_queries, seed)
+    embeddings = np.asarray(embedding_function(texts), dtype=np.float32).tolist()
+    include = ["documents", "metadatas", "distances"]
+
+    # Startup: opening the persisted index and answering a first query, in a fresh process
+    started = time.perf_counter()
+    collection = open_product_collection(path, backend, embedding_function)
+    collection.query(query_embeddings=embeddings[:1], n_results=10, include=include)
+    startup = time.perf_counter() - started
+
+    latencies = {"query": [], "filtered": []}
+    for embedding, where in zip(embeddings, filters):
+        started = time.perf_counter()
+        collection.query(query_embeddings=[embedding], n_results=10, include=include)
+        latencies["query"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        collection.query(query_embeddings=[embedding], n_results=10, where=where, include=include)
+        latencies["filtered"].append(time.perf_counter() - started)
+    started = time.perf_counter()
+    for start in range(0, len(embeddings), batch_size):
+        collection.query(query_embeddings=embeddings[start:start + batch_size], n_results=10, include=include)
+    batched = (time.perf_counter() - started) / len(embeddings)
+
+    return {
+        "startup_seconds": startup,
+        **{f"{name}_p50": float(np.percentile(values, 50)) for name, values in latencies.items()},
+        **{f"{name}_p95": float(np.percentile(values, 95)) for name, values in latencies.items()},
+        "batched_per_query": batched,
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def run_vector_scenario(n_products, backend, n_queries, seed=0):
+    path = tempfile.mkdtemp(prefix="benchmark-vectors-")
+    try:
+        build = run_in_fresh_process(build_vector_index, backend=backend, path=path, n_products=n_products, seed=seed)
+        report = run_in_fresh_process(query_vector_index, backend=backend, path=path, n_queries=n_queries, seed=seed)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+    return {"mode": "vectors", "backend": backend, "products": n_products, "queries": n_queries, "build_seconds": build, **report}
+
+def print_vector_report(report):
+    print(
+        f"\n{report['backend']} vectors: {report['products']} products -> build {report['build_seconds']:.2f} s, "
+        f"startup {report['startup_seconds'] * 1000:.0f} ms, peak memory {report['peak_memory_mb']:.0f} MB"
+    )
+    print(
+        f"  query p50 {report['query_p50'] * 1000:.2f} ms, p95 {report['query_p95'] * 1000:.2f} ms; "
+        f"filtered p50 {report['filtered_p50'] * 1000:.2f} ms, p95 {report['filtered_p95'] * 1000:.2f} ms; "
+        f"batched {report['batched_per_query'] * 1000:.2f} ms per query"
+    )
+
+def print_report(report):
+    mode = f"{report['workers']} workers" if report["mode"] == "workers" else report["mode"]
+    print(
+        f"\n{mode} ({report['extraction']}, {report['order_response']} responses): {report['products']} products, {report['emails']} emails -> "
+        f"{report['emails_per_second']:.1f} emails/s ({report['seconds']:.2f} s), "
+        f"peak memory {report['peak_memory_mb']:.0f} MB"
+    )
+    print("  API calls: " + ", ".join(f"{name} {count}" for name, count in report["api_calls"].items()))
+    if report["repeated_share"] or not report["inquiry_dedup"]:
+        reused = report["inquiry_answers_reused"]
+        print(
+            f"  {report['repeated_share']:.0%} repeated inquiries, inquiry dedup "
+            + (f"on ({reused if reused is not None else 'n/a'} answers reused)" if report["inquiry_dedup"] else "off")
+        )
+    if not report["stages"]:
+        return
+    if report["models"]:
+        print(f"  models: {report['models']}")
+    print(
+        f"  {report['tokens_per_email']:.0f} tokens and ${report['cost_per_email']:.4f} per email, "
+        f"slowest stage {report['slowest_stage']}"
+    )
+    print("  model calls: " + ", ".join(f"{model} {count}" for model, count in report["model_calls"].items())
+          + f" ({report['escalations']} escalations)")
+    print(f"  {'stage':<24}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}")
+    for name, stage in report["stages"].items():
+        print(f"  {name:<24}{stage['count']:>8}{stage['p50'] * 1000:>10.1f}{stage['p95'] * 1000:>10.1f}{stage['total']:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the email pipeline offline on synthetic data.")
+    parser.add_argument("--products", type=int, nargs="+", default=[1000], help="catalog sizes to benchmark")
+    parser.add_argument("--emails", type=int, default=200, help="emails in the backlog")
+    parser.add_argument("--mode", choices=["sync", "async", "both", "workers", "vectors"], default="both")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="worker process counts to benchmark (workers mode)")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake LLM call")
+    parser.add_argument("--concurrency", type=int, default=16, help="LLM requests in flight in async mode")
+    parser.add_argument("--extraction", choices=ORDER_EXTRACTION_MODES, nargs="+", default=["two-step"],
+                        help="order extraction modes to benchmark")
+    parser.add_argument("--order-response", choices=ORDER_RESPONSE_MODES, nargs="+", default=["llm"],
+                        help="order response modes to benchmark")
+    parser.add_argument("--models", nargs="+", default=[""],
+                        help="model routes to benchmark, in the app.py --models format ('' for the default routes)")
+    parser.add_argument("--backends", choices=VECTOR_BACKENDS, nargs="+", default=list(VECTOR_BACKENDS),
+                        help="vector backends to benchmark (vectors mode)")
+    parser.add_argument("--queries", type=int, default=200, help="product queries per backend (vectors mode)")
+    parser.add_argument("--repeated", type=float, default=0.0,
+                        help="share of the inquiries repeating, reworded, one of a few questions about popular products")
+    parser.add_argument("--inquiry-dedup", choices=["on", "off"], nargs="+", default=["on"],
+                        help="answer near-duplicate inquiries once, or each of them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="also write the reports to a JSON file")
+    parser.add_argument("--write-dataset", metavar="DIR",
+                        help="only write a synthetic dataset as CSV files, usable with app.py --offline DIR")
+    args = parser.parse_args()
+
+    if args.write_dataset:
+        write_dataset(args.write_dataset, args.products[0], args.emails, args.seed, args.repeated)
+        return
+
+    if args.mode == "vectors":
+        reports = []
+        for n_products in args.products:
+            for backend in args.backends:
+                report = run_vector_scenario(n_products, backend, args.queries, args.seed)
+                print_vector_report(report)
+                reports.append(report)
+        write_reports(reports, args.json)
+        return
+
+    modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+    scenarios = [(mode, workers) for mode in modes for workers in (args.workers if mode == "workers" else [0])]
+    reports = []
+    for n_products in args.products:
+        for mode, workers in scenarios:
+            for extraction in args.extraction:
+                for order_response in args.order_response:
+                    for models in args.models:
+                        for inquiry_dedup in args.inquiry_dedup:
+                            report = run_isolated(
+                                n_products=n_products, n_emails=args.emails, mode=mode, latency=args.latency,
+                                concurrency=args.concurrency, seed=args.seed, extraction=extraction,
+                                order_response=order_response, workers=workers, models=models,
+                                inquiry_dedup=inquiry_dedup == "on", repeated_share=args.repeated
+                            )
+                            print_report(report)
+                            reports.append(report)
+
+    write_reports(reports, args.json)
+
+def write_reports(reports, path):
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == "__main__":
+    main()
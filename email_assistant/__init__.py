@@ -0,0 +1,4 @@
+# Classify customer emails and answer orders and inquiries, see cli.py for the command line
+import logging
+
+logging.basicConfig(level=logging.INFO)
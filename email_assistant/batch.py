@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+import types
+
+from .llm import BatchPending, BatchRequestError, LLMCache, LLMClient, current_stage
+from .metrics import current_email
+from .pipeline import run_sequential
+from .scheduling import openai_scheduler
+from .settings import BATCH_COMPLETION_WINDOW, BATCH_MAX_REQUESTS
+
+# === Batch mode ===
+class BatchStore:
+    """SQLite store of the batch requests and of their answers.
+
+    A request is named after its email, LLM stage, model and number of
+    messages (repairs add messages, escalations change the model), so that
+    the next pass finds its answer again even if retrieval or the stock
+    changed the prompt in the meantime. Requests go to a batch job once
+    submitted, and keep their answer or error once the job is collected.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS batch_requests (
+            custom_id TEXT PRIMARY KEY,
+            body TEXT,
+            batch_id TEXT,
+            content TEXT,
+            confidence REAL,
+            usage TEXT,
+            error TEXT,
+            consumed INTEGER DEFAULT 0,
+            finish_reason TEXT
+        )""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS batches (
+            batch_id TEXT PRIMARY KEY,
+            path TEXT,
+            submitted_at REAL,
+            collected INTEGER DEFAULT 0
+        )""")
+        self.connection.commit()
+
+    def get(self, custom_id):
+        row = self.connection.execute(
+            "SELECT content, confidence, usage, error, consumed, finish_reason FROM batch_requests WHERE custom_id = ?", (custom_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        content, confidence, usage, error, consumed, finish_reason = row
+        return {
+            "content": content, "confidence": confidence, "usage": json.loads(usage) if usage else None,
+            "error": error, "consumed": consumed, "finish_reason": finish_reason
+        }
+
+    def request(self, custom_id, body):
+        self.connection.execute(
+            "INSERT OR IGNORE INTO batch_requests (custom_id, body) VALUES (?, ?)", (custom_id, json.dumps(body))
+        )
+        self.connection.commit()
+
+    def consumed(self, custom_id):
+        self.connection.execute("UPDATE batch_requests SET consumed = 1 WHERE custom_id = ?", (custom_id,))
+        self.connection.commit()
+
+    def forget(self, custom_id):
+        # A failed request is sent again by the next pass
+        self.connection.execute("DELETE FROM batch_requests WHERE custom_id = ?", (custom_id,))
+        self.connection.commit()
+
+    def unsubmitted(self):
+        return self.connection.execute(
+            "SELECT custom_id, body FROM batch_requests WHERE batch_id IS NULL ORDER BY rowid"
+        ).fetchall()
+
+    def submitted(self, batch_id, path, custom_ids):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO batches (batch_id, path, submitted_at) VALUES (?, ?, ?)", (batch_id, path, time.time())
+            )
+            self.connection.executemany(
+                "UPDATE batch_requests SET batch_id = ? WHERE custom_id = ?", [(batch_id, custom_id) for custom_id in custom_ids]
+            )
+
+    def open_batches(self):
+        return [batch_id for (batch_id,) in self.connection.execute("SELECT batch_id FROM batches WHERE collected = 0 ORDER BY rowid")]
+
+    def collected(self, batch_id, results):
+        # results: (custom_id, content, confidence, usage, error, finish_reason) of the requests the job answered
+        with self.connection:
+            self.connection.executemany(
+                """UPDATE batch_requests SET content = ?, confidence = ?, usage = ?, error = ?, finish_reason = ?
+                WHERE custom_id = ? AND batch_id = ?""",
+                [
+                    (content, confidence, json.dumps(usage) if usage else None, error, finish_reason, custom_id, batch_id)
+                    for custom_id, content, confidence, usage, error, finish_reason in results
+                ]
+            )
+            # Requests left unanswered (expired or cancelled job) go to the next batch
+            self.connection.execute(
+                "UPDATE batch_requests SET batch_id = NULL WHERE batch_id = ? AND content IS NULL AND error IS NULL", (batch_id,)
+            )
+            self.connection.execute("UPDATE batches SET collected = 1 WHERE batch_id = ?", (batch_id,))
+
+    def counts(self):
+        waiting, answered = self.connection.execute(
+            "SELECT COALESCE(SUM(content IS NULL AND error IS NULL), 0), COALESCE(SUM(content IS NOT NULL), 0) FROM batch_requests"
+        ).fetchone()
+        return waiting, answered
+
+    def close(self):
+        self.connection.close()
+
+class BatchClient:
+    """Stand-in for AsyncOpenAI() answering chat completions from the batch results.
+
+    A completion without an answer yet is recorded as a batch request and
+    raises BatchPending, which defers its email to the next pass.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, model, messages, **params):
+        email_id = current_email.get()
+        if email_id is None:
+            custom_id = LLMCache.key(model, messages, params)
+        else:
+            custom_id = f"{email_id}:{current_stage.get()}:{model}:{len(messages)}"
+        answer = self.store.get(custom_id)
+        if answer is None:
+            self.store.request(custom_id, {"model": model, "messages": messages, **params})
+            raise BatchPending(custom_id)
+        if answer["error"] is not None:
+            self.store.forget(custom_id)
+            raise BatchRequestError(f"{custom_id}: {answer['error']}")
+        if answer["content"] is None:
+            raise BatchPending(custom_id)
+
+        # Tokens are counted once, when the answer is first used
+        usage = answer["usage"] if not answer["consumed"] else None
+        if not answer["consumed"]:
+            self.store.consumed(custom_id)
+        logprobs = None
+        if answer["confidence"] is not None:
+            logprobs = types.SimpleNamespace(content=[types.SimpleNamespace(logprob=math.log(answer["confidence"]))])
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(
+                message=types.SimpleNamespace(content=answer["content"], tool_calls=None), logprobs=logprobs,
+                finish_reason=answer["finish_reason"]
+            )],
+            usage=types.SimpleNamespace(
+                prompt_tokens=(usage or {}).get("prompt_tokens", 0),
+                completion_tokens=(usage or {}).get("completion_tokens", 0),
+                total_tokens=(usage or {}).get("total_tokens", 0)
+            )
+        )
+
+class OpenAIBatchProvider:
+    """Submits the batch request files to the OpenAI Batch API and downloads their results."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, path):
+        with open(path, "rb") as f:
+            file = openai_scheduler.call("batch:upload", self.client.files.create, file=f, purpose="batch")
+        batch = openai_scheduler.call(
+            "batch:create", self.client.batches.create,
+            input_file_id=file.id, endpoint="/v1/chat/completions", completion_window=BATCH_COMPLETION_WINDOW
+        )
+        return batch.id
+
+    def collect(self, batch_id):
+        # None while the job runs, then the lines of its output and error files
+        batch = openai_scheduler.call("batch:retrieve", self.client.batches.retrieve, batch_id)
+        if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
+            return None
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                text = openai_scheduler.call("batch:download", self.client.files.content, file_id).text
+                lines += [json.loads(line) for line in text.splitlines() if line.strip()]
+        return lines
+
+def batch_result(line):
+    # (custom_id, content, confidence, usage, error, finish_reason) of a line of a batch output file
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        error = line.get("error") or (response.get("body") or {}).get("error") or f"HTTP {response.get('status_code')}"
+        return line["custom_id"], None, None, None, json.dumps(error) if not isinstance(error, str) else error, None
+    body = response["body"]
+    choice = body["choices"][0]
+    tool_calls = choice["message"].get("tool_calls")
+    content = tool_calls[0]["function"]["arguments"] if tool_calls else choice["message"].get("content")
+    tokens = (choice.get("logprobs") or {}).get("content")
+    confidence = math.exp(tokens[0]["logprob"]) if tokens else None
+    return line["custom_id"], content, confidence, body.get("usage"), None, choice.get("finish_reason")
+
+def collect_batches(store, provider):
+    answered = 0
+    for batch_id in store.open_batches():
+        lines = provider.collect(batch_id)
+        if lines is None:
+            continue
+        results = [batch_result(line) for line in lines]
+        store.collected(batch_id, results)
+        answered += len(results)
+        logging.info(f"Batch {batch_id} collected: {len(results)} answers.")
+    return answered
+
+def submit_batches(store, provider, directory):
+    pending = store.unsubmitted()
+    for start in range(0, len(pending), BATCH_MAX_REQUESTS):
+        chunk = pending[start:start + BATCH_MAX_REQUESTS]
+        path = os.path.join(directory, f"requests-{time.strftime('%Y%m%d-%H%M%S')}-{start // BATCH_MAX_REQUESTS}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for custom_id, body in chunk:
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": json.loads(body)}) + "\n")
+        batch_id = provider.submit(path)
+        store.submitted(batch_id, path, [custom_id for custom_id, body in chunk])
+        logging.info(f"Batch {batch_id} submitted: {len(chunk)} requests from {path}.")
+    return len(pending)
+
+def batch_provider(args):
+    if args.offline:
+        import offline
+        # Batch jobs answered locally by the (sync) fake LLM
+        client = offline.FakeOpenAI(latency=args.fake_llm_latency, max_in_flight=args.fake_llm_max_in_flight, retry_after=0.5)
+        return offline.FileBatchProvider(os.path.join(args.batch_dir, "provider"), client)
+    from openai import OpenAI
+    # Transient errors are retried by openai_scheduler
+    return OpenAIBatchProvider(OpenAI(api_key=args.openai_api_key, max_retries=0))
+
+# === Run the pipeline in passes over batch jobs ===
+def run_batch(spreadsheet, provider, writer, args, services):
+    os.makedirs(args.batch_dir, exist_ok=True)
+    store = BatchStore(os.path.join(args.batch_dir, "requests.sqlite"))
+    # The passes only record their requests, the rate limits apply to the batch jobs
+    llm = LLMClient(BatchClient(store), cache=services.llm_cache, routes=services.model_routes)
+    try:
+        while True:
+            answered = collect_batches(store, provider)
+            # Emails classified by the first run are processed by the second one
+            for _ in range(2):
+                asyncio.run(run_sequential(spreadsheet, llm, writer, args, services))
+                writer.flush()
+            submitted = submit_batches(store, provider, args.batch_dir)
+            waiting, _ = store.counts()
+            logging.info(f"Batch pass: {answered} answers collected, {submitted} requests submitted, {waiting} requests waiting.")
+            if not waiting or not args.batch_poll:
+                break
+            time.sleep(args.batch_poll)
+    finally:
+        store.close()
@@ -0,0 +1,396 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+from .llm import count_tokens
+from .metrics import metrics
+from .scheduling import chroma_scheduler
+from .settings import ALTERNATIVES_BLOCK_SIZE, ALTERNATIVES_NEIGHBOURS, CHROMA_BATCH_SIZE, PRODUCT_CONTEXT_TOKENS
+from .sheets import load_data, plain_value
+from .stores import ProductStore, SQLiteProductStore, content_hash
+from .vectors import default_embedding_function, open_product_collection, persist_collection
+
+# === Load products in ChromaDB ===
+def product_document(row):
+    return f"""{row['name']}: {row['description']}
+        The product (ID: {row['product_id']}) belongs to the category {row['category']} and is great in {row['seasons']}. The cost of the product is {row['price']}.
+        """
+
+def load_products_to_chromadb(df_products, collection):
+    with metrics.stage("catalog:sync"):
+        changed = sync_products_to_chromadb(df_products, collection)
+    if changed:
+        persist_collection(collection)
+
+def sync_products_to_chromadb(df_products, collection):
+    # One call for the ids and hashes of everything already in the collection
+    existing = chroma_scheduler.call("chroma:get", collection.get, include=["metadatas"])
+    existing_hashes = {
+        product_id: (metadata or {}) for product_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+
+    new_ids, new_documents, new_metadatas = [], [], []
+    changed_ids, changed_metadatas = [], []
+    catalog_ids = set()
+    for row in df_products.to_dict("records"):
+        row = {field: plain_value(value) for field, value in row.items()}
+        product_id = str(row['product_id'])
+        catalog_ids.add(product_id)
+
+        document = product_document(row)
+        metadata = {"product_id": row['product_id'], "name": row['name'], "category": row['category'], "seasons": row['seasons'], "price": row['price'], "stock": row['stock']}
+        metadata["document_hash"] = content_hash(document)
+        metadata["content_hash"] = content_hash(document, metadata)
+
+        stored = existing_hashes.get(product_id)
+        if stored is None or stored.get("document_hash") != metadata["document_hash"]:
+            # New text: the embedding has to be computed
+            new_ids.append(product_id)
+            new_documents.append(document)
+            new_metadatas.append(metadata)
+        elif stored.get("content_hash") != metadata["content_hash"]:
+            # Same text, e.g. only the stock changed: the embedding is kept
+            changed_ids.append(product_id)
+            changed_metadatas.append(metadata)
+
+    for start in range(0, len(new_ids), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        chroma_scheduler.call(
+            "chroma:upsert", collection.upsert,
+            ids=new_ids[start:end], documents=new_documents[start:end], metadatas=new_metadatas[start:end]
+        )
+    for start in range(0, len(changed_ids), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        chroma_scheduler.call("chroma:update", collection.update, ids=changed_ids[start:end], metadatas=changed_metadatas[start:end])
+
+    # Products removed from the sheet are removed from the collection too
+    removed_ids = [product_id for product_id in existing_hashes if product_id not in catalog_ids]
+    for start in range(0, len(removed_ids), CHROMA_BATCH_SIZE):
+        chroma_scheduler.call("chroma:delete", collection.delete, ids=removed_ids[start:start + CHROMA_BATCH_SIZE])
+
+    logging.info(f"Catalog synced: {len(new_ids)} embedded, {len(changed_ids)} metadata updates, {len(removed_ids)} removed.")
+    return bool(new_ids or changed_ids or removed_ids)
+
+# === Batched product retrieval ===
+class ProductRetriever:
+    """Runs product queries in batches, caching query embeddings and results.
+
+    query_many() embeds the texts missing from the embedding cache in one call
+    and sends one collection.query per (n_results, where) group. With a
+    batch_window, queries issued by concurrent emails within the window are
+    merged into the same batch. Texts are normalized (lowercase, collapsed
+    whitespace) before being embedded and used as cache keys.
+    """
+
+    def __init__(self, collection, embedding_function=None, cache_size=10000, batch_window=0.0, alternatives=None):
+        self.collection = collection
+        self.alternatives = alternatives or AlternativesIndex()
+        self.embedding_function = embedding_function or default_embedding_function()
+        self.cache_size = cache_size
+        self.batch_window = batch_window
+        self.embeddings = collections.OrderedDict()
+        self.results = collections.OrderedDict()
+        self.pending = {}
+        self.futures = {}
+        self.timer = None
+        self.lock = threading.Lock()
+        self.stats = {"queries": 0, "result_hits": 0, "batches": 0, "embedded": 0, "embedding_hits": 0, "seconds": 0.0}
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(str(text).lower().split())
+
+    @classmethod
+    def key(cls, text, n_results, where):
+        return cls.normalize(text), n_results, json.dumps(where, sort_keys=True, default=str)
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def query(self, text, n_results, where=None, include=("documents", "metadatas", "distances")):
+        return self.query_many([(text, n_results, where)], include)[0]
+
+    def query_many(self, queries, include=("documents", "metadatas", "distances")):
+        queries = [self.key(text, n_results, where) for text, n_results, where in queries]
+        found = {}
+        waiting = {}
+        run_now = None
+        with self.lock:
+            self.stats["queries"] += len(queries)
+            for key in queries:
+                if key in found or key in waiting:
+                    continue
+                if key in self.results:
+                    found[key] = self.results[key]
+                    self.results.move_to_end(key)
+                    continue
+                future = self.futures.get(key)
+                if future is None:
+                    future = concurrent.futures.Future()
+                    self.futures[key] = future
+                    self.pending[key] = future
+                waiting[key] = future
+            self.stats["result_hits"] += len(queries) - len(waiting)
+            if self.pending:
+                if self.batch_window <= 0:
+                    run_now, self.pending = self.pending, {}
+                elif self.timer is None:
+                    self.timer = threading.Timer(self.batch_window, self._run_pending)
+                    self.timer.daemon = True
+                    self.timer.start()
+        if run_now:
+            self._run(run_now)
+
+        for key, future in waiting.items():
+            found[key] = future.result()
+        return [
+            {"ids": [found[key]["ids"]], **{field: [found[key][field]] for field in include}}
+            for key in queries
+        ]
+
+    def _run_pending(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.timer = None
+        if batch:
+            self._run(batch)
+
+    def _run(self, batch):
+        start = time.perf_counter()
+        try:
+            # The embeddings of the batch are kept here: the cache may evict them before they are queried
+            cached = {}
+            with self.lock:
+                for text in dict.fromkeys(text for text, n_results, where in batch):
+                    if text in self.embeddings:
+                        cached[text] = self.embeddings[text]
+                        self.embeddings.move_to_end(text)
+                texts = [text for text in dict.fromkeys(text for text, n_results, where in batch) if text not in cached]
+                self.stats["embedding_hits"] += len(cached)
+            embeddings = {}
+            if texts:
+                with metrics.stage("embedding"):
+                    embeddings = dict(zip(texts, self.embedding_function(texts)))
+
+            groups = {}
+            for key in batch:
+                groups.setdefault(key[1:], []).append(key)
+            results = {}
+            for (n_results, where_key), keys in groups.items():
+                where = json.loads(where_key)
+                query_embeddings = [embeddings[text] if text in embeddings else cached[text] for text, _, _ in keys]
+                found = chroma_scheduler.call(
+                    "chroma:query", self.collection.query,
+                    query_embeddings=[np.asarray(embedding, dtype=np.float32).tolist() for embedding in query_embeddings],
+                    n_results=n_results,
+                    where=where or None,
+                    include=["documents", "metadatas", "distances"]
+                )
+                for position, key in enumerate(keys):
+                    results[key] = {field: found[field][position] for field in ("ids", "documents", "metadatas", "distances")}
+
+            with self.lock:
+                self.stats["batches"] += len(groups)
+                self.stats["embedded"] += len(texts)
+                self.stats["seconds"] += time.perf_counter() - start
+                for text, embedding in embeddings.items():
+                    self._remember(self.embeddings, text, embedding)
+                for key, result in results.items():
+                    self._remember(self.results, key, result)
+                    self.futures.pop(key, None)
+            for key, future in batch.items():
+                future.set_result(results[key])
+        except BaseException as e:
+            with self.lock:
+                for key in batch:
+                    self.futures.pop(key, None)
+            for future in batch.values():
+                future.set_exception(e)
+
+    def log_stats(self):
+        stats = self.stats
+        per_query = stats["seconds"] / stats["queries"] * 1000 if stats["queries"] else 0
+        logging.info(
+            f"Retrieval: {stats['queries']} queries ({stats['result_hits']} cached) in {stats['batches']} batched calls, "
+            f"{stats['embedded']} texts embedded ({stats['embedding_hits']} embedding cache hits), "
+            f"{per_query:.1f} ms per query."
+        )
+
+# === Precomputed alternatives of each product ===
+class AlternativesIndex:
+    """Closest products of the same category of each product, computed at catalog load.
+
+    alternatives() walks the precomputed neighbours of a product and keeps the
+    ones the stock ledger has available, so out-of-stock order lines need no
+    vector search and never see stale stock. update() only recomputes the
+    categories whose products were added, removed or changed.
+    """
+
+    def __init__(self, neighbours_count=ALTERNATIVES_NEIGHBOURS):
+        self.neighbours_count = neighbours_count
+        self.products = {}
+        self.neighbours = {}
+        self.signatures = {}
+
+    def update(self, collection):
+        stored = chroma_scheduler.call("chroma:get", collection.get, include=["documents", "metadatas"])
+        products = {}
+        categories = collections.defaultdict(list)
+        for product_id, document, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+            products[product_id] = (document, metadata or {})
+            categories[str((metadata or {}).get("category"))].append(product_id)
+
+        signatures = {
+            category: content_hash(sorted((product_id, products[product_id][1].get("document_hash")) for product_id in ids))
+            for category, ids in categories.items()
+        }
+        changed = [category for category in categories if self.signatures.get(category) != signatures[category]]
+        neighbours = {
+            product_id: self.neighbours[product_id]
+            for category, ids in categories.items() if category not in changed
+            for product_id in ids
+        }
+        for category in changed:
+            ids, embeddings = [], []
+            for start in range(0, len(categories[category]), CHROMA_BATCH_SIZE):
+                found = chroma_scheduler.call(
+                    "chroma:get", collection.get, ids=categories[category][start:start + CHROMA_BATCH_SIZE], include=["embeddings"]
+                )
+                ids += found["ids"]
+                embeddings += list(found["embeddings"])
+            with metrics.stage("alternatives:build"):
+                neighbours.update(self.nearest(ids, embeddings))
+
+        # Swapped at once, lookups running meanwhile see the previous index
+        self.products, self.neighbours, self.signatures = products, neighbours, signatures
+        logging.info(f"Alternatives index: {len(changed)} of {len(categories)} categories recomputed.")
+
+    def nearest(self, ids, embeddings):
+        count = min(self.neighbours_count, len(ids) - 1)
+        if count <= 0:
+            return {product_id: [] for product_id in ids}
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        neighbours = {}
+        for start in range(0, len(ids), ALTERNATIVES_BLOCK_SIZE):
+            similarities = vectors[start:start + ALTERNATIVES_BLOCK_SIZE] @ vectors.T
+            rows = np.arange(len(similarities))
+            similarities[rows, rows + start] = -np.inf  # a product is not its own alternative
+            top = np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+            order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+            top = np.take_along_axis(top, order, axis=1)
+            for row, columns in enumerate(top):
+                # Cosine distances, as in the collection
+                neighbours[ids[start + row]] = [(ids[column], float(1 - similarities[row, column])) for column in columns]
+        return neighbours
+
+    def alternatives(self, product_id, count, products, excluded=()):
+        found = []
+        for neighbour_id, distance in self.neighbours.get(str(product_id), ()):
+            stock = products.available(neighbour_id) if neighbour_id not in excluded else 0
+            if stock <= 0:
+                continue
+            document, metadata = self.products[neighbour_id]
+            found.append((neighbour_id, document, {**metadata, "stock": stock}, distance))
+            if len(found) == count:
+                break
+        return found
+
+# === Product context of the prompts ===
+class ProductContext:
+    """Candidate products of a prompt, deduplicated by product_id.
+
+    Products are ranked by their rank in the query that found them, then by
+    distance, so every query gets its closest products in first. lines()
+    renders them in a compact form, as many as fit in the token budget.
+    """
+
+    def __init__(self):
+        self.candidates = {}
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def __contains__(self, product_id):
+        return str(product_id) in self.candidates
+
+    def add(self, product_id, document, metadata, distance=0.0, rank=0):
+        product_id = str(product_id)
+        candidate = (rank, distance, document, metadata)
+        if product_id not in self.candidates or candidate[:2] < self.candidates[product_id][:2]:
+            self.candidates[product_id] = candidate
+
+    def add_results(self, found_products, keep=None):
+        # found_products: the results of a single query, as returned by ProductRetriever.query
+        distances = found_products.get('distances') or [[0.0] * len(found_products['ids'][0])]
+        rank = 0
+        for product_id, document, metadata, distance in zip(
+            found_products['ids'][0], found_products['documents'][0], found_products['metadatas'][0], distances[0]
+        ):
+            if keep is None or keep(product_id, metadata):
+                self.add(product_id, document, metadata, distance, rank)
+                rank += 1
+
+    def ranked(self, max_products=None):
+        ranked = sorted(self.candidates.items(), key=lambda item: item[1][:2])
+        return [(product_id, document, metadata) for product_id, (rank, distance, document, metadata) in ranked[:max_products]]
+
+    def lines(self, max_tokens=PRODUCT_CONTEXT_TOKENS):
+        lines = {}
+        used = 0
+        ranked = self.ranked()
+        for product_id, document, metadata in ranked:
+            line = format_product(product_id, document, metadata)
+            tokens = count_tokens(line)
+            # The closest product is always kept
+            if lines and used + tokens > max_tokens:
+                metrics.count("context_products_dropped", len(ranked) - len(lines))
+                break
+            lines[product_id] = line
+            used += tokens
+        return lines
+
+    def render(self, max_tokens=PRODUCT_CONTEXT_TOKENS):
+        return "\n".join(self.lines(max_tokens).values())
+
+def format_product(product_id, document, metadata):
+    # The first line of the document is "name: description", the rest repeats the metadata
+    summary = str(document).strip().split("\n")[0]
+    return (
+        f'<PRODUCT id="{product_id}" stock="{metadata.get("stock")}" price="{metadata.get("price")}">'
+        f'{summary} ({metadata.get("category")}; {metadata.get("seasons")})</PRODUCT>'
+    )
+
+# === Load the products catalog in the vector database ===
+def load_catalog(spreadsheet, args, services):
+    collection = open_product_collection(args.chroma_path, args.vector_backend, services.embedding_function)
+    df_products = load_data(spreadsheet, "products")
+    # Workers share a persistent vector database, synced by the coordinator
+    if not (args.worker and args.chroma_path):
+        load_products_to_chromadb(df_products, collection)
+
+    logging.info("Products loaded into ChromaDB.")
+    # Kept across catalog reloads, which only update the categories that changed
+    index = services.alternatives_index or AlternativesIndex()
+    index.update(collection)
+    services.alternatives_index = index
+    # Concurrent emails only share retrieval batches in async mode
+    batch_window = args.retrieval_window / 1000 if args.use_async else 0.0
+    products = SQLiteProductStore(df_products, args.queue_path) if args.worker else ProductStore(df_products)
+    retriever = ProductRetriever(collection, services.embedding_function, batch_window=batch_window, alternatives=index)
+    return retriever, products
+
+def sync_catalog(spreadsheet, args, services):
+    # The products collection alone, for the sync-catalog command
+    collection = open_product_collection(args.chroma_path, args.vector_backend, services.embedding_function)
+    load_products_to_chromadb(load_data(spreadsheet, "products"), collection)
+    logging.info(f"Products collection synced: {chroma_scheduler.call('chroma:count', collection.count)} products.")
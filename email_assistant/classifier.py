@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import random
+import threading
+
+import numpy as np
+
+from .llm import parse_category
+from .settings import CLASSIFICATION_MIN_CONFIDENCE, EMAIL_CLASSIFIER_PATH
+from .sheets import load_data
+from .vectors import default_embedding_function, embed_texts, embedding_function_id
+
+# === Local email classifier ===
+class LocalEmailClassifier:
+    """Nearest-centroid classifier on sentence embeddings, tried before the LLM.
+
+    The confidence of a prediction is the cosine similarity margin between the
+    two closest class centroids. Emails below the threshold are left to the
+    LLM, and a fraction (audit_rate) of the confident ones is sent to the LLM
+    anyway to keep measuring the agreement between the two tiers.
+    """
+
+    def __init__(self, labels, centroids, threshold, embedding_function=None, audit_rate=0.0):
+        self.labels = list(labels)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.threshold = threshold
+        self.embedding_function = embedding_function or default_embedding_function()
+        self.audit_rate = audit_rate
+        self.local_count = 0
+        self.llm_count = 0
+        self.audited_count = 0
+        self.agreements = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def email_text(email_subject, email_message):
+        return f"Subject: {email_subject}\nMessage: {email_message}"
+
+    @staticmethod
+    def fit_centroids(embeddings, labels, classes):
+        centroids = np.stack([embeddings[labels == label].mean(axis=0) for label in classes])
+        return centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    @staticmethod
+    def margins(embeddings, centroids):
+        similarities = embeddings @ centroids.T
+        ranked = np.sort(similarities, axis=1)
+        return similarities.argmax(axis=1), ranked[:, -1] - ranked[:, -2]
+
+    @classmethod
+    def train(cls, texts, labels, embedding_function=None, target_accuracy=0.98, folds=5):
+        embedding_function = embedding_function or default_embedding_function()
+        labels = np.asarray(labels)
+        classes = sorted(set(labels))
+        if len(classes) < 2:
+            raise ValueError("At least two categories are needed to train the email classifier.")
+
+        embeddings = embed_texts(embedding_function, texts)
+
+        # Cross-validated margins pick the lowest threshold reaching the target accuracy
+        fold_of = np.arange(len(texts)) % folds
+        margins = np.zeros(len(texts), dtype=np.float32)
+        correct = np.zeros(len(texts), dtype=bool)
+        for fold in range(folds):
+            train_mask = fold_of != fold
+            if not all((labels[train_mask] == label).any() for label in classes):
+                continue
+            centroids = cls.fit_centroids(embeddings[train_mask], labels[train_mask], classes)
+            predicted, margins[~train_mask] = cls.margins(embeddings[~train_mask], centroids)
+            correct[~train_mask] = np.asarray(classes)[predicted] == labels[~train_mask]
+
+        threshold = float(margins.max()) if len(margins) else 1.0
+        order = np.argsort(-margins)
+        accuracy = np.cumsum(correct[order]) / np.arange(1, len(order) + 1)
+        reaching = np.nonzero(accuracy >= target_accuracy)[0]
+        if len(reaching):
+            threshold = float(margins[order][reaching[-1]])
+
+        classifier = cls(classes, cls.fit_centroids(embeddings, labels, classes), threshold, embedding_function)
+        logging.info(
+            f"Email classifier trained on {len(texts)} emails: threshold {threshold:.4f}, "
+            f"{(margins >= threshold).mean():.1%} of the training emails classified locally."
+        )
+        return classifier
+
+    def save(self, path=EMAIL_CLASSIFIER_PATH):
+        np.savez(
+            path, labels=np.asarray(self.labels), centroids=self.centroids, threshold=self.threshold,
+            embedding=embedding_function_id(self.embedding_function)
+        )
+
+    @classmethod
+    def load(cls, path=EMAIL_CLASSIFIER_PATH, embedding_function=None, audit_rate=0.0, threshold=None):
+        with np.load(path) as model:
+            classifier = cls(
+                [str(label) for label in model["labels"]],
+                model["centroids"],
+                float(model["threshold"]) if threshold is None else threshold,
+                embedding_function,
+                audit_rate
+            )
+            # Centroids are only comparable with embeddings of the model they were computed with
+            trained_with = str(model["embedding"]) if "embedding" in model.files else "unknown"
+        used = embedding_function_id(classifier.embedding_function)
+        if trained_with != used:
+            raise ValueError(
+                f"The email classifier {path} was trained on {trained_with} embeddings, not {used}: "
+                f"retrain it with --retrain-classifier."
+            )
+        return classifier
+
+    def predict(self, email_subject, email_message):
+        embedding = embed_texts(self.embedding_function, [self.email_text(email_subject, email_message)])
+        predicted, margin = self.margins(embedding, self.centroids)
+        label = self.labels[predicted[0]]
+        confident = margin[0] >= self.threshold
+        with self.lock:
+            if confident and random.random() < self.audit_rate:
+                self.audited_count += 1
+                confident = False
+            if confident:
+                self.local_count += 1
+        return label, confident
+
+    def record_llm(self, local_label, llm_label):
+        with self.lock:
+            self.llm_count += 1
+            if local_label == llm_label.strip().lower():
+                self.agreements += 1
+
+    def log_stats(self):
+        agreement = f"{self.agreements / self.llm_count:.1%}" if self.llm_count else "n/a"
+        logging.info(
+            f"Email classifier (threshold {self.threshold:.4f}): {self.local_count} local, "
+            f"{self.llm_count} LLM ({self.audited_count} audits), agreement with the LLM {agreement}."
+        )
+
+# === Train the local email classifier on the labelled emails ===
+def train_email_classifier(spreadsheet, path=EMAIL_CLASSIFIER_PATH, embedding_function=None):
+    df_emails = load_data(spreadsheet, "emails")
+    df_email_classification = load_data(spreadsheet, "email-classification")
+    df_labelled = df_email_classification.merge(
+        df_emails, left_on='email ID', right_on='email_id', how='inner'
+    )
+    df_labelled = df_labelled[df_labelled['category'].isin(['order', 'inquiry'])]
+
+    texts = [
+        LocalEmailClassifier.email_text(subject, message)
+        for subject, message in zip(df_labelled['subject'], df_labelled['message'])
+    ]
+    classifier = LocalEmailClassifier.train(texts, list(df_labelled['category']), embedding_function)
+    classifier.save(path)
+    logging.info(f"Email classifier saved to {path}.")
+    return classifier
+
+# === Classify email ===
+def build_classification_messages(email_subject, email_message):
+    return [
+        {"role": "system", "content": "You are an email classification assistant. Classify the email into one of the following categories: 'order', 'inquiry'. Respond with the category only."},
+        {"role": "user", "content": f"Identify the category of the following email:\nSubject: {email_subject}\nMessage: {email_message}"}
+    ]
+
+async def classify_email(llm, email_classifier, email_subject, email_message):
+   # email_classifier: the local classifier tried first, None to always ask the LLM
+   local_label = None
+   if email_classifier is not None:
+       local_label, confident = await asyncio.to_thread(email_classifier.predict, email_subject, email_message)
+       if confident:
+           return local_label
+
+   # Unparsable answers fall back to an inquiry, which changes no stock
+   email_category = await llm.validated(
+       build_classification_messages(email_subject, email_message), "classification", parse_category,
+       min_confidence=CLASSIFICATION_MIN_CONFIDENCE, default="inquiry", logprobs=True
+   )
+   if local_label is not None:
+       email_classifier.record_llm(local_label, email_category)
+   return email_category
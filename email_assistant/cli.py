@@ -0,0 +1,232 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+
+from .batch import batch_provider, run_batch
+from .catalog import sync_catalog
+from .classifier import train_email_classifier
+from .llm import parse_model_routes
+from .metrics import metrics
+from .pipeline import llm_client, run_concurrent, run_sequential
+from .services import configure, connect, embedding_function_of
+from .settings import (
+    ACCESS_KEY_PATH, BATCH_DIR, CHROMA_PATH, COMMANDS, CONFIG_ENV, CONFIG_PATH, DEAD_LETTER_PATH, EMAIL_CLASSIFIER_PATH,
+    INGESTION_STATE_PATH, INQUIRY_CLUSTERS_PATH, INQUIRY_DEDUP_THRESHOLD, LLM_STAGES, MAX_EMAIL_ATTEMPTS,
+    ORDER_EXTRACTION_MODES, ORDER_RESPONSE_MODES, SPREADSHEET_URL, VECTOR_BACKENDS, WORK_QUEUE_PATH
+)
+from .sheets import SheetWriter, close_writer
+from .watch import watch
+from .workers import run_workers, worker_main
+
+# === Command line ===
+def model_routes_arg(spec):
+    try:
+        return parse_model_routes(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def read_config(parser, path, required):
+    # Defaults of the options: the settings file, then the environment variables of the settings
+    config = {}
+    if required or os.path.exists(path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                config = {key.replace("-", "_"): value for key, value in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            parser.error(f"cannot read the settings file {path}: {e}")
+    unknown = sorted(set(config) - set(vars(parser.parse_args([]))))
+    if unknown:
+        parser.error(f"unknown settings in {path}: {', '.join(unknown)}")
+    for key, variable in CONFIG_ENV.items():
+        if os.environ.get(variable):
+            config[key] = os.environ[variable]
+    return config
+
+def parse_args(argv=None):
+    # The settings file is found first, its settings are the defaults of the other options
+    config_parser = argparse.ArgumentParser(add_help=False)
+    config_parser.add_argument("--config", default=os.environ.get("EMAIL_ASSISTANT_CONFIG"),
+                               help=f"JSON file of settings keyed by option name, used as the defaults of the options "
+                                    f"(default: EMAIL_ASSISTANT_CONFIG, or {CONFIG_PATH} when it exists)")
+    config_args, _ = config_parser.parse_known_args(argv)
+
+    parser = argparse.ArgumentParser(
+        description="Classify customer emails and answer orders and inquiries.", parents=[config_parser]
+    )
+    parser.add_argument("command", nargs="?", choices=COMMANDS, default="run-all",
+                        help="run every stage (default), classify the new emails, sync the products collection "
+                             "with the products sheet, or answer the classified orders or inquiries")
+    parser.add_argument("--spreadsheet-url", default=SPREADSHEET_URL,
+                        help="Google Sheets of the emails and products (or EMAIL_ASSISTANT_SPREADSHEET_URL)")
+    parser.add_argument("--access-key-path", default=ACCESS_KEY_PATH,
+                        help="service account key opening the spreadsheet (or EMAIL_ASSISTANT_ACCESS_KEY)")
+    # Only from the settings file or OPENAI_API_KEY, keys on the command line end up in the shell history
+    parser.set_defaults(openai_api_key=None)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="process independent emails concurrently instead of one at a time")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="maximum number of OpenAI requests in flight")
+    parser.add_argument("--rpm", type=int, default=500,
+                        help="OpenAI requests per minute budget")
+    parser.add_argument("--tpm", type=int, default=80000,
+                        help="OpenAI tokens per minute budget")
+    parser.add_argument("--flush-rows", type=int, default=500,
+                        help="buffered sheet writes that trigger a flush to Google Sheets")
+    parser.add_argument("--flush-interval", type=float, default=5.0,
+                        help="seconds between periodic flushes of the buffered sheet writes")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false",
+                        help="always call the LLM, ignoring the local response cache")
+    parser.add_argument("--cache-stages", default=",".join(LLM_STAGES),
+                        help="comma separated LLM stages whose responses are cached")
+    parser.add_argument("--cache-ttl", type=float, default=30,
+                        help="days after which a cached LLM response expires")
+    parser.add_argument("--cache-max-entries", type=int, default=100000,
+                        help="cached LLM responses kept before evicting the least recently used")
+    parser.add_argument("--retrieval-batch", type=int, default=32,
+                        help="emails whose product queries are sent to the vector database together")
+    parser.add_argument("--retrieval-window", type=float, default=10,
+                        help="milliseconds concurrent product queries wait to be batched together (async mode)")
+    parser.add_argument("--chroma-path", default=CHROMA_PATH,
+                        help="directory of the persistent vector database (empty: in memory only)")
+    parser.add_argument("--vector-backend", choices=VECTOR_BACKENDS, default="chroma",
+                        help="keep the products collection in Chroma, or in an in-process NumPy index saved to --chroma-path")
+    parser.add_argument("--offline", metavar="DIR",
+                        help="use CSV files in DIR instead of Google Sheets, a fake LLM and hashed embeddings")
+    parser.add_argument("--fake-llm-latency", type=float, default=0.0,
+                        help="seconds each fake LLM call takes (offline mode)")
+    parser.add_argument("--fake-llm-max-in-flight", type=int, default=0,
+                        help="concurrent fake LLM calls above which they are rate limited (offline mode, 0: unlimited)")
+    parser.add_argument("--retrain-classifier", action="store_true",
+                        help="rebuild the local email classifier from the email-classification sheet and exit")
+    parser.add_argument("--no-local-classifier", dest="use_local_classifier", action="store_false",
+                        help="classify every email with the LLM even if a local classifier was trained")
+    parser.add_argument("--classifier-path", default=EMAIL_CLASSIFIER_PATH,
+                        help="file of the local email classifier, written by --retrain-classifier")
+    parser.add_argument("--classifier-threshold", type=float, default=None,
+                        help="confidence margin above which the local classifier decides (default: the trained one)")
+    parser.add_argument("--classifier-audit-rate", type=float, default=0.0,
+                        help="fraction of confident local decisions also sent to the LLM to measure agreement")
+    parser.add_argument("--trace-dir", default="traces",
+                        help="directory receiving a JSON trace of each run (empty: no trace)")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="write the run metrics in the Prometheus text format to PATH")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve the metrics in the Prometheus text format on this port while running")
+    parser.add_argument("--extraction", choices=ORDER_EXTRACTION_MODES, default="two-step",
+                        help="identify the ordered products with two LLM calls (suborders, then product ids) "
+                             "or a single function call on candidates retrieved from the email")
+    parser.add_argument("--order-response", choices=ORDER_RESPONSE_MODES, default="llm",
+                        help="have the LLM write the whole order response, or render the order table and totals "
+                             "locally with the LLM only writing the opening text")
+    parser.add_argument("--models", type=model_routes_arg, default="",
+                        help="comma separated stage=model or stage=model>escalation_model routes overriding the "
+                             "default model of the LLM stages (stage * for all of them)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="process the emails with this many worker processes sharing a work queue and the stock")
+    parser.add_argument("--worker", action="store_true",
+                        help="only run a worker on the shared work queue, e.g. on another node (see --queue-path)")
+    parser.add_argument("--worker-id", default=socket.gethostname(),
+                        help="name of this worker, which also names its sheet writes journal (--worker)")
+    parser.add_argument("--queue-path", default=WORK_QUEUE_PATH,
+                        help="SQLite file of the work queue and stock shared by the workers")
+    parser.add_argument("--claim-batch", type=int, default=16,
+                        help="emails a worker processes at the same time")
+    parser.add_argument("--lease", type=float, default=120,
+                        help="seconds after which the emails claimed by an unresponsive worker are claimed again")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, polling the emails sheet and processing new emails as they arrive")
+    parser.add_argument("--poll-interval", type=float, default=30,
+                        help="seconds between polls of the emails sheet (watch mode)")
+    parser.add_argument("--max-poll-interval", type=float, default=300,
+                        help="longest wait between polls, reached by backing off while no mail arrives (watch mode)")
+    parser.add_argument("--catalog-refresh", type=float, default=600,
+                        help="seconds after which the products catalog is reloaded from the sheet (watch mode)")
+    parser.add_argument("--max-cycles", type=int, default=0,
+                        help="stop after this many polls (watch mode, 0: run until interrupted)")
+    parser.add_argument("--batch", action="store_true",
+                        help="run a pass of the batch mode: collect the finished batch jobs, advance the emails "
+                             "and submit the prompts left as JSONL batch request files")
+    parser.add_argument("--batch-dir", default=BATCH_DIR,
+                        help="directory of the batch request files and of the batch mode state")
+    parser.add_argument("--batch-poll", type=float, default=0,
+                        help="keep running passes every this many seconds until no request is waiting (batch mode, 0: one pass)")
+    parser.add_argument("--state-path", default=INGESTION_STATE_PATH,
+                        help="SQLite file of the emails sheet watermark and processed emails (watch mode)")
+    parser.add_argument("--dead-letter-path", default=DEAD_LETTER_PATH,
+                        help="SQLite file of the emails whose processing failed, retried by the next runs")
+    parser.add_argument("--max-attempts", type=int, default=MAX_EMAIL_ATTEMPTS,
+                        help="failed attempts after which an email is left in the dead-letter queue")
+    parser.add_argument("--retry-dead-letters", action="store_true",
+                        help="retry the emails left in the dead-letter queue after too many failed attempts")
+    parser.add_argument("--no-inquiry-dedup", dest="use_inquiry_dedup", action="store_false",
+                        help="answer every inquiry, even the near-duplicates of an inquiry already answered")
+    parser.add_argument("--inquiry-dedup-threshold", type=float, default=INQUIRY_DEDUP_THRESHOLD,
+                        help="share of their words two inquiries have in common to be near-duplicates (Jaccard similarity)")
+    parser.add_argument("--inquiry-clusters-path", default=INQUIRY_CLUSTERS_PATH,
+                        help="SQLite file of the clusters of near-duplicate inquiries and of their answers")
+
+    parser.set_defaults(**read_config(parser, config_args.config or CONFIG_PATH, required=config_args.config is not None))
+    args = parser.parse_args(argv)
+    if args.command != "run-all" and (args.watch or args.workers or args.worker or args.batch):
+        parser.error("--watch, --workers, --worker and --batch run every stage (run-all)")
+    return args
+
+def main(args=None):
+    if args is None:
+        args = parse_args([])
+    if args.watch or args.workers or args.worker:
+        # The watch mode and the workers run the emails concurrently
+        args.use_async = True
+    if args.batch:
+        # Batch passes run the sequential pipeline
+        args.use_async = False
+
+    if args.worker:
+        # Workers connect on their own, as the ones started by run_workers
+        worker_main(args, args.worker_id)
+        return
+
+    spreadsheet, openai_client = connect(args)
+
+    if args.retrain_classifier:
+        train_email_classifier(spreadsheet, args.classifier_path, embedding_function_of(args))
+        return
+
+    services = configure(args)
+
+    if args.metrics_port:
+        metrics.serve_prometheus(args.metrics_port)
+
+    # Writes left over by a crashed run are replayed before loading any data
+    writer = SheetWriter(spreadsheet, max_rows=args.flush_rows, flush_interval=args.flush_interval)
+    failed = True
+    try:
+        if args.command == "sync-catalog":
+            sync_catalog(spreadsheet, args, services)
+        elif args.batch:
+            run_batch(spreadsheet, batch_provider(args), writer, args, services)
+        elif args.workers:
+            run_workers(spreadsheet, writer, args, services)
+        elif args.watch:
+            asyncio.run(watch(spreadsheet, openai_client, writer, args, services))
+        elif args.use_async:
+            asyncio.run(run_concurrent(spreadsheet, llm_client(openai_client, args, services), writer, args, services))
+        else:
+            asyncio.run(run_sequential(spreadsheet, llm_client(openai_client, args, services), writer, args, services))
+        failed = False
+    except KeyboardInterrupt:
+        logging.info("Interrupted, flushing pending writes.")
+        failed = False
+    finally:
+        try:
+            close_writer(writer, failed)
+        finally:
+            services.close()
+            metrics.log_summary()
+            if args.trace_dir:
+                metrics.write_trace(args.trace_dir)
+            if args.metrics_file:
+                metrics.write_prometheus(args.metrics_file)
@@ -0,0 +1,301 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from .catalog import ProductContext, product_document
+from .llm import BatchPending
+from .metrics import metrics
+from .settings import (
+    INQUIRY_ANSWER_FORMAT, INQUIRY_BATCH_CLAIM_LEASE, INQUIRY_CLAIM_LEASE, INQUIRY_CLAIM_POLL_INTERVAL,
+    INQUIRY_CLUSTERS_PATH, INQUIRY_DEDUP_THRESHOLD, INQUIRY_MINHASH_BANDS, INQUIRY_MINHASH_PERMUTATIONS, INQUIRY_STOPWORDS
+)
+from .stores import connect_shared_db, content_hash, immediate_transaction
+
+# === Generate inquiry response ===
+def build_inquiry_response_messages(email_data, relevant_products, shared=False):
+    email_subject = email_data['subject']
+    email_message = email_data['message']
+    # A shared answer is reused for the near-duplicate inquiries of other customers (see InquiryClusters)
+    if shared:
+        addressing = """The response is also sent to other customers asking the same questions: it should be concise and informative, answer the questions of the email without quoting or paraphrasing its wording, and use no name or personal detail of the customer.
+The greeting should be exactly "Dear customer,"."""
+    else:
+        addressing = "The response should be concise and informative, addressing the user's email directly."
+
+    prompt = f"""<INSTRUCTIONS>
+Generate a professional response to the user based on the email inquiry. The response should answer the customer's questions, based solely on the relevant products data.
+If the inquiry is about a specific product, provide detailed information about that product.
+If the inquiry is about a general topic, provide relevant information based on the products information available.
+{addressing}
+The signature at the bottom of the email, after the greetings, should include only the text "Customer Service Team" and no other information or placeholder.
+The tone of the email should be professional and friendly.
+The email should be structured with a clear subject line, a greeting, the body of the email, and a closing signature.
+If the information required is not available, inform the user that we need more information to provide a precise answer or suggest to visit our online store for more details.
+Only output valid HTML and no other characters.
+Double check the HTML format and ensure it is valid.
+Do not output markdown backticks. Just output raw HTML only.
+</INSTRUCTIONS>
+
+<EMAIL>
+<SUBJECT>{email_subject}</SUBJECT>
+<MESSAGE>{email_message}</MESSAGE>
+</EMAIL>
+
+<RELEVANT PRODUCTS>
+{relevant_products}
+</RELEVANT PRODUCTS>
+"""
+    return [
+        {"role": "system", "content": "You are a professional seller assistant, generating professional answers to customers inquiries via email. You generate a response to the user based solely on the product data provided."},
+        {"role": "user", "content": prompt}
+    ]
+
+async def generate_inquiry_response(llm, email_data, relevant_products, shared=False):
+    return await llm.complete(build_inquiry_response_messages(email_data, relevant_products, shared), "inquiry-response")
+
+# === Clusters of near-duplicate inquiries sharing one answer ===
+def inquiry_shingles(row):
+    # Content words of the subject and message, and the pairs of consecutive ones
+    words = [
+        word for word in re.findall(r"[a-z0-9]+", f"{row['subject']} {row['message']}".lower())
+        if word not in INQUIRY_STOPWORDS
+    ]
+    return set(words) | {f"{first} {second}" for first, second in zip(words, words[1:])}
+
+def jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+class InquiryClusters:
+    """SQLite store of the clusters of near-duplicate inquiries, each with a single answer.
+
+    An inquiry joins the cluster whose first inquiry shares at least `threshold`
+    of its words (Jaccard similarity), the candidate clusters being found
+    through the bands of the MinHash signature of the words. The answer of a
+    cluster is written for any of its customers (no name, greeting or wording
+    of the first one), and reused as long as the data and stock of the
+    products it was grounded on are unchanged, and generated again otherwise.
+
+    The inquiry answering a cluster holds a claim stored with the cluster
+    (claimed_by, claimed_until), until it resolves or abandons it or its lease
+    expires. Concurrent inquiries of the cluster wait for the answer, through
+    a future in the same process and by polling the store in other processes.
+    An inquiry whose answer waits for a batch job keeps the claim (defer) for
+    the completion window; with batch=True, the other inquiries of the cluster
+    are deferred with BatchPending instead of waiting.
+    """
+
+    def __init__(self, path=INQUIRY_CLUSTERS_PATH, threshold=INQUIRY_DEDUP_THRESHOLD,
+                 permutations=INQUIRY_MINHASH_PERMUTATIONS, bands=INQUIRY_MINHASH_BANDS, batch=False):
+        self.threshold = threshold
+        self.bands = bands
+        self.batch = batch
+        # Same permutations in every run and process, the band keys are stored
+        rng = np.random.default_rng(0)
+        self.multipliers = rng.integers(1, 2 ** 63, size=permutations, dtype=np.uint64) | np.uint64(1)
+        self.increments = rng.integers(0, 2 ** 63, size=permutations, dtype=np.uint64)
+        self.pending = {}
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        # Shared by the worker processes
+        self.connection = connect_shared_db(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS inquiry_clusters (
+            cluster_id INTEGER PRIMARY KEY,
+            shingles TEXT,
+            product_ids TEXT,
+            products_hash TEXT,
+            response TEXT,
+            inquiries INTEGER DEFAULT 1,
+            updated_at REAL,
+            claimed_by TEXT,
+            claimed_until REAL,
+            claim_batch INTEGER DEFAULT 0
+        )""")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS inquiry_bands (band_key TEXT, cluster_id INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS inquiry_bands_key ON inquiry_bands (band_key)")
+
+    def band_keys(self, shingles):
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little") for shingle in sorted(shingles)]
+            or [0],
+            dtype=np.uint64
+        )
+        # a * h + b wraps around 2^64, one permutation per row
+        signature = (self.multipliers[:, None] * hashes[None, :] + self.increments[:, None]).min(axis=1)
+        return [f"{band}:{rows.tobytes().hex()}" for band, rows in enumerate(np.array_split(signature, self.bands))]
+
+    @staticmethod
+    def products_hash(product_ids, products):
+        # Data and available stock of the products the answer was grounded on
+        return content_hash(INQUIRY_ANSWER_FORMAT, [
+            (product_id, product_document(products.get(product_id)) if product_id in products else None, products.available(product_id))
+            for product_id in sorted(product_ids)
+        ])
+
+    def _find(self, shingles, band_keys):
+        candidates = self.connection.execute(
+            f"""SELECT cluster_id, shingles, response, product_ids, products_hash, claimed_by, claimed_until, claim_batch
+            FROM inquiry_clusters
+            WHERE cluster_id IN (SELECT cluster_id FROM inquiry_bands WHERE band_key IN ({','.join('?' * len(band_keys))}))""",
+            band_keys
+        ).fetchall()
+        best, best_similarity = None, self.threshold
+        for cluster_id, cluster_shingles, *cluster in candidates:
+            similarity = jaccard(shingles, set(json.loads(cluster_shingles)))
+            if similarity >= best_similarity:
+                best, best_similarity = (cluster_id, *cluster), similarity
+        return best
+
+    def claim(self, row, products):
+        # (cluster_id, answer to reuse, future of the answer being generated for the cluster in this process);
+        # with neither, the caller holds the claim: it generates the answer and calls resolve(), abandon() or defer().
+        # cluster_id is None while another process holds the claim: the caller claims again later.
+        email_id = str(row['email_id'])
+        shingles = inquiry_shingles(row)
+        band_keys = self.band_keys(shingles)
+        now = time.time()
+        with self.lock, immediate_transaction(self.connection):
+            cluster = self._find(shingles, band_keys)
+            if cluster is None:
+                cluster_id = self.connection.execute(
+                    "INSERT INTO inquiry_clusters (shingles, updated_at, claimed_by, claimed_until) VALUES (?, ?, ?, ?)",
+                    (json.dumps(sorted(shingles)), now, email_id, now + INQUIRY_CLAIM_LEASE)
+                ).lastrowid
+                self.connection.executemany(
+                    "INSERT INTO inquiry_bands (band_key, cluster_id) VALUES (?, ?)", [(key, cluster_id) for key in band_keys]
+                )
+                self._count("new")
+            else:
+                cluster_id, response, product_ids, products_hash, claimed_by, claimed_until, claim_batch = cluster
+                fresh = response is not None and products_hash == self.products_hash(json.loads(product_ids), products)
+                shared = self.pending.get(cluster_id)
+                # A batch answer is only waited for by the batch passes, the other runs answer the cluster themselves
+                held = (
+                    not fresh and shared is None and claimed_by is not None and claimed_by != email_id
+                    and claimed_until > now and (self.batch or not claim_batch)
+                )
+                if held:
+                    if self.batch:
+                        raise BatchPending(f"inquiry cluster {cluster_id} answered by email {claimed_by}")
+                    return None, None, None
+                self.connection.execute(
+                    "UPDATE inquiry_clusters SET inquiries = inquiries + 1 WHERE cluster_id = ?", (cluster_id,)
+                )
+                if fresh or shared is not None:
+                    self._count("reused")
+                    return cluster_id, response if fresh else None, None if fresh else shared
+                if response is not None:
+                    self._count("stale")
+                self.connection.execute(
+                    "UPDATE inquiry_clusters SET claimed_by = ?, claimed_until = ?, claim_batch = 0 WHERE cluster_id = ?",
+                    (email_id, now + INQUIRY_CLAIM_LEASE, cluster_id)
+                )
+            self.pending[cluster_id] = concurrent.futures.Future()
+        return cluster_id, None, None
+
+    def _count(self, name):
+        self.counts[name] += 1
+        metrics.count(f"inquiry_clusters:{name}")
+
+    def resolve(self, cluster_id, response, product_ids, products):
+        # product_ids: the products the answer was grounded on
+        products_hash = self.products_hash(product_ids, products)
+        with self.lock:
+            future = self.pending.pop(cluster_id)
+            self.connection.execute(
+                """UPDATE inquiry_clusters SET response = ?, product_ids = ?, products_hash = ?, updated_at = ?,
+                claimed_by = NULL, claimed_until = NULL, claim_batch = 0 WHERE cluster_id = ?""",
+                (response, json.dumps(sorted(product_ids)), products_hash, time.time(), cluster_id)
+            )
+        future.set_result(response)
+
+    def abandon(self, cluster_id, error):
+        # The inquiries waiting for the answer fail as well, and are retried with their email
+        with self.lock:
+            future = self.pending.pop(cluster_id)
+            self.connection.execute(
+                "UPDATE inquiry_clusters SET claimed_by = NULL, claimed_until = NULL, claim_batch = 0 WHERE cluster_id = ?",
+                (cluster_id,)
+            )
+        future.set_exception(error)
+
+    def defer(self, cluster_id, error):
+        # The answer waits for a batch job: the claim is kept until the next passes collect it
+        with self.lock:
+            future = self.pending.pop(cluster_id)
+            self.connection.execute(
+                "UPDATE inquiry_clusters SET claimed_until = ?, claim_batch = 1 WHERE cluster_id = ?",
+                (time.time() + INQUIRY_BATCH_CLAIM_LEASE, cluster_id)
+            )
+        future.set_exception(error)
+
+    def log_stats(self):
+        if self.counts:
+            logging.info(
+                f"Inquiry clusters: {self.counts['reused']} answers reused, {self.counts['new']} new clusters, "
+                f"{self.counts['stale']} stale answers generated again (changed products or answer format)."
+            )
+
+    def close(self):
+        self.connection.close()
+
+async def answer_inquiry(inquiry_clusters, row, products, generate):
+    # generate() returns the answer and the products it was grounded on, unless a near-duplicate
+    # inquiry was answered from products that did not change since (inquiry_clusters: None to always generate)
+    if inquiry_clusters is None:
+        return (await generate())[0]
+    cluster_id, response, shared = await asyncio.to_thread(inquiry_clusters.claim, row, products)
+    while cluster_id is None:
+        # Another process answers the cluster
+        await asyncio.sleep(INQUIRY_CLAIM_POLL_INTERVAL)
+        cluster_id, response, shared = await asyncio.to_thread(inquiry_clusters.claim, row, products)
+    if response is not None:
+        return response
+    if shared is not None:
+        return await asyncio.wrap_future(shared)
+    try:
+        response, product_ids = await generate()
+    except BatchPending as error:
+        inquiry_clusters.defer(cluster_id, error)
+        raise
+    except BaseException as error:
+        inquiry_clusters.abandon(cluster_id, error)
+        raise
+    await asyncio.to_thread(inquiry_clusters.resolve, cluster_id, response, product_ids, products)
+    return response
+
+# === Process an inquiry email ===
+def inquiry_product_query(row):
+    return (f"{row['subject']} - {row['message']}", 5, None)
+
+async def grounded_inquiry_response(llm, row, retriever, shared=False):
+    # shared: the answer is written for any customer of the inquiry cluster
+    product_data = ProductContext()
+    product_data.add_results(await asyncio.to_thread(retriever.query, *inquiry_product_query(row)))
+    lines = product_data.lines()
+    response = await generate_inquiry_response(llm, row, "\n".join(lines.values()), shared)
+    return response, list(lines)
+
+async def process_inquiry(pipeline, row):
+    email_id = row['email_id']
+    inquiry_clusters = pipeline.services.inquiry_clusters
+
+    logging.info(f"####Processing inquiry for email ID {email_id}...")
+
+    retriever, products = await pipeline.catalog_ready()
+    response = await answer_inquiry(
+        inquiry_clusters, row, products,
+        lambda: grounded_inquiry_response(pipeline.llm, row, retriever, shared=inquiry_clusters is not None)
+    )
+    await asyncio.to_thread(pipeline.sheets["inquiry-response"].append_row, [email_id, response])
+
+    logging.info(f"######Inquiry response generated for email ID {email_id}...")
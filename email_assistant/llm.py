@@ -0,0 +1,337 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:  # Token counts are estimated instead
+    tiktoken = None
+
+from .metrics import metrics
+from .scheduling import failure_kind, retry_delay
+from .settings import (
+    COMPLETION_TOKENS_ESTIMATE, EMAIL_CATEGORIES, JSON_REPAIR_RETRIES, LLM_CACHE_PATH, LLM_STAGES, MAX_RETRIES, MODEL_ROUTES,
+    OPENAI_MODEL,
+)
+from .stores import content_hash
+
+# LLM stage of the chat completion being sent, which names its request in batch mode
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+class BatchPending(Exception):
+    """The answer of a chat completion is left to a batch job not finished yet."""
+
+class BatchRequestError(Exception):
+    """The batch job answered a chat completion with an error."""
+
+# === LLM response cache ===
+class LLMCache:
+    """SQLite cache of chat completions, keyed on model, messages and parameters.
+
+    Entries older than ttl seconds are ignored and purged; when more than
+    max_entries are stored the least recently used ones are evicted. Only the
+    stages listed in `stages` are cached.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_entries=100000, ttl=30 * 24 * 3600, stages=LLM_STAGES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stages = set(stages)
+        self.hits = {stage: 0 for stage in LLM_STAGES}
+        self.misses = {stage: 0 for stage in LLM_STAGES}
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            stage TEXT,
+            content TEXT,
+            created_at REAL,
+            accessed_at REAL
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(model, messages, params):
+        return content_hash(model, messages, params)
+
+    def enabled(self, stage):
+        return stage in self.stages
+
+    def get(self, stage, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT content FROM responses WHERE key = ? AND created_at >= ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                self.misses[stage] += 1
+                return None
+            self.hits[stage] += 1
+            self.connection.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, stage, key, content):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, stage, content, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, content, now, now)
+            )
+            self._evict(now)
+            self.connection.commit()
+
+    def _evict(self, now):
+        self.connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        self.connection.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def log_stats(self):
+        for stage in LLM_STAGES:
+            if self.hits[stage] or self.misses[stage]:
+                logging.info(f"LLM cache {stage}: {self.hits[stage]} hits, {self.misses[stage]} misses.")
+
+    def close(self):
+        self.connection.close()
+
+# === Model of each stage ===
+def parse_model_routes(spec):
+    # "stage=model" or "stage=model>escalation_model", comma separated; "*" sets every stage
+    routes = dict(MODEL_ROUTES)
+    for item in filter(None, (item.strip() for item in spec.split(","))):
+        stage, _, models = item.partition("=")
+        stage = stage.strip()
+        model, _, escalation_model = models.partition(">")
+        if stage != "*" and stage not in LLM_STAGES:
+            raise ValueError(f"unknown LLM stage {stage!r} in --models")
+        if not model.strip():
+            raise ValueError(f"no model for {stage!r} in --models")
+        for name in (LLM_STAGES if stage == "*" else [stage]):
+            routes[name] = (model.strip(), escalation_model.strip() or None)
+    return routes
+
+# === Chat completion ===
+class LLMClient:
+    """Sends the chat completions of the pipeline stages to the OpenAI client (or a stand-in).
+
+    Each stage is answered by the model routed to it (routes, see
+    parse_model_routes), from the cache when it has the answer. Calls run
+    within the rate limits of the limiter and are retried on transient
+    failures and rate limits; without a limiter (batch passes, which only
+    record their requests) they are sent straight away.
+    """
+
+    def __init__(self, openai_client, limiter=None, cache=None, routes=MODEL_ROUTES):
+        self.openai_client = openai_client
+        self.limiter = limiter
+        self.cache = cache
+        self.routes = routes
+
+    def model(self, stage, escalated=False):
+        model, escalation_model = self.routes.get(stage, (OPENAI_MODEL, None))
+        return escalation_model if escalated else model
+
+    def escalate(self, stage, escalated):
+        # Whether the next attempt of a stage goes to its escalation model
+        if not escalated and self.model(stage, escalated=True) is not None:
+            metrics.count(f"escalations:{stage}")
+            return True
+        return escalated
+
+    def cached(self, stage, model, messages, params):
+        if self.cache is None or not self.cache.enabled(stage):
+            return None, None
+        key = LLMCache.key(model, messages, params)
+        content = self.cache.get(stage, key)
+        if content is not None:
+            metrics.count(f"llm_cache_hits:{stage}")
+        return key, content
+
+    async def _send(self, model, messages, stage, params):
+        token = current_stage.set(stage)
+        try:
+            with metrics.stage(f"llm:{stage}"), metrics.stage(f"model:{model}"):
+                return await self.openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    **params)
+        finally:
+            current_stage.reset(token)
+
+    async def _create(self, model, messages, stage, params):
+        if self.limiter is None:
+            return await self._send(model, messages, stage, params)
+        # The slot adapts the concurrency limit to the outcome of the call
+        async with self.limiter.slot(estimate_tokens(messages)) as slot:
+            response = await self._send(model, messages, stage, params)
+            if response.usage is not None:
+                slot.used_tokens = response.usage.total_tokens
+        return response
+
+    async def complete(self, messages, stage, model=None, with_confidence=False, complete_only=False, **params):
+        # with_confidence also returns the probability of the first token of the answer
+        # (None when unknown, e.g. for cached answers); it needs logprobs=True.
+        # complete_only returns None instead of an answer cut at max_tokens.
+        model = model or self.model(stage)
+        key, content = self.cached(stage, model, messages, params)
+        if content is not None:
+            return (content, None) if with_confidence else content
+
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = await self._create(model, messages, stage, params)
+                break
+            except Exception as e:
+                if failure_kind(e) is None or attempt == MAX_RETRIES:
+                    raise
+                delay = retry_delay(attempt, e)
+                metrics.count(f"retries:llm:{stage}")
+                logging.warning(f"Retrying {stage} in {delay:.1f} s after {type(e).__name__}.")
+                await asyncio.sleep(delay)
+        metrics.record_usage(stage, model, response.usage)
+        content = response_content(response)
+        if complete_only and answer_cut(response):
+            metrics.count(f"cut_answers:{stage}")
+            content = None
+        if key is not None and content is not None:
+            self.cache.put(stage, key, content)
+        return (content, answer_confidence(response)) if with_confidence else content
+
+    # Chat completion whose answer is validated, with repair retries. Invalid answers are repaired by the
+    # escalation model of the stage. Valid answers less likely than min_confidence are asked again to it,
+    # and kept if its answer is invalid.
+    async def validated(self, messages, stage, parse, min_confidence=None, default=None, **params):
+        escalated = False
+        repairs = 0
+        fallback = [] if default is None else default
+        while True:
+            content, confidence = await self.complete(
+                messages, stage, model=self.model(stage, escalated), with_confidence=True, **params
+            )
+            try:
+                answer = parse(content)
+            except ValueError as e:
+                if repairs == JSON_REPAIR_RETRIES:
+                    logging.error(f"Invalid {stage} answer after {JSON_REPAIR_RETRIES} repairs: {e}")
+                    return fallback
+                repairs += 1
+                metrics.count(f"repairs:{stage}")
+                logging.warning(f"Invalid {stage} answer ({e}), asking for a repair.")
+                messages = repair_messages(messages, content, e)
+                escalated = self.escalate(stage, escalated)
+                continue
+            if escalated or not low_confidence(stage, confidence, min_confidence) or not self.escalate(stage, escalated):
+                return answer
+            escalated = True
+            fallback = answer
+
+    def log_stats(self):
+        if self.limiter is not None:
+            self.limiter.log_stats()
+
+# === Text of the answer, or the arguments of the function it called ===
+def response_content(response):
+    message = response.choices[0].message
+    if message.tool_calls:
+        return message.tool_calls[0].function.arguments
+    return message.content
+
+def answer_cut(response):
+    # The answer reached max_tokens before its end
+    return getattr(response.choices[0], "finish_reason", None) == "length"
+
+def answer_confidence(response):
+    logprobs = getattr(response.choices[0], "logprobs", None)
+    if logprobs is None or not logprobs.content:
+        return None
+    return math.exp(logprobs.content[0].logprob)
+
+# === Count the tokens of a text with the model tokenizer ===
+token_encoding_lock = threading.Lock()
+
+def token_encoding():
+    # Loaded once, even when several threads count tokens at startup
+    with token_encoding_lock:
+        return load_token_encoding()
+
+@functools.lru_cache(maxsize=None)
+def load_token_encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
+    except Exception as e:
+        # The encoding is downloaded on first use
+        logging.warning(f"No tokenizer available for {OPENAI_MODEL} ({e}), token counts are estimated.")
+        return None
+
+def count_tokens(text):
+    encoding = token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+# === Estimate tokens used by a request ===
+def estimate_tokens(messages, completion_tokens=COMPLETION_TOKENS_ESTIMATE):
+    # Roughly 4 characters per token for English text
+    return sum(len(message["content"]) for message in messages) // 4 + completion_tokens
+
+# === Parse and validate the JSON answers ===
+def load_json_object(content):
+    if not content:
+        raise ValueError("the answer is empty")
+    data = json.loads(content)
+    if not isinstance(data, dict) or not isinstance(data.get('data'), list):
+        raise ValueError('the answer must be a JSON object with a "data" list')
+    return data['data']
+
+def parse_suborders(content):
+    suborders = load_json_object(content)
+    if not all(isinstance(suborder, dict) for suborder in suborders):
+        raise ValueError('every item of "data" must be an object')
+    return suborders
+
+def parse_order_data(content, product_ids=None):
+    orders = {}
+    for order in load_json_object(content):
+        if not isinstance(order, dict) or 'product_id' not in order:
+            raise ValueError(f"order without a product_id: {order}")
+        product_id = str(order['product_id']).strip()
+        if product_ids is not None and product_id not in product_ids:
+            raise ValueError(f"product_id {product_id} is not in the products list")
+        try:
+            quantity = float(order.get('quantity', 1))
+        except (TypeError, ValueError):
+            raise ValueError(f"quantity of {product_id} is not a number: {order.get('quantity')!r}")
+        if not quantity.is_integer() or quantity < 1:
+            raise ValueError(f"quantity of {product_id} must be a positive integer, got {order.get('quantity')!r}")
+        # One order line per product, with the total quantity
+        orders[product_id] = orders.get(product_id, 0) + int(quantity)
+    return [{"product_id": product_id, "quantity": quantity} for product_id, quantity in orders.items()]
+
+def parse_category(content):
+    category = (content or "").strip().strip("'\".").lower()
+    if category not in EMAIL_CATEGORIES:
+        raise ValueError(f"the category must be one of {', '.join(EMAIL_CATEGORIES)}, got {content!r}")
+    return category
+
+def repair_messages(messages, content, error):
+    return messages + [
+        {"role": "assistant", "content": content or ""},
+        {"role": "user", "content": f"This answer is invalid: {error}. Answer again with the corrected answer, in the requested format."},
+    ]
+
+def low_confidence(stage, confidence, min_confidence):
+    if min_confidence is None or confidence is None or confidence >= min_confidence:
+        return False
+    metrics.count(f"low_confidence:{stage}")
+    return True
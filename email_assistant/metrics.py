@@ -0,0 +1,232 @@
+import collections
+import contextlib
+import contextvars
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .settings import MODEL_PRICES
+
+# === Run metrics ===
+class Metrics:
+    """Wall time of each stage, token usage, API calls and counters of the current run.
+
+    Stage names are prefixed by the service they call ("llm:", "chroma:",
+    "sheets:"). Token usage and the time spent on each email are attributed to
+    the email being processed in the current context (see email()).
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.durations = collections.defaultdict(list)
+        self.counters = collections.Counter()
+        self.emails = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def email(self, email_id, category=None):
+        # Everything measured inside the block is attributed to this email
+        token = current_email.set(str(email_id))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            current_email.reset(token)
+            with self.lock:
+                email = self._email(str(email_id))
+                email["seconds"] += time.perf_counter() - started
+                if category is not None:
+                    email["category"] = category
+
+    def _email(self, email_id):
+        return self.emails.setdefault(email_id, {
+            "category": None, "seconds": 0.0, "llm_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0
+        })
+
+    def set_category(self, email_id, category):
+        with self.lock:
+            self._email(str(email_id))["category"] = category
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.durations[name].append(seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_usage(self, stage, model, usage):
+        if usage is None:
+            return
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        cost = (usage.prompt_tokens * prompt_price + usage.completion_tokens * completion_price) / 1000
+        with self.lock:
+            self.counters[f"prompt_tokens:{stage}"] += usage.prompt_tokens
+            self.counters[f"completion_tokens:{stage}"] += usage.completion_tokens
+            self.counters["cost_dollars"] += cost
+            self.counters[f"model_prompt_tokens:{model}"] += usage.prompt_tokens
+            self.counters[f"model_completion_tokens:{model}"] += usage.completion_tokens
+            self.counters[f"model_cost_dollars:{model}"] += cost
+            email_id = current_email.get()
+            if email_id is not None:
+                email = self._email(email_id)
+                email["llm_calls"] += 1
+                email["prompt_tokens"] += usage.prompt_tokens
+                email["completion_tokens"] += usage.completion_tokens
+                email["cost"] += cost
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for name, durations in sorted(self.durations.items()):
+                durations = np.asarray(durations)
+                stages[name] = {
+                    "count": len(durations),
+                    "total": float(durations.sum()),
+                    "p50": float(np.percentile(durations, 50)),
+                    "p95": float(np.percentile(durations, 95)),
+                }
+            for category in sorted({str(email["category"]) for email in self.emails.values()}):
+                seconds = np.asarray([email["seconds"] for email in self.emails.values() if str(email["category"]) == category])
+                stages[f"email:{category}"] = {
+                    "count": len(seconds),
+                    "total": float(seconds.sum()),
+                    "p50": float(np.percentile(seconds, 50)),
+                    "p95": float(np.percentile(seconds, 95)),
+                }
+
+            calls = {
+                service: sum(stage["count"] for name, stage in stages.items() if name.startswith(f"{service}:"))
+                for service in ("llm", "chroma", "sheets")
+            }
+            service_stages = {name: stage for name, stage in stages.items() if not name.startswith(("email:", "model:"))}
+            models = {}
+            for name, stage in stages.items():
+                if name.startswith("model:"):
+                    model = name[len("model:"):]
+                    models[model] = {
+                        "calls": stage["count"],
+                        "p50": stage["p50"],
+                        "p95": stage["p95"],
+                        "prompt_tokens": self.counters[f"model_prompt_tokens:{model}"],
+                        "completion_tokens": self.counters[f"model_completion_tokens:{model}"],
+                        "cost_dollars": self.counters[f"model_cost_dollars:{model}"],
+                    }
+            slowest = max(service_stages, key=lambda name: service_stages[name]["total"]) if service_stages else None
+            prompt_tokens = sum(value for name, value in self.counters.items() if name.startswith("prompt_tokens:"))
+            completion_tokens = sum(value for name, value in self.counters.items() if name.startswith("completion_tokens:"))
+            emails = len(self.emails)
+            return {
+                "stages": stages,
+                "counters": dict(self.counters),
+                "calls": calls,
+                "slowest_stage": slowest,
+                "models": models,
+                "emails": emails,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cost_dollars": self.counters["cost_dollars"],
+                "cost_per_email": self.counters["cost_dollars"] / emails if emails else 0.0,
+                "tokens_per_email": (prompt_tokens + completion_tokens) / emails if emails else 0.0,
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        if summary["slowest_stage"] is not None:
+            slowest = summary["stages"][summary["slowest_stage"]]
+            logging.info(f"Slowest stage: {summary['slowest_stage']} ({slowest['total']:.1f} s over {slowest['count']} calls).")
+        logging.info(
+            f"{summary['emails']} emails, {summary['calls']['llm']} LLM, {summary['calls']['chroma']} Chroma and "
+            f"{summary['calls']['sheets']} Sheets calls, {summary['tokens_per_email']:.0f} tokens and "
+            f"${summary['cost_per_email']:.4f} per email."
+        )
+        for model, stats in summary["models"].items():
+            logging.info(
+                f"Model {model}: {stats['calls']} calls, p50 {stats['p50']:.2f} s, p95 {stats['p95']:.2f} s, "
+                f"{stats['prompt_tokens'] + stats['completion_tokens']} tokens, ${stats['cost_dollars']:.4f}."
+            )
+
+    def write_trace(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime("run-%Y%m%d-%H%M%S.json", time.localtime(self.started_at)))
+        with self.lock:
+            emails = {email_id: dict(email) for email_id, email in self.emails.items()}
+        trace = {"started_at": self.started_at, "finished_at": time.time(), **self.summary(), "per_email": emails}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f, indent=2, default=str)
+        logging.info(f"Run trace written to {path}.")
+        return path
+
+    def prometheus_text(self):
+        summary = self.summary()
+        lines = [
+            "# HELP email_assistant_stage_seconds Wall time of the pipeline stages.",
+            "# TYPE email_assistant_stage_seconds summary",
+        ]
+        for name, stage in summary["stages"].items():
+            lines += [
+                f'email_assistant_stage_seconds{{stage="{name}",quantile="0.5"}} {stage["p50"]}',
+                f'email_assistant_stage_seconds{{stage="{name}",quantile="0.95"}} {stage["p95"]}',
+                f'email_assistant_stage_seconds_sum{{stage="{name}"}} {stage["total"]}',
+                f'email_assistant_stage_seconds_count{{stage="{name}"}} {stage["count"]}',
+            ]
+        lines += ["# HELP email_assistant_events_total Counters of the run.", "# TYPE email_assistant_events_total counter"]
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f'email_assistant_events_total{{name="{name}"}} {value}')
+        lines += [
+            "# TYPE email_assistant_emails_total counter",
+            f"email_assistant_emails_total {summary['emails']}",
+            "# TYPE email_assistant_cost_dollars_total counter",
+            f"email_assistant_cost_dollars_total {summary['cost_dollars']}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(path + ".tmp", path)
+
+    def serve_prometheus(self, port):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Prometheus metrics served on port {port}.")
+        return server
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.durations.clear()
+            self.counters.clear()
+            self.emails.clear()
+
+# Email whose processing is running in the current thread or task
+current_email = contextvars.ContextVar("current_email", default=None)
+
+metrics = Metrics()
@@ -0,0 +1,546 @@
+import asyncio
+import html
+import json
+import logging
+import re
+
+from .catalog import ProductContext, product_document
+from .llm import parse_order_data, parse_suborders
+from .metrics import metrics
+from .settings import (
+    ALTERNATIVES_PER_PRODUCT, ORDER_CANDIDATE_SENTENCES, ORDER_CONFIRMED_PROSE, ORDER_PROSE_MAX_TOKENS,
+    ORDER_RESPONSE_ALTERNATIVES, ORDER_STATUS_PROSE, ORDER_UNIDENTIFIED_PROSE
+)
+
+# === Generate suborders from email ===  
+def build_suborders_messages(query):
+    prompt = f"""<INSTRUCTIONS>
+Given the following user email, generate a list of independent orders that corresponds to each product the user wants to order through the email. 
+For each order, return two fields: product_data, a text containing all the information provided by the customer in regard to the specific product required (product name, product id, product description, etc.); quantity: the desired quantity in numerical format.
+Make sure the customer wants to buy the product, based on the information provided in the email.
+Return the result as JSON with the key "data" and the list of orders as its value.
+If no products are identified, return a JSON with the key "data" and the list of orders as an empty list.
+Only output valid JSON and no other characters.
+Double check the JSON format and ensure it is valid.
+Do not output markdown backticks. Just output raw JSON only.
+</INSTRUCTIONS>
+
+<QUERY>{query}</QUERY>
+"""
+    return [
+        {"role": "system", "content": "You are an order processing assistant. Generate suborders based only on the user's email."},
+        {"role": "user", "content": prompt}
+    ]
+
+async def generate_suborders(llm, query):
+    return await llm.validated(build_suborders_messages(query), "suborders", parse_suborders)
+
+# === Process order request to get product_id and quantity for each order ===
+def build_order_request_messages(email_data, suborders, relevant_products):
+    email_subject = email_data['subject']
+    email_message = email_data['message']
+
+    prompt = f"""<INSTRUCTIONS>
+Given the following user email, generate a list of orders that corresponds to each product the user wants to order through the email. 
+To help in identifying the orders there is a hypotetical list of orders that have already been identified from the email and that should be considered in the identification of the orders.
+If the hypotetical list of orders is empty, just use the email subject and message to identify the products, using solely the products present in the product list provided.
+The identification of the products should be based solely on the products present in the product list provided.
+For each order, return two fields: product_id, the id corresponding to the product that the user wants to order, taken from the products list provided; quantity: the user desired quantity for the product in numerical format.
+If the hypotetical orders are provided, always use the quantity identified within the hypotetical list of orders provided.
+If no hypotetical orders are provided, identify the quantity based on the email subject and message.
+If unsure about the quantity and the hypotetical order is not empty and has a valid numerical quantity, use that one as default.
+There must be only one order for each product, with the total quantity required for that specific product. The quantity must be a number and should not include any other information.
+If it is not possible to identify the quantity as a number, return 1 as the default quantity.
+If the user has provided a quantity range, return the maximum value of the range as the quantity if the availability in stock allows it.
+If the user has provided a quantity range and the maximum value of the range is not available in stock, return the maximum value of the range that is available in stock and that is greater than the minimum in the range.
+If the user has provided a quantity range and the minimum value in the range is uqual to or greater than the available stock, use the minimum value in the range as quantity.
+If it is not possible to identify a product, skip it.
+If no products are identified, return an empty list.
+If you are unable to identify the product id for a specific product, skip the product from the order list.
+If the description provided in the email by the user does not clearly match any product in the products list provided, skip that product from the order list.
+If the quantity in stock is not sufficient to fulfill the order, the quantity should be kept the same and not diminished to send a partial order.
+Return the result as JSON with the key "data" and the list of orders as its value.
+Only output valid JSON and no other characters.
+Double check the JSON format and ensure it is valid.
+Do not output markdown backticks. Just output raw JSON only.
+</INSTRUCTIONS>
+
+<EMAIL>
+<SUBJECT>{email_subject}</SUBJECT>
+<MESSAGE>{email_message}</MESSAGE>
+</EMAIL>
+
+<ORDERS HYPOTESIS>
+    {json.dumps(suborders)}
+</ORDERS HYPOTESIS>
+<PRODUCTS LIST>
+    {relevant_products}
+</PRODUCTS LIST>
+
+"""
+    return [
+        {"role": "system", "content": "You are an order processing assistant. Generate a list of orders based only on the user's email, on the orders hypotesis, and on the products list provided."},
+        {"role": "user", "content": prompt}
+    ]
+
+async def process_order_request(llm, email_data, suborders, relevant_products, product_ids):
+    # product_ids: the products listed in the prompt, the only ones the answer may order
+    return await llm.validated(
+        build_order_request_messages(email_data, suborders, relevant_products), "order-request",
+        lambda content: parse_order_data(content, product_ids)
+    )
+
+# === Extract the orders of an email in a single call ===
+def order_candidate_queries(email_subject, email_message):
+    # The whole email, plus each sentence on its own for emails ordering several products
+    sentences = [
+        sentence for sentence in re.split(r"(?<=[.!?;])\s+|\n+", str(email_message)) if len(sentence.split()) >= 3
+    ]
+    return [(f"{email_subject} - {email_message}", 10, None)] + [
+        (sentence, 3, None) for sentence in sentences[:ORDER_CANDIDATE_SENTENCES]
+    ]
+
+def find_order_candidates(retriever, products, email_subject, email_message):
+    candidates = ProductContext()
+    # Product IDs quoted in the email are candidates even when the search misses them, and come first
+    for token in re.findall(r"[A-Za-z0-9]+", f"{email_subject} {email_message}"):
+        for product_id in (token, token.upper()):
+            product = products.get(product_id)
+            if product is not None:
+                candidates.add(product_id, product_document(product), product, rank=-1)
+
+    for found_products in retriever.query_many(order_candidate_queries(email_subject, email_message)):
+        candidates.add_results(found_products)
+    return candidates
+
+def order_extraction_tool(product_ids):
+    return {
+        "type": "function",
+        "function": {
+            "name": "record_order",
+            "description": "Record the products the customer orders, with the quantity of each.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "data": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "product_id": {"type": "string", "enum": product_ids},
+                                "quantity": {"type": "integer", "minimum": 1},
+                            },
+                            "required": ["product_id", "quantity"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["data"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def build_order_extraction_request(email_data, candidates):
+    email_subject = email_data['subject']
+    email_message = email_data['message']
+    products = candidates.lines()
+    relevant_products = "\n".join(products.values())
+
+    prompt = f"""<INSTRUCTIONS>
+Given the following user email, identify each product the user wants to order through the email and record the orders with the record_order function.
+Make sure the customer wants to buy the product, based on the information provided in the email.
+The identification of the products should be based solely on the products present in the product list provided.
+For each order, return two fields: product_id, the id corresponding to the product that the user wants to order, taken from the products list provided; quantity: the user desired quantity for the product in numerical format.
+There must be only one order for each product, with the total quantity required for that specific product.
+If it is not possible to identify the quantity as a number, use 1 as the default quantity.
+If the user has provided a quantity range, use the maximum value of the range as the quantity if the availability in stock allows it.
+If the user has provided a quantity range and the maximum value of the range is not available in stock, use the maximum value of the range that is available in stock and that is greater than the minimum in the range.
+If the user has provided a quantity range and the minimum value in the range is equal to or greater than the available stock, use the minimum value in the range as quantity.
+If the description provided in the email by the user does not clearly match any product in the products list provided, skip that product from the order list.
+If the quantity in stock is not sufficient to fulfill the order, the quantity should be kept the same and not diminished to send a partial order.
+If no products are identified, record an empty list.
+</INSTRUCTIONS>
+
+<EMAIL>
+<SUBJECT>{email_subject}</SUBJECT>
+<MESSAGE>{email_message}</MESSAGE>
+</EMAIL>
+
+<PRODUCTS LIST>
+    {relevant_products}
+</PRODUCTS LIST>
+"""
+    messages = [
+        {"role": "system", "content": "You are an order processing assistant. Extract the orders of the user's email, using only the products list provided."},
+        {"role": "user", "content": prompt}
+    ]
+    # The forced function call makes the model answer with arguments following the schema
+    params = {
+        "tools": [order_extraction_tool(list(products))],
+        "tool_choice": {"type": "function", "function": {"name": "record_order"}},
+    }
+    return messages, params, list(products)
+
+async def extract_order(llm, email_data, candidates):
+    if not candidates:
+        return []
+    messages, params, product_ids = build_order_extraction_request(email_data, candidates)
+    return await llm.validated(
+        messages, "order-extraction", lambda content: parse_order_data(content, product_ids), **params
+    )
+
+# === Generate order response ===
+def build_order_response_messages(email_data, order_data, relevant_products):
+    email_subject = email_data['subject']
+    email_message = email_data['message']
+    orders = ''.join([
+        f"""<ORDER>
+    <PRODUCT ID>{x.get('product_id')}</PRODUCT ID>
+    <QUANTITY>{x.get('quantity')}</QUANTITY>
+    <STATUS>{x.get('status')}</STATUS>
+    <UNIT PRICE>{x.get('price')}</UNIT PRICE>+
+    <CURRENTLY IN STOCK>{x.get('currently_in_stock')}</CURRENTLY IN STOCK>
+</ORDER>""" for x in order_data
+    ])
+
+    prompt = f"""<INSTRUCTIONS>
+Generate a professional response to the user based on the order data provided. The response should confirm the order and provide details about the products ordered.
+If all the products are out of stock, inform the user that the order cannot be processed.
+If some products are out of stock, inform the user about the products that are out of stock and confirm the order for the available products.
+If some products are out of stock, you may suggest to the user alternative products among the relevant products provided that are available in stock in the required quantity and that are similar to the products ordered which are missing.
+If among the alternative products there is nothing that is similar to the product out of stock (check the product description for this), don't propose alternative products.
+If some products are out of stock and there are no alternatives available or appropriate, encourage the user to wait for restock.
+The response should be concise and informative, addressing the user's email directly.
+The signature at the bottom of the email, after the greetings, should include only the text "Customer Service Team" and no other information or placeholder.
+The tone of the email should be professional and friendly.
+All prices are intended in US dollars and are shown using the specific symbol ($).
+The email should be structured with a clear subject line, a greeting, the body of the email, and a closing signature.
+The body of the email should include the order details in a table, with columns for product ID, product name, quantity, and status.
+At the end of the order details there should be the total cost for the order, calculated as the sum of the total price for each product, which is given by the cost of the single product multiplied by its quantity.
+If the quantity required was not fully available, specify this to the user, indicating the quantity that has been included in the order and the quantity that was not available.
+If the order data is empty do not include the order details table, but just a message apologizing for the inconvenience and asking for more information to identify the products.
+If the order data is empty, do not include the total cost in the email.
+If the order data is empty, do not include the order details table.
+If there is a range in the quantity written in the email content, consider it above the quantity present in the hypotetical orders provided.
+If the user has provided a quantity range, return the maximum value of the range as quantity if the availability in stock is enough to cover for it.
+If the user has provided a quantity range and the maximum value of the range is not available in stock, return the maximum value of the range that is available in stock and that is greater than or equal to the minimum in the range.
+If the user has provided a quantity range and the minimum value in the range is uqual to or greater than the available stock, use the minimum value in the range as quantity.
+If, and only if, there are some products out of stock, include a short sencente to apologize for the inconvenience and a section for alternative products with their details.
+If there are some products out of stock, select accurately the alternative products to suggest, ensuring they are exactly of the same kind as the required product and available in stock, otherwise do not propose any alternative product.
+If all the products required are available (no product required out of stock), do not include the sentence of apology nor the section for alternative products.
+If no alternative products are available and none of the products are out of stock, do not include apologies in the message.
+If the order data is empty or it is not possible to identify any product from the email, return an apologetic response where you explain that it was not possible to identify the specified products and that we need more information to knwo exactly the product they desire, encouraging them to visit our online store (no need to put a placeholder for this).
+Only for products present in the order data a order can be created.
+No product not present in the order data can be included in the ordered products specified in the email.
+If the order data is empty, do not include the order details table.
+If the order data is empty, do not include the total cost in the email.
+If no product is available in stock, do not include the total cost in the email.
+If only one product is ordered and the quantity is 1, do not specify that the total cost was calculated multiplying the quantity by the unit price, just provide the total cost.
+If the quantity in stock is not sufficient to fulfill the order, the quantity should be kept the same and not diminished to send a partial order and the order should be marked as out of stock.
+If the quantity in stock is enough (even equal to the quantity required), the order should be marked as created and processed accordingly.
+If no fitting alternative products are available, do not include the section for alternative products.
+If all products are available and in stock, avoid mentiontioning alternative products in the reply.
+Only output valid HTML and no other characters.
+Double check the HTML format and ensure it is valid.
+Do not output markdown backticks. Just output raw HTML only.
+</INSTRUCTIONS>
+
+<EMAIL>
+<SUBJECT>{email_subject}</SUBJECT>
+<MESSAGE>{email_message}</MESSAGE>
+</EMAIL>
+
+<ORDER DATA>
+{orders}
+</ORDER DATA>
+
+<RELEVANT PRODUCTS>
+{relevant_products}
+</RELEVANT PRODUCTS>
+"""
+    return [
+        {"role": "system", "content": "You are a professional seller assistant, generating professional answers to customers orders via email. You generate a response to the user based on the order data provided."},
+        {"role": "user", "content": prompt}
+    ]
+
+async def generate_order_response(llm, email_data, order_data, relevant_products, mode="llm"):
+    # mode: --order-response
+    if mode == "template":
+        return await generate_order_response_template(llm, email_data, order_data, relevant_products)
+    return await llm.complete(build_order_response_messages(email_data, order_data, relevant_products.render()), "order-response")
+
+# === Render the order response locally, the LLM only writing the prose ===
+def build_order_prose_messages(email_data, order_data):
+    lines = "\n".join(
+        f"- {order['quantity']} x {order.get('name') or order['product_id']}: "
+        + ("created" if order['status'] == 'created' else f"out of stock ({order['currently_in_stock']} available)")
+        for order in order_data
+    ) or "- no product could be identified in the email"
+
+    prompt = f"""<INSTRUCTIONS>
+Write the opening of the reply to the following order email: a greeting and two or three short sentences.
+If some products are out of stock, apologize briefly and say that similar products available in stock are suggested below, or that the customer may wait for restock.
+If no product could be identified, apologize, explain that we need more information to know exactly the products desired, and encourage the customer to visit our online store.
+Do not list the products, quantities or prices: the order details are added after your text.
+Do not write a closing or a signature.
+Only output plain text, with paragraphs separated by an empty line.
+</INSTRUCTIONS>
+
+<EMAIL>
+<SUBJECT>{email_data['subject']}</SUBJECT>
+<MESSAGE>{email_data['message']}</MESSAGE>
+</EMAIL>
+
+<ORDER LINES>
+{lines}
+</ORDER LINES>
+"""
+    return [
+        {"role": "system", "content": "You are a professional seller assistant writing the opening paragraphs of replies to customers orders. The tone is professional and friendly."},
+        {"role": "user", "content": prompt}
+    ]
+
+def order_prose_needed(order_data):
+    # Fully available orders get the fixed confirmation text, without any LLM call
+    return not order_data or any(order['status'] != 'created' for order in order_data)
+
+def format_price(value):
+    try:
+        return f"${float(value):,.2f}"
+    except (TypeError, ValueError):
+        return html.escape(str(value))
+
+def format_quantity(value):
+    try:
+        return f"{float(value):g}"
+    except (TypeError, ValueError):
+        return html.escape(str(value))
+
+def order_prose_or_default(order_data, prose):
+    # A refusal, an empty answer or prose cut mid-sentence is replaced by a neutral opening
+    if prose is None or not prose.strip():
+        metrics.count("order_prose_defaults")
+        return ORDER_STATUS_PROSE if order_data else ORDER_UNIDENTIFIED_PROSE
+    return prose
+
+def render_order_response(email_data, order_data, alternative_products, prose):
+    parts = [f"<p><strong>Subject:</strong> Re: {html.escape(str(email_data['subject']))}</p>"]
+    parts += [f"<p>{html.escape(paragraph.strip())}</p>" for paragraph in prose.split("\n\n") if paragraph.strip()]
+
+    if order_data:
+        rows = []
+        total = 0.0
+        for order in order_data:
+            if order['status'] == 'created':
+                line_total = float(order['price']) * order['quantity']
+                total += line_total
+                status = "Confirmed"
+                line_price = format_price(line_total)
+            else:
+                status = f"Out of stock ({format_quantity(order['currently_in_stock'])} available)"
+                line_price = "-"
+            rows.append(
+                f"<tr><td>{html.escape(str(order['product_id']))}</td><td>{html.escape(str(order.get('name') or ''))}</td>"
+                f"<td>{order['quantity']}</td><td>{format_price(order['price'])}</td><td>{line_price}</td><td>{status}</td></tr>"
+            )
+        parts.append(
+            "<table><tr><th>Product ID</th><th>Product</th><th>Quantity</th><th>Unit price</th><th>Total</th><th>Status</th></tr>"
+            + "".join(rows) + "</table>"
+        )
+        if any(order['status'] == 'created' for order in order_data):
+            parts.append(f"<p><strong>Order total:</strong> {format_price(total)}</p>")
+
+    out_of_stock = [order for order in order_data if order['status'] != 'created']
+    alternatives = alternative_products.ranked(ORDER_RESPONSE_ALTERNATIVES) if out_of_stock or not order_data else []
+    if alternatives:
+        parts.append("<p>You may be interested in these similar products, available in stock:</p><ul>" + "".join(
+            f"<li>{html.escape(str(metadata.get('name') or product_id))} ({html.escape(product_id)}): "
+            f"{format_price(metadata.get('price'))}, {format_quantity(metadata.get('stock'))} in stock</li>"
+            for product_id, document, metadata in alternatives
+        ) + "</ul>")
+
+    parts.append("<p>Best regards,</p><p>Customer Service Team</p>")
+    return "<html><body>" + "".join(parts) + "</body></html>"
+
+async def generate_order_response_template(llm, email_data, order_data, alternative_products):
+    prose = ORDER_CONFIRMED_PROSE
+    if order_prose_needed(order_data):
+        prose = order_prose_or_default(order_data, await llm.complete(
+            build_order_prose_messages(email_data, order_data), "order-prose",
+            complete_only=True, max_tokens=ORDER_PROSE_MAX_TOKENS
+        ))
+    return render_order_response(email_data, order_data, alternative_products, prose)
+
+# === Find relevant products for the suborders of an email ===
+def relevant_product_queries(suborders, email_subject, email_message):
+    if not suborders:
+        return [(f"{email_subject} - {email_message}", 10, None)]
+    return [(f"{suborder.get('product_data', {})}", 3, None) for suborder in suborders]
+
+def find_relevant_products(retriever, suborders, email_id, email_subject, email_message):
+    suborders_results = ""
+    # Products found by several suborders are listed once
+    relevant_products = ProductContext()
+
+    # All the queries of the email go to the vector database together
+    found = retriever.query_many(relevant_product_queries(suborders, email_subject, email_message))
+
+    # Process each suborder to find relevant products
+    for suborder, found_products in zip(suborders, found):
+        product_data = suborder.get('product_data', {})
+        quantity = suborder.get('quantity', 1)
+
+        if found_products['documents'][0]:
+            suborders_results += f"<PRODUCT ORDER><PRODUCT DESCRIPTION>{product_data}</PRODUCT DESCRIPTION><PRODUCT QUANTITY>{quantity}</PRODUCT QUANTITY></PRODUCT ORDER>"    
+            relevant_products.add_results(found_products)
+
+    # If no suborders were generated, try to find products based on email subject and message
+    if not suborders:
+        logging.warning(f"No suborder were identified for email ID {email_id}.")
+        logging.info("Trying to find products based on email subject and message...")
+        relevant_products.add_results(found[0])
+
+    lines = relevant_products.lines()
+    return suborders_results, "\n".join(lines.values()), set(lines)
+
+# === Check stock for each order line and decrement it for created lines ===
+def update_order_stock(dead_letters, email_id, order_data, products, sheet_products, sheet_order_status):
+    with metrics.stage("stock"):
+        order_status = apply_order_stock(email_id, order_data, products, sheet_products, sheet_order_status)
+    # A retry after a failure in the next steps must not apply the stock again
+    if dead_letters is not None:
+        dead_letters.stock_applied(email_id, order_status)
+    return order_status
+
+def apply_order_stock(email_id, order_data, products, sheet_products, sheet_order_status):
+    order_status = []
+
+    # Update order status and response
+    for order in order_data:
+        product_id = order.get('product_id')
+        quantity = int(order.get('quantity', 1))
+
+        product = products.get(product_id)
+        product_stock = products.available(product_id)
+
+        if products.reserve(product_id, quantity):
+            status = 'created'
+        else:
+            status = 'out of stock'
+
+        # Collect order status
+        order_status.append({
+            'product_id': product_id,
+            'quantity': quantity,
+            'status': status,
+            'name': product['name'] if product is not None else None,
+            'price': product['price'] if product is not None else 0,
+            'currently_in_stock': product_stock
+        })
+        # Insert order status
+        sheet_order_status.append_row([email_id, product_id, quantity, status])
+
+        if status == 'created' and product is not None:
+            products.commit(product_id, quantity)
+
+    # Update Google Sheet with new stock values
+    products.flush(sheet_products)
+
+    return order_status
+
+# === Order status of an order whose stock was applied by a run that failed afterwards ===
+def applied_order_status(dead_letters, email_id):
+    order_status = dead_letters.order_status(email_id) if dead_letters is not None else None
+    if order_status is not None:
+        logging.info(f"####Stock of the order of email ID {email_id} already applied, writing its response...")
+    return order_status
+
+def order_lines(order_status):
+    return [{'product_id': order['product_id'], 'quantity': order['quantity']} for order in order_status]
+
+# === Find alternative products for the out of stock order lines ===
+def find_alternative_products(retriever, products, order_data, order_status, email_subject, email_message):
+    alternative_products = ProductContext()
+
+    # Closest products of the same category with stock available, from the precomputed index
+    out_of_stock_ids = [str(order['product_id']) for order in order_status if order['status'] == 'out of stock']
+    excluded = set(out_of_stock_ids)
+    with metrics.stage("alternatives:lookup"):
+        for product_id in out_of_stock_ids:
+            alternatives = retriever.alternatives.alternatives(product_id, ALTERNATIVES_PER_PRODUCT, products, excluded)
+            for rank, (alternative_id, document, metadata, distance) in enumerate(alternatives):
+                alternative_products.add(alternative_id, document, metadata, distance, rank)
+
+    # If the order was impossible to identify, we try to find alternative products
+    if not alternative_products and not order_data:
+        alternative_products.add_results(retriever.query(f"{email_subject} - {email_message}", 5))
+
+    return alternative_products
+
+# === Generate the suborders of an order email ===
+async def generate_email_suborders(llm, row):
+    suborders = await generate_suborders(llm, f"Subject: {row['subject']}\nMessage: {row['message']}")
+    if not suborders:
+        logging.warning(f"No suborders generated for email ID {row['email_id']}.")
+
+    logging.info(f"######Suborders generated: {suborders}")
+    return suborders
+
+# === Process an order email ===
+async def process_order(pipeline, row, turn, suborders=None):
+    # suborders: the suborders of the email when the caller already generated them (sequential run)
+    email_message = row['message']
+    email_subject = row['subject']
+    email_id = row['email_id']
+    services = pipeline.services
+    llm = pipeline.llm
+
+    order_status = applied_order_status(services.dead_letters, email_id)
+    holding_turn = False
+    try:
+        logging.info(f"####Processing order for email ID {email_id}...")
+
+        if order_status is not None:
+            retriever, products = await pipeline.catalog_ready()
+            order_data = order_lines(order_status)
+        elif services.order_extraction == "single":
+            retriever, products = await pipeline.catalog_ready()
+            candidates = await asyncio.to_thread(find_order_candidates, retriever, products, email_subject, email_message)
+            order_data = await extract_order(llm, row, candidates)
+        else:
+            if suborders is None:
+                suborders = await generate_email_suborders(llm, row)
+            retriever, products = await pipeline.catalog_ready()
+            suborders_results, relevant_products, product_ids = await asyncio.to_thread(
+                find_relevant_products, retriever, suborders, email_id, email_subject, email_message
+            )
+
+            order_data = await process_order_request(llm, row, suborders_results, relevant_products, product_ids)
+
+        if order_status is None:
+            logging.info(f"######Order data generated for email ID {email_id}...")
+            logging.info(order_data)
+            logging.info("-------")
+
+        # Only the stock mutation runs one order at a time, in the sequential order. The alternatives
+        # are looked up in the same turn, so their stock is the one the sequential run would see.
+        await pipeline.turnstile.wait(turn)
+        holding_turn = True
+        if order_status is None:
+            order_status = await asyncio.to_thread(
+                update_order_stock, services.dead_letters, email_id, order_data, products,
+                pipeline.sheets["products"], pipeline.sheets["order-status"]
+            )
+        alternative_products = await asyncio.to_thread(
+            find_alternative_products, retriever, products, order_data, order_status, email_subject, email_message
+        )
+    finally:
+        # Failed orders still hand the turn over to the next one, skipping it if they failed before it came
+        if holding_turn:
+            await pipeline.turnstile.advance(turn)
+        else:
+            await pipeline.turnstile.skip(turn)
+
+    response = await generate_order_response(llm, row, order_status, alternative_products, services.order_response)
+    await asyncio.to_thread(pipeline.sheets["order-response"].append_row, [email_id, response])
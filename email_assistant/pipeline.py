@@ -0,0 +1,342 @@
+import asyncio
+import itertools
+import logging
+
+from .catalog import load_catalog
+from .classifier import classify_email
+from .inquiries import inquiry_product_query, process_inquiry
+from .llm import BatchPending, LLMClient
+from .metrics import metrics
+from .orders import (
+    applied_order_status, generate_email_suborders, order_candidate_queries, process_order, relevant_product_queries
+)
+from .scheduling import RateLimiter
+from .settings import COMMAND_STAGES, PIPELINE_STAGES
+from .sheets import init_worksheets, load_data, plain_value
+
+# === What the stages of a run work with ===
+class Pipeline:
+    """The services, LLM client and output sheets of a run, with its products catalog and stock turnstile.
+
+    The stages take the pipeline of their run instead of reading module
+    globals. The catalog loads in a task shared by the emails of the run
+    (load_catalog), which wait for it with catalog_ready().
+    """
+
+    def __init__(self, services, llm, sheets, turnstile, catalog=None):
+        self.services = services
+        self.llm = llm
+        self.sheets = sheets
+        self.turnstile = turnstile
+        self.catalog = catalog
+
+    def load_catalog(self, spreadsheet, args):
+        self.catalog = asyncio.create_task(asyncio.to_thread(load_catalog, spreadsheet, args, self.services))
+        return self.catalog
+
+    async def catalog_ready(self):
+        # (retriever, products); an email cancelled while waiting does not cancel the load for the others
+        return await asyncio.shield(self.catalog)
+
+def llm_client(openai_client, args, services):
+    # Chat completions within the rate limits of the options
+    return LLMClient(
+        openai_client, RateLimiter(args.concurrency, args.rpm, args.tpm), services.llm_cache, services.model_routes
+    )
+
+# === Serializes stock updates in the order of the sequential run ===
+class StockTurnstile:
+    """Lets order number N mutate the stock only after orders 0..N-1 did.
+
+    Emails that don't change the stock (inquiries, failed orders) skip their
+    turn without waiting for it: it is passed over once the turns before it
+    are done.
+    """
+
+    def __init__(self):
+        self.next_turn = 0
+        self.skipped = set()
+        self.condition = asyncio.Condition()
+
+    async def wait(self, turn):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.next_turn == turn)
+
+    async def advance(self, turn):
+        async with self.condition:
+            self.next_turn = turn + 1
+            while self.next_turn in self.skipped:
+                self.skipped.remove(self.next_turn)
+                self.next_turn += 1
+            self.condition.notify_all()
+
+    async def skip(self, turn):
+        if self.next_turn == turn:
+            await self.advance(turn)
+        else:
+            self.skipped.add(turn)
+
+# === Find emails of a category still waiting for a response ===
+def find_pending_emails(spreadsheet, df_email_merge, category, response_worksheet_name):
+    requests = df_email_merge[df_email_merge['category'] == category]
+
+    # Load response data to identify already processed emails
+    df_response = load_data(spreadsheet, response_worksheet_name)
+
+    requests = requests.merge(
+        df_response, left_on='email_id', right_on='email ID', how='left'
+    )
+
+    # Filter out emails that have already been processed
+    return requests[requests['response'].isnull()]
+
+# === Run the whole pipeline sequentially ===
+async def run_sequential(spreadsheet, llm, writer, args, services):
+    # One email at a time, through the same stages as the concurrent run
+    stages = COMMAND_STAGES[args.command]
+    sheets = init_worksheets(spreadsheet, writer)
+    pipeline = Pipeline(services, llm, sheets, StockTurnstile())
+
+    # Loading data
+    df_emails = load_data(spreadsheet, "emails")
+    df_email_classification = load_data(spreadsheet, "email-classification")
+
+    logging.info("Data loaded successfully.")
+
+    # Checking for existing classifications
+    classified_ids = set(df_email_classification['email ID'].astype(str))
+    # Emails that failed too many times are left in the dead-letter queue
+    given_up = services.given_up()
+    # Emails waiting for the answer of a batch request (batch mode) are picked up by the next pass
+    failures = deferred = 0
+
+    # Classifying emails
+    if "classify" in stages:
+        for idx, row in df_emails.iterrows():
+            email_id = row['email_id']
+            email_subject = row['subject']
+            email_message = row['message']
+            if email_id in classified_ids or str(email_id) in given_up:
+                continue # Skip already classified emails
+            try:
+                with metrics.email(email_id):
+                    email_category = await classify_email(llm, services.email_classifier, email_subject, email_message)
+            except BatchPending:
+                deferred += 1
+                continue
+            except Exception as e:
+                services.failed(email_id, None, e)
+                failures += 1
+                continue
+            metrics.set_category(email_id, email_category)
+            # Update email classification
+            sheets["email-classification"].append_row([email_id, email_category])
+
+    if "orders" not in stages and "inquiries" not in stages:
+        llm.log_stats()
+        log_run_end(failures, deferred)
+        return
+
+    # Loading products data in the vector database
+    pipeline.load_catalog(spreadsheet, args)
+    retriever, products = await pipeline.catalog_ready()
+
+    df_email_merge = df_email_classification.merge(
+        df_emails, left_on='email ID', right_on='email_id', how='inner'
+    )
+
+    # Processing order requests
+    if "orders" in stages:
+        pending_orders = find_pending_emails(spreadsheet, df_email_merge, 'order', "order-response")
+
+        # Processing unprocessed orders, a batch of emails at a time
+        order_rows = [row for idx, row in pending_orders.iterrows() if str(row['email_id']) not in given_up]
+        turns = itertools.count()
+        for start in range(0, len(order_rows), args.retrieval_batch):
+            batch = order_rows[start:start + args.retrieval_batch]
+            batch_suborders = []
+            for row in batch:
+                try:
+                    with metrics.email(row['email_id'], 'order'):
+                        # No suborders in single call extraction, nor for orders whose stock is already applied
+                        if services.order_extraction == "single" or applied_order_status(services.dead_letters, row['email_id']) is not None:
+                            batch_suborders.append(None)
+                        else:
+                            batch_suborders.append(await generate_email_suborders(llm, row))
+                except BatchPending:
+                    deferred += 1
+                    batch_suborders.append(False)
+                except Exception as e:
+                    services.failed(row['email_id'], 'order', e)
+                    failures += 1
+                    batch_suborders.append(False)
+            # One vector query for the products of the whole batch
+            await asyncio.to_thread(retriever.query_many, [
+                query
+                for row, suborders in zip(batch, batch_suborders)
+                if suborders is not False
+                for query in (
+                    order_candidate_queries(row['subject'], row['message']) if suborders is None
+                    else relevant_product_queries(suborders, row['subject'], row['message'])
+                )
+            ])
+            for row, suborders in zip(batch, batch_suborders):
+                if suborders is False:
+                    continue
+                try:
+                    with metrics.email(row['email_id'], 'order'):
+                        await process_order(pipeline, row, next(turns), suborders)
+                except BatchPending:
+                    deferred += 1
+                    continue
+                except Exception as e:
+                    services.failed(row['email_id'], 'order', e)
+                    failures += 1
+                    continue
+                services.processed(row['email_id'])
+
+    #Handling inquiries
+    if "inquiries" in stages:
+        pending_inquiries = find_pending_emails(spreadsheet, df_email_merge, 'inquiry', "inquiry-response")
+
+        inquiry_rows = [row for idx, row in pending_inquiries.iterrows() if str(row['email_id']) not in given_up]
+        for start in range(0, len(inquiry_rows), args.retrieval_batch):
+            batch = inquiry_rows[start:start + args.retrieval_batch]
+            await asyncio.to_thread(retriever.query_many, [inquiry_product_query(row) for row in batch])
+            for row in batch:
+                try:
+                    with metrics.email(row['email_id'], 'inquiry'):
+                        await process_inquiry(pipeline, row)
+                except BatchPending:
+                    deferred += 1
+                    continue
+                except Exception as e:
+                    services.failed(row['email_id'], 'inquiry', e)
+                    failures += 1
+                    continue
+                services.processed(row['email_id'])
+
+    retriever.log_stats()
+    llm.log_stats()
+    log_run_end(failures, deferred)
+
+def log_run_end(failures, deferred=0):
+    if deferred:
+        logging.info(f"{deferred} emails wait for batch answers.")
+    if failures:
+        logging.warning(f"{failures} emails failed and will be retried on the next run.")
+    elif not deferred:
+        logging.info("All emails processed successfully.")
+
+# === Classify a new email and process it right away ===
+async def classify_and_process(pipeline, row, turn, state=None, stages=PIPELINE_STAGES):
+    try:
+        email_category = await classify_email(
+            pipeline.llm, pipeline.services.email_classifier, row['subject'], row['message']
+        )
+        await asyncio.to_thread(pipeline.sheets["email-classification"].append_row, [row['email_id'], email_category])
+        metrics.set_category(row['email_id'], email_category)
+        if state is not None:
+            # A retry after a failure will not classify the email twice
+            state.classified(row['email_id'], email_category)
+    except BaseException:
+        await pipeline.turnstile.skip(turn)
+        raise
+
+    if email_category == 'order' and 'orders' in stages:
+        await process_order(pipeline, row, turn)
+        return
+
+    # Not an order to process: give up the stock turn straight away
+    await pipeline.turnstile.skip(turn)
+    if email_category == 'inquiry' and 'inquiries' in stages:
+        await process_inquiry(pipeline, row)
+
+async def tracked(email_id, category, coroutine):
+    # Runs in its own task, so the email context does not leak into the others
+    with metrics.email(email_id, category):
+        return await coroutine
+
+# === Processing of a queued email according to its category ===
+def email_coroutine(pipeline, email, turn, state):
+    # None when there is nothing to do for the category; only orders and new emails take a stock turn
+    if email['category'] is None:
+        return classify_and_process(pipeline, email, turn, state)
+    if email['category'] == 'order':
+        return process_order(pipeline, email, turn)
+    if email['category'] == 'inquiry':
+        return process_inquiry(pipeline, email)
+    return None
+
+# === Find the emails left to process ===
+def find_pending_work(spreadsheet, services):
+    df_emails = load_data(spreadsheet, "emails")
+    df_email_classification = load_data(spreadsheet, "email-classification")
+
+    logging.info("Data loaded successfully.")
+
+    df_email_merge = df_email_classification.merge(
+        df_emails, left_on='email ID', right_on='email_id', how='inner'
+    )
+    pending_orders = find_pending_emails(spreadsheet, df_email_merge, 'order', "order-response")
+    pending_inquiries = find_pending_emails(spreadsheet, df_email_merge, 'inquiry', "inquiry-response")
+
+    classified_ids = set(df_email_classification['email ID'].astype(str))
+    new_emails = df_emails[~df_emails['email_id'].isin(classified_ids)]
+
+    # Emails that failed too many times are left in the dead-letter queue
+    given_up = services.given_up()
+    pending_orders, new_emails, pending_inquiries = (
+        pending[~pending['email_id'].astype(str).isin(given_up)] for pending in (pending_orders, new_emails, pending_inquiries)
+    )
+    return pending_orders, new_emails, pending_inquiries
+
+def email_rows(df_emails):
+    return [
+        {"email_id": str(plain_value(row['email_id'])), "subject": plain_value(row['subject']), "message": plain_value(row['message'])}
+        for row in df_emails.to_dict("records")
+    ]
+
+# === Run the whole pipeline concurrently ===
+async def run_concurrent(spreadsheet, llm, writer, args, services):
+    stages = COMMAND_STAGES[args.command]
+    sheets = await asyncio.to_thread(init_worksheets, spreadsheet, writer)
+    # Stock turns follow the sequential run: pending orders first, then new emails
+    pipeline = Pipeline(services, llm, sheets, StockTurnstile())
+
+    # The catalog loads while the first emails are being classified; classifying alone doesn't need it
+    if "orders" in stages or "inquiries" in stages:
+        pipeline.load_catalog(spreadsheet, args)
+    pending_orders, new_emails, pending_inquiries = await asyncio.to_thread(find_pending_work, spreadsheet, services)
+
+    tasks = []
+    emails = []
+    turn = 0
+    if "orders" in stages:
+        for idx, row in pending_orders.iterrows():
+            tasks.append(tracked(row['email_id'], 'order', process_order(pipeline, row, turn)))
+            emails.append((row['email_id'], 'order'))
+            turn += 1
+    if "classify" in stages:
+        for idx, row in new_emails.iterrows():
+            tasks.append(tracked(row['email_id'], None, classify_and_process(pipeline, row, turn, stages=stages)))
+            emails.append((row['email_id'], None))
+            turn += 1
+    if "inquiries" in stages:
+        for idx, row in pending_inquiries.iterrows():
+            tasks.append(tracked(row['email_id'], 'inquiry', process_inquiry(pipeline, row)))
+            emails.append((row['email_id'], 'inquiry'))
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failures = 0
+    for (email_id, category), result in zip(emails, results):
+        if isinstance(result, BaseException):
+            failures += 1
+            services.failed(email_id, category, result)
+        else:
+            services.processed(email_id)
+    if pipeline.catalog is not None:
+        retriever, products = await pipeline.catalog
+        retriever.log_stats()
+    llm.log_stats()
+    log_run_end(failures)
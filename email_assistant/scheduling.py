@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from .metrics import metrics
+from .settings import CHROMA_CONCURRENCY, MAX_RETRIES, MAX_RETRY_DELAY, SHEETS_CONCURRENCY
+
+# === Retries and adaptive concurrency of the calls to OpenAI, Google Sheets and Chroma ===
+def network_errors():
+    # Network errors of the OpenAI, Google Sheets and Chroma clients worth a retry
+    import openai
+    import requests
+    return (
+        ConnectionError, TimeoutError, openai.APIConnectionError, openai.InternalServerError,
+        requests.exceptions.ConnectionError, requests.exceptions.Timeout
+    )
+
+def failure_kind(error):
+    # "throttled" (rate or quota limit: slow down), "transient" (retry as is) or None (not retried)
+    import openai
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    if isinstance(error, openai.RateLimitError) or status == 429:
+        return "throttled"
+    if isinstance(error, network_errors()):
+        return "transient"
+    if isinstance(status, int) and status >= 500:
+        return "transient"
+    return None
+
+def retry_after(error):
+    # Delay asked by the provider in the headers of the error response, in seconds
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass  # An HTTP date: the backoff applies
+    return None
+
+def retry_delay(attempt, error=None):
+    # Retry-After when the provider sent one, else exponential backoff with jitter: about 1, 2, 4... seconds
+    delay = retry_after(error) if error is not None else None
+    if delay is None:
+        delay = 2 ** attempt * (0.5 + random.random())
+    return min(delay, MAX_RETRY_DELAY)
+
+class AIMDLimit:
+    """Concurrency limit of a service tracking its real capacity.
+
+    Additive increase: the limit grows by one after a limit's worth of
+    successful calls. Multiplicative decrease: a throttled call halves it, at
+    most once per backoff delay since the calls in flight fail together, and a
+    Retry-After pauses every new call. Callers hold the lock guarding it.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.lowest = self.limit
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.decreased_until = 0.0
+
+    def wait_time(self):
+        # 0 when a call can start now, None when it waits for a call in flight to end
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        return 0 if self.in_flight < int(self.limit) else None
+
+    def succeeded(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def throttled(self, delay, paused):
+        now = time.monotonic()
+        if now >= self.decreased_until:
+            self.limit = max(self.min_limit, self.limit / 2)
+            self.lowest = min(self.lowest, self.limit)
+            self.decreased_until = now + delay
+        if paused:
+            self.paused_until = max(self.paused_until, now + delay)
+
+class ServiceScheduler:
+    """Runs the calls to a service within its AIMD concurrency limit, retrying
+    transient failures and rate limits with backoff (thread safe)."""
+
+    def __init__(self, service, max_concurrency, max_retries=MAX_RETRIES):
+        self.service = service
+        self.limit = AIMDLimit(max_concurrency)
+        self.max_retries = max_retries
+        self.condition = threading.Condition()
+        self.throttled = 0
+        self.retried = 0
+
+    def call(self, stage, function, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._acquire()
+            try:
+                with metrics.stage(stage):
+                    result = function(*args, **kwargs)
+            except Exception as e:
+                kind = failure_kind(e)
+                delay = retry_delay(attempt, e)
+                self._release(kind, delay, retry_after(e) is not None)
+                if kind is None or attempt == self.max_retries:
+                    raise
+                with self.condition:
+                    self.retried += 1
+                metrics.count(f"retries:{stage}")
+                logging.warning(f"Retrying {stage} in {delay:.1f} s after {type(e).__name__}.")
+                time.sleep(delay)
+                continue
+            self._release()
+            return result
+
+    def _acquire(self):
+        with self.condition:
+            wait = self.limit.wait_time()
+            while wait != 0:
+                self.condition.wait(wait)
+                wait = self.limit.wait_time()
+            self.limit.in_flight += 1
+
+    def _release(self, kind="success", delay=0.0, paused=False):
+        with self.condition:
+            self.limit.in_flight -= 1
+            if kind == "success":
+                self.limit.succeeded()
+            elif kind == "throttled":
+                self.throttled += 1
+                self.limit.throttled(delay, paused)
+            self.condition.notify_all()
+        if kind == "throttled":
+            metrics.count(f"throttled:{self.service}")
+
+    def log_stats(self):
+        if self.throttled or self.retried:
+            logging.info(
+                f"{self.service}: {self.retried} retries, {self.throttled} rate limited calls, "
+                f"concurrency limit {self.limit.limit:.1f} (lowest {self.limit.lowest:.1f}, max {self.limit.max_limit})."
+            )
+
+# Schedulers of the calls made from threads: the batch API calls, Google Sheets and Chroma.
+# The chat completions go through RateLimiter.
+openai_scheduler = ServiceScheduler("openai", 1)
+sheets_scheduler = ServiceScheduler("sheets", SHEETS_CONCURRENCY)
+chroma_scheduler = ServiceScheduler("chroma", CHROMA_CONCURRENCY)
+
+# === Rate limiter of the chat completions ===
+class RateLimiter:
+    """Caps concurrent requests and enforces requests/tokens per minute budgets.
+
+    The concurrency cap is an AIMD limit: halved when OpenAI rate limits a
+    request (and paused for its Retry-After), raised back by successes.
+    """
+
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute):
+        self.concurrency = AIMDLimit(max_concurrency)
+        self.condition = asyncio.Condition()
+        self.throttled = 0
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed * self.requests_per_minute / 60)
+        self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed * self.tokens_per_minute / 60)
+
+    async def _acquire_budget(self, tokens):
+        # A single request larger than the whole budget waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return tokens
+                missing_requests = max(0, 1 - self.available_requests) * 60 / self.requests_per_minute
+                missing_tokens = max(0, tokens - self.available_tokens) * 60 / self.tokens_per_minute
+                await asyncio.sleep(max(missing_requests, missing_tokens))
+
+    async def _acquire_slot(self):
+        async with self.condition:
+            wait = self.concurrency.wait_time()
+            while wait != 0:
+                try:
+                    await asyncio.wait_for(self.condition.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                wait = self.concurrency.wait_time()
+            self.concurrency.in_flight += 1
+
+    async def _release_slot(self, error=None, completed=True):
+        # Requests that did not complete (cancelled, never sent) leave the limit as it is
+        async with self.condition:
+            self.concurrency.in_flight -= 1
+            if not completed:
+                pass
+            elif error is None:
+                self.concurrency.succeeded()
+            elif failure_kind(error) == "throttled":
+                self.throttled += 1
+                metrics.count("throttled:openai")
+                self.concurrency.throttled(retry_delay(0, error), retry_after(error) is not None)
+            self.condition.notify_all()
+
+    def slot(self, estimated_tokens):
+        return RateLimiterSlot(self, estimated_tokens)
+
+    def log_stats(self):
+        if self.throttled:
+            logging.info(
+                f"openai: {self.throttled} rate limited calls, concurrency limit {self.concurrency.limit:.1f} "
+                f"(lowest {self.concurrency.lowest:.1f}, max {self.concurrency.max_limit})."
+            )
+
+
+class RateLimiterSlot:
+    """Holds a concurrency slot and reconciles estimated tokens with the real usage."""
+
+    def __init__(self, limiter, estimated_tokens):
+        self.limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self.used_tokens = None
+
+    async def __aenter__(self):
+        await self.limiter._acquire_slot()
+        try:
+            self.estimated_tokens = await self.limiter._acquire_budget(self.estimated_tokens)
+        except BaseException:
+            await self.limiter._release_slot(completed=False)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter._release_slot(exc, completed=exc is None or isinstance(exc, Exception))
+        if self.used_tokens is not None:
+            self.limiter.available_tokens -= self.used_tokens - self.estimated_tokens
+        return False
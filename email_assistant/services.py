@@ -0,0 +1,140 @@
+import logging
+import os
+
+from .classifier import LocalEmailClassifier
+from .inquiries import InquiryClusters
+from .llm import LLMCache
+from .scheduling import chroma_scheduler, openai_scheduler, sheets_scheduler
+from .settings import (
+    BATCH_DIR, CHROMA_PATH, DEAD_LETTER_PATH, EMAIL_CLASSIFIER_PATH, GOOGLE_SCOPES, INGESTION_STATE_PATH,
+    INQUIRY_CLUSTERS_PATH, MODEL_ROUTES, WORK_QUEUE_PATH
+)
+from .sheets import authenticate_gspread
+from .stores import DeadLetterQueue
+
+# === Stores and options shared by the runs of the process ===
+class Services:
+    """The caches, stores and pipeline options of the process, built from the options by configure().
+
+    The stages get them from their Pipeline. Each of them is None when its
+    option turns it off: no LLM cache, local classifier, dead-letter queue or
+    inquiry clusters.
+    """
+
+    def __init__(self, llm_cache=None, model_routes=MODEL_ROUTES, email_classifier=None, embedding_function=None,
+                 dead_letters=None, inquiry_clusters=None, order_extraction="two-step", order_response="llm"):
+        self.llm_cache = llm_cache
+        self.model_routes = model_routes
+        self.email_classifier = email_classifier
+        # None: the Chroma default model
+        self.embedding_function = embedding_function
+        self.dead_letters = dead_letters
+        self.inquiry_clusters = inquiry_clusters
+        self.order_extraction = order_extraction
+        self.order_response = order_response
+        # Kept across catalog reloads, which only update the categories that changed
+        self.alternatives_index = None
+
+    def failed(self, email_id, category, error):
+        logging.error(f"Processing of email ID {email_id} failed", exc_info=error)
+        if self.dead_letters is not None:
+            self.dead_letters.record(email_id, category, error)
+
+    def processed(self, email_id):
+        if self.dead_letters is not None:
+            self.dead_letters.resolve(email_id)
+
+    def given_up(self):
+        # Emails that failed too many times, left in the dead-letter queue
+        return self.dead_letters.given_up() if self.dead_letters is not None else set()
+
+    def close(self):
+        if self.llm_cache is not None:
+            self.llm_cache.log_stats()
+            self.llm_cache.close()
+        if self.email_classifier is not None:
+            self.email_classifier.log_stats()
+        for scheduler in (openai_scheduler, sheets_scheduler, chroma_scheduler):
+            scheduler.log_stats()
+        if self.dead_letters is not None:
+            self.dead_letters.log_stats()
+            self.dead_letters.close()
+        if self.inquiry_clusters is not None:
+            self.inquiry_clusters.log_stats()
+            self.inquiry_clusters.close()
+
+# === Connect to Google Sheets and OpenAI, or their offline stand-ins ===
+def connect(args):
+    if args.offline:
+        import offline
+        # Local stand-ins for Google Sheets and OpenAI
+        spreadsheet = offline.CsvSpreadsheet(args.offline)
+        openai_client = offline.FakeAsyncOpenAI(
+            latency=args.fake_llm_latency, max_in_flight=args.fake_llm_max_in_flight, retry_after=0.5
+        )
+        if args.chroma_path == CHROMA_PATH:
+            args.chroma_path = os.path.join(args.offline, "chroma")
+        if args.state_path == INGESTION_STATE_PATH:
+            args.state_path = os.path.join(args.offline, "ingestion.sqlite")
+        if args.queue_path == WORK_QUEUE_PATH:
+            args.queue_path = os.path.join(args.offline, "work_queue.sqlite")
+        if args.batch_dir == BATCH_DIR:
+            args.batch_dir = os.path.join(args.offline, "batches")
+        if args.dead_letter_path == DEAD_LETTER_PATH:
+            args.dead_letter_path = os.path.join(args.offline, "dead_letters.sqlite")
+        if args.classifier_path == EMAIL_CLASSIFIER_PATH:
+            args.classifier_path = os.path.join(args.offline, "email_classifier.npz")
+        if args.inquiry_clusters_path == INQUIRY_CLUSTERS_PATH:
+            args.inquiry_clusters_path = os.path.join(args.offline, "inquiry_clusters.sqlite")
+    else:
+        # Authentication and setup
+        client = authenticate_gspread(args.access_key_path, GOOGLE_SCOPES)
+        spreadsheet = client.open_by_url(args.spreadsheet_url)
+        openai_client = None
+        if args.command != "sync-catalog":
+            from openai import AsyncOpenAI
+            # Transient errors are retried by LLMClient, which counts them
+            openai_client = AsyncOpenAI(api_key=args.openai_api_key, max_retries=0)
+    return spreadsheet, openai_client
+
+def embedding_function_of(args):
+    # Hashed embeddings offline, the Chroma default model (None) otherwise
+    if args.offline:
+        import offline
+        return offline.HashingEmbeddingFunction()
+    return None
+
+# === Set up the pipeline options, the local classifier and the LLM cache ===
+def configure(args):
+    services = Services(
+        model_routes=args.models,
+        embedding_function=embedding_function_of(args),
+        order_extraction=args.extraction,
+        order_response=args.order_response
+    )
+
+    services.dead_letters = DeadLetterQueue(args.dead_letter_path, max_attempts=args.max_attempts)
+    if args.retry_dead_letters:
+        services.dead_letters.retry_all()
+
+    if args.use_inquiry_dedup:
+        services.inquiry_clusters = InquiryClusters(
+            args.inquiry_clusters_path, threshold=args.inquiry_dedup_threshold, batch=args.batch
+        )
+
+    if args.use_local_classifier and os.path.exists(args.classifier_path):
+        try:
+            services.email_classifier = LocalEmailClassifier.load(
+                args.classifier_path, services.embedding_function,
+                audit_rate=args.classifier_audit_rate, threshold=args.classifier_threshold
+            )
+        except ValueError as e:
+            logging.warning(f"{e} Every email is classified by the LLM meanwhile.")
+
+    if args.use_cache:
+        services.llm_cache = LLMCache(
+            max_entries=args.cache_max_entries,
+            ttl=args.cache_ttl * 24 * 3600,
+            stages=[stage.strip() for stage in args.cache_stages.split(",") if stage.strip()]
+        )
+    return services
@@ -0,0 +1,191 @@
+# Settings of the pipeline: models, limits, file paths and the defaults of the command line options
+
+OPENAI_MODEL = "gpt-4"
+
+# Fast, cheap model answering the stages that don't need the large one
+SMALL_MODEL = "gpt-4o-mini"
+
+# Dollars per 1K prompt and completion tokens
+MODEL_PRICES = {"gpt-4": (0.03, 0.06), "gpt-4o": (0.0025, 0.01), "gpt-4o-mini": (0.00015, 0.0006)}
+
+# Model of each LLM stage, and the model it escalates to when the answer is invalid
+# or not confident enough (None: no escalation). --models overrides them.
+MODEL_ROUTES = {
+    "classification": (SMALL_MODEL, OPENAI_MODEL),
+    "suborders": (SMALL_MODEL, OPENAI_MODEL),
+    "order-request": (SMALL_MODEL, OPENAI_MODEL),
+    "order-extraction": (SMALL_MODEL, OPENAI_MODEL),
+    "order-response": (OPENAI_MODEL, None),
+    "order-prose": (SMALL_MODEL, None),
+    "inquiry-response": (OPENAI_MODEL, None),
+}
+
+# Probability of its answer below which a classification is escalated
+CLASSIFICATION_MIN_CONFIDENCE = 0.8
+
+# Categories of the emails
+EMAIL_CATEGORIES = ("order", "inquiry")
+
+# Retries of a call to OpenAI, Google Sheets or Chroma failing with a transient error or a rate limit
+MAX_RETRIES = 6
+
+# Longest wait before a retry, in seconds
+MAX_RETRY_DELAY = 60
+
+# Concurrent calls to Google Sheets and Chroma, lowered on rate limits and raised back on success (AIMD)
+SHEETS_CONCURRENCY = 4
+CHROMA_CONCURRENCY = 8
+
+# Emails that failed, with their error, and the order status of failed orders whose stock was applied
+DEAD_LETTER_PATH = "dead_letters.sqlite"
+
+# Failed attempts after which an email is left in the dead-letter queue (--max-attempts)
+MAX_EMAIL_ATTEMPTS = 3
+
+# Stages of the pipeline calling the LLM
+LLM_STAGES = ("classification", "suborders", "order-request", "order-extraction", "order-response", "order-prose", "inquiry-response")
+
+# How the products and quantities of an order email are identified (--extraction):
+# "two-step" generates suborders then maps them to product ids, "single" does both in one call
+ORDER_EXTRACTION_MODES = ("two-step", "single")
+
+# How order responses are written (--order-response): "llm" has the model write the whole
+# HTML email, "template" renders the order details locally and the model only the prose
+ORDER_RESPONSE_MODES = ("llm", "template")
+
+# Completion tokens of the prose of a templated order response
+ORDER_PROSE_MAX_TOKENS = 200
+
+# Alternative products listed in a templated order response
+ORDER_RESPONSE_ALTERNATIVES = 3
+
+# Opening of the templated response of orders whose products are all in stock
+ORDER_CONFIRMED_PROSE = """Dear customer,
+
+Thank you for your order! We are happy to confirm that all the products you requested are available and your order has been created. You will find its details below."""
+
+# Openings used when the prose written by the model is empty or cut at ORDER_PROSE_MAX_TOKENS
+ORDER_STATUS_PROSE = """Dear customer,
+
+Thank you for your order. You will find below the products of your order and their availability, and similar products available in stock for those we could not provide."""
+ORDER_UNIDENTIFIED_PROSE = """Dear customer,
+
+Thank you for your email. Unfortunately we could not identify the products you would like to order: please reply with their names or product IDs, or visit our online store."""
+
+# Repairs asked to the model when its JSON answer is invalid
+JSON_REPAIR_RETRIES = 1
+
+# Sentences of an order email searched on their own for candidate products
+ORDER_CANDIDATE_SENTENCES = 8
+
+# Tokens of product data included in a single prompt
+PRODUCT_CONTEXT_TOKENS = 1500
+
+# Closest products of the same category precomputed for each product
+ALTERNATIVES_NEIGHBOURS = 20
+
+# Alternatives looked up for each out-of-stock order line
+ALTERNATIVES_PER_PRODUCT = 5
+
+# Products whose similarities are computed together when building the alternatives index
+ALTERNATIVES_BLOCK_SIZE = 1024
+
+# Completion tokens reserved for each request until the real usage is known
+COMPLETION_TOKENS_ESTIMATE = 500
+
+# Rows of newly created worksheets, so bulk appends don't need to resize them
+NEW_WORKSHEET_ROWS = 1000
+
+# Products sent to ChromaDB in a single upsert/update/delete call
+CHROMA_BATCH_SIZE = 1000
+
+# Local journal of sheet writes that were not flushed to Google Sheets yet
+SHEET_JOURNAL_PATH = "sheet_writes.journal"
+
+# Directory of the persistent vector database
+CHROMA_PATH = "./chroma"
+
+# Local cache of LLM responses
+LLM_CACHE_PATH = "llm_cache.sqlite"
+
+# Centroids and threshold of the local email classifier
+EMAIL_CLASSIFIER_PATH = "email_classifier.npz"
+
+# Watermark and processed emails of the watch mode
+INGESTION_STATE_PATH = "ingestion.sqlite"
+
+# Vector database backends of the products collection
+VECTOR_BACKENDS = ("chroma", "numpy")
+
+# Work queue and stock shared by the worker processes
+WORK_QUEUE_PATH = "work_queue.sqlite"
+
+# Seconds between checks of the work queue by the workers
+QUEUE_POLL_INTERVAL = 0.02
+
+# Modules imported once by the server process the workers are forked from
+WORKER_PRELOAD_MODULES = ["pandas", "gspread", "gspread_dataframe", "google.oauth2.service_account", "openai", "chromadb"]
+
+# Directory of the batch request files and of the state of the batch mode
+BATCH_DIR = "batches"
+
+# Requests per batch file (the provider accepts up to 50,000)
+BATCH_MAX_REQUESTS = 50000
+
+# Turnaround the batch jobs are submitted with
+BATCH_COMPLETION_WINDOW = "24h"
+
+# Commands of the command line: the whole pipeline, syncing the catalog, or a single stage
+COMMANDS = ("run-all", "classify", "sync-catalog", "process-orders", "process-inquiries")
+
+# Stages of the pipeline run by each command
+PIPELINE_STAGES = ("classify", "orders", "inquiries")
+COMMAND_STAGES = {
+    "run-all": PIPELINE_STAGES,
+    "classify": ("classify",),
+    "process-orders": ("orders",),
+    "process-inquiries": ("inquiries",),
+}
+
+# JSON file of settings, keyed by option name, used as the defaults of the options (--config)
+CONFIG_PATH = "config.json"
+
+# Environment variables of the settings, taking precedence over the settings file
+CONFIG_ENV = {
+    "spreadsheet_url": "EMAIL_ASSISTANT_SPREADSHEET_URL",
+    "access_key_path": "EMAIL_ASSISTANT_ACCESS_KEY",
+    "openai_api_key": "OPENAI_API_KEY",
+}
+
+# Google Sheets of the store, and the service account key opening it
+SPREADSHEET_URL = "https://docs.google.com/spreadsheets/d/1jDlayp5eUY2kWNouKAkFvqgygQ55XZ6CKydQTCHkfqI"
+ACCESS_KEY_PATH = "access_key.json"
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
+
+# Answers of the clusters of near-duplicate inquiries, reused by the next runs
+INQUIRY_CLUSTERS_PATH = "inquiry_clusters.sqlite"
+
+# Jaccard similarity of their words above which two inquiries are near-duplicates
+INQUIRY_DEDUP_THRESHOLD = 0.8
+
+# MinHash signature of an inquiry, split into bands looked up to find the candidate clusters
+INQUIRY_MINHASH_PERMUTATIONS = 64
+INQUIRY_MINHASH_BANDS = 16
+
+# Seconds the inquiry answering a cluster holds its claim, and between the checks of
+# the inquiries waiting for the answer of another process
+INQUIRY_CLAIM_LEASE = 120
+INQUIRY_CLAIM_POLL_INTERVAL = 0.1
+
+# Seconds an inquiry waiting for a batch answer holds the claim of its cluster: the completion window of the jobs
+INQUIRY_BATCH_CLAIM_LEASE = 24 * 3600
+
+# Format of the answers shared by the inquiries of a cluster; stored answers of another format are generated again
+INQUIRY_ANSWER_FORMAT = "recipient-neutral"
+
+# Words left out of the inquiry fingerprints: greetings, politeness and grammar words
+INQUIRY_STOPWORDS = frozenset("""
+a an the and or but of to for in on at by with from about is are was were be been am it its this that these those
+i me my we our us you your he she they them hi hello hey dear there thanks thank regards best kind please would
+could can do does did will have has had
+""".split())
@@ -0,0 +1,257 @@
+import collections
+import json
+import logging
+import os
+import threading
+
+from .scheduling import sheets_scheduler
+from .settings import NEW_WORKSHEET_ROWS, SHEET_JOURNAL_PATH
+
+# === Authentication ===
+def authenticate_gspread(json_path, scopes):
+  import gspread
+  from google.oauth2.service_account import Credentials
+  creds = Credentials.from_service_account_file(json_path, scopes=scopes)
+  return gspread.authorize(creds)
+
+# === Create and initialize worksheet ===
+def create_and_init_worksheet(spreedsheet, title, fields):
+  import gspread
+  try:
+    return sheets_scheduler.call("sheets:open", spreedsheet.worksheet, title)
+  except gspread.exceptions.WorksheetNotFound:
+    worksheet = sheets_scheduler.call("sheets:create", spreedsheet.add_worksheet, title=title, rows=NEW_WORKSHEET_ROWS, cols=len(fields))
+    sheets_scheduler.call("sheets:update", worksheet.update, [fields], 'A1')
+    return worksheet
+
+# === Loading data from Google Sheet ===
+def load_data(spreadsheet, worksheet_name):
+  from gspread_dataframe import get_as_dataframe
+  df = sheets_scheduler.call(
+    "sheets:load", lambda: get_as_dataframe(spreadsheet.worksheet(worksheet_name))
+  ).dropna(how="all")
+  # Columns of an empty sheet would be float and break the merges on the email IDs
+  return df.astype(object) if df.empty else df
+
+# === Buffered Google Sheets writer ===
+def plain_value(value):
+    # numpy/pandas scalars are not JSON serializable
+    return value.item() if hasattr(value, "item") else value
+
+def sheet_text(value):
+    # Value as read back from a worksheet
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class SheetWriter:
+    """Write-behind sink batching appended rows and cell updates per worksheet.
+
+    Writes are flushed with append_rows/batch_update when max_rows writes are
+    buffered, every flush_interval seconds and on close(). Every buffered write
+    is journaled to a local file first: writes left over by a crashed run are
+    replayed when the next SheetWriter is created. Rows are marked in flight in
+    the journal before they are sent, and rows in flight when a run crashed are
+    only sent again if the worksheet doesn't have them.
+    """
+
+    def __init__(self, spreadsheet, max_rows=500, flush_interval=5.0, journal_path=SHEET_JOURNAL_PATH):
+        self.spreadsheet = spreadsheet
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self.worksheets = {}
+        self.rows = {}
+        self.inflight = {}
+        self.cells = {}
+        self.lock = threading.RLock()
+
+        self.journal = None
+        self._recover()
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.flusher.start()
+
+    def _recover(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, encoding="utf-8") as journal:
+            entries = [json.loads(line) for line in journal if line.strip()]
+        if not entries:
+            return
+        logging.warning(f"Replaying {len(entries)} sheet writes left over by a previous run.")
+        for entry in entries:
+            if entry["sheet"] not in self.worksheets:
+                self.worksheets[entry["sheet"]] = sheets_scheduler.call("sheets:open", self.spreadsheet.worksheet, entry["sheet"])
+            if "cell" in entry:
+                self.cells.setdefault(entry["sheet"], {})[tuple(entry["cell"])] = entry["value"]
+            elif entry.get("inflight"):
+                self.inflight.setdefault(entry["sheet"], []).append(entry["row"])
+            else:
+                self.rows.setdefault(entry["sheet"], []).append(entry["row"])
+        self.flush()
+
+    def _write_journal(self, entry):
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+
+    def _rewrite_journal(self):
+        # Keep only the writes that are still buffered
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as journal:
+            for title, rows in self.inflight.items():
+                for row in rows:
+                    journal.write(json.dumps({"sheet": title, "row": row, "inflight": True}) + "\n")
+            for title, rows in self.rows.items():
+                for row in rows:
+                    journal.write(json.dumps({"sheet": title, "row": row}) + "\n")
+            for title, cells in self.cells.items():
+                for cell, value in cells.items():
+                    journal.write(json.dumps({"sheet": title, "cell": list(cell), "value": value}) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        if self.journal is not None:
+            self.journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self.journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _settle_inflight(self, title, worksheet):
+        # An append that failed or was cut by a crash may have reached the sheet:
+        # its rows go back to the buffer unless the worksheet has them already
+        rows = self.inflight.pop(title)
+        width = max(len(row) for row in rows)
+        present = collections.Counter(
+            tuple(([sheet_text(value) for value in values] + [""] * width)[:width])
+            for values in sheets_scheduler.call("sheets:load", worksheet.get_all_values)
+        )
+        missing = []
+        for row in rows:
+            key = tuple(([sheet_text(value) for value in row] + [""] * width)[:width])
+            if present[key]:
+                present[key] -= 1
+            else:
+                missing.append(row)
+        if len(missing) < len(rows):
+            logging.warning(f"{len(rows) - len(missing)} rows of an interrupted append are already in {title}, not sent again.")
+        self.rows[title] = missing + self.rows.get(title, [])
+        self._rewrite_journal()
+
+    def pending(self):
+        with self.lock:
+            return (
+                sum(len(rows) for rows in self.rows.values()) + sum(len(rows) for rows in self.inflight.values())
+                + sum(len(cells) for cells in self.cells.values())
+            )
+
+    def append_row(self, worksheet, values):
+        values = [plain_value(value) for value in values]
+        with self.lock:
+            self._write_journal({"sheet": worksheet.title, "row": values})
+            self.worksheets[worksheet.title] = worksheet
+            self.rows.setdefault(worksheet.title, []).append(values)
+            if self.pending() >= self.max_rows:
+                self.flush()
+
+    def update_cell(self, worksheet, row, col, value):
+        value = plain_value(value)
+        with self.lock:
+            self._write_journal({"sheet": worksheet.title, "cell": [row, col], "value": value})
+            self.worksheets[worksheet.title] = worksheet
+            # Only the last value written to a cell matters
+            self.cells.setdefault(worksheet.title, {})[(row, col)] = value
+            if self.pending() >= self.max_rows:
+                self.flush()
+
+    def flush(self):
+        import gspread
+        with self.lock:
+            for title, worksheet in self.worksheets.items():
+                if self.inflight.get(title):
+                    self._settle_inflight(title, worksheet)
+                rows = self.rows.get(title)
+                if rows:
+                    self.inflight[title] = rows
+                    self.rows[title] = []
+                    self._rewrite_journal()
+                    sheets_scheduler.call("sheets:append", worksheet.append_rows, rows)
+                    del self.inflight[title]
+                    self._rewrite_journal()
+                cells = self.cells.get(title)
+                if cells:
+                    sheets_scheduler.call("sheets:update", worksheet.batch_update, [
+                        {"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}
+                        for (row, col), value in cells.items()
+                    ], value_input_option="USER_ENTERED")
+                    self.cells[title] = {}
+                    self._rewrite_journal()
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Periodic flush of the sheet writes failed, will retry.")
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+        self.journal.close()
+        os.remove(self.journal_path)
+
+    def wrap(self, worksheet):
+        return BufferedWorksheet(self, worksheet)
+
+def close_writer(writer, failed):
+    # Writes the final flush could not send stay in the journal for the next run. While
+    # the run is failing with another error, that error is the one propagated.
+    try:
+        writer.close()
+    except Exception:
+        if not failed:
+            raise
+        logging.exception("Final flush of the sheet writes failed, they are kept in the journal.")
+
+
+class BufferedWorksheet:
+    """Worksheet proxy sending append_row/update_cell through a SheetWriter."""
+
+    def __init__(self, writer, worksheet):
+        self.writer = writer
+        self.worksheet = worksheet
+
+    def append_row(self, values):
+        self.writer.append_row(self.worksheet, values)
+
+    def update_cell(self, row, col, value):
+        self.writer.update_cell(self.worksheet, row, col, value)
+
+    def __getattr__(self, name):
+        return getattr(self.worksheet, name)
+
+# === Initialize output worksheets ===
+def init_worksheets(spreadsheet, writer):
+    products = sheets_scheduler.call("sheets:open", spreadsheet.worksheet, "products")
+    worksheets = {
+        "products": products,
+        "email-classification": create_and_init_worksheet(spreadsheet, "email-classification", ['email ID', 'category']),
+        "order-status": create_and_init_worksheet(spreadsheet, "order-status", ['email ID', 'product ID', 'quantity', 'status']),
+        "order-response": create_and_init_worksheet(spreadsheet, "order-response", ['email ID', 'response']),
+        "inquiry-response": create_and_init_worksheet(spreadsheet, "inquiry-response", ['email ID', 'response']),
+    }
+    # All the writes go through the buffered writer
+    return {title: writer.wrap(worksheet) for title, worksheet in worksheets.items()}
+
+# === Read the cells of a worksheet ===
+def read_rows(spreadsheet, worksheet_name, cells=None):
+    range_name = "'{}'".format(worksheet_name.replace("'", "''"))
+    if cells:
+        range_name += f"!{cells}"
+    return sheets_scheduler.call("sheets:read", spreadsheet.values_get, range_name).get("values", [])
@@ -0,0 +1,277 @@
+import contextlib
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from .metrics import metrics
+from .settings import DEAD_LETTER_PATH, MAX_EMAIL_ATTEMPTS, WORK_QUEUE_PATH
+from .sheets import plain_value
+
+# === Hash of stored content, keys of the caches and stores ===
+def content_hash(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+# === In-memory product store ===
+class ProductStore:
+    """Products indexed by product_id, with a stock ledger flushed to the products sheet in bulk.
+
+    Stock is reserved, then committed (decremented) or released. Committed
+    decrements are kept in the ledger until flush() writes the new stock of
+    every touched product to the products sheet.
+    """
+
+    def __init__(self, df_products=None):
+        self.products = {}
+        self.reserved = {}
+        self.decremented = {}
+        self.stock_col = None
+        self.lock = threading.RLock()
+        if df_products is not None:
+            self.load(df_products)
+
+    def load(self, df_products):
+        stock_col = df_products.columns.get_loc('stock') + 1
+        products = {}
+        for idx, row in zip(df_products.index, df_products.to_dict("records")):
+            product = {field: plain_value(value) for field, value in row.items()}
+            product['sheet_row'] = idx + 2  # row 1 is the header
+            products[str(product['product_id'])] = product
+
+        with self.lock:
+            # Decrements not flushed yet are missing from a reloaded sheet
+            for product_id, quantity in self.decremented.items():
+                if product_id in products:
+                    products[product_id]['stock'] -= quantity
+            self.products = products
+            self.stock_col = stock_col
+
+    def __len__(self):
+        return len(self.products)
+
+    def __contains__(self, product_id):
+        return str(product_id) in self.products
+
+    def get(self, product_id):
+        return self.products.get(str(product_id))
+
+    def available(self, product_id):
+        with self.lock:
+            product = self.get(product_id)
+            if product is None:
+                return 0
+            return int(product['stock']) - self.reserved.get(str(product_id), 0)
+
+    def reserve(self, product_id, quantity):
+        with self.lock:
+            if self.available(product_id) < quantity:
+                return False
+            if product_id in self:
+                self.reserved[str(product_id)] = self.reserved.get(str(product_id), 0) + quantity
+            return True
+
+    def release(self, product_id, quantity):
+        with self.lock:
+            self.reserved[str(product_id)] -= quantity
+
+    def commit(self, product_id, quantity):
+        with self.lock:
+            product_id = str(product_id)
+            self.reserved[product_id] -= quantity
+            self.products[product_id]['stock'] -= quantity
+            self.decremented[product_id] = self.decremented.get(product_id, 0) + quantity
+
+    def flush(self, sheet_products):
+        with self.lock:
+            for product_id in self.decremented:
+                product = self.products.get(product_id)
+                if product is not None:
+                    # Stock read by pandas is float when a column has gaps: the sheet keeps integers
+                    sheet_products.update_cell(product['sheet_row'], self.stock_col, int(product['stock']))
+            self.decremented = {}
+
+# === Shared SQLite database of the worker processes ===
+def connect_shared_db(path):
+    # Autocommit, transactions are opened explicitly; WAL lets readers run during writes
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+@contextlib.contextmanager
+def immediate_transaction(connection):
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+class SQLiteProductStore(ProductStore):
+    """ProductStore whose stock lives in a SQLite database shared by worker processes.
+
+    Every stock change is a compare-and-swap on the version of the product
+    row, retried on conflict. The coordinator imports the stock of the products
+    sheet (import_stock) and writes the changed stock back to it (sync); the
+    workers leave the sheet alone, so flush() does nothing.
+    """
+
+    def __init__(self, df_products=None, path=WORK_QUEUE_PATH):
+        self.db_lock = threading.Lock()
+        self.connection = connect_shared_db(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS inventory (
+            product_id TEXT PRIMARY KEY,
+            stock INTEGER,
+            reserved INTEGER DEFAULT 0,
+            version INTEGER DEFAULT 0,
+            synced_stock INTEGER
+        )""")
+        super().__init__(df_products)
+
+    def import_stock(self):
+        # Products whose stock changed since the last sync keep it, the sheet is not up to date yet.
+        # No worker runs yet, so reservations left by crashed workers are dropped.
+        with self.db_lock, immediate_transaction(self.connection):
+            self.connection.execute("UPDATE inventory SET reserved = 0")
+            self.connection.executemany(
+                """INSERT INTO inventory (product_id, stock, synced_stock) VALUES (?, ?, ?)
+                ON CONFLICT (product_id) DO UPDATE SET stock = excluded.stock, synced_stock = excluded.stock, version = version + 1
+                WHERE stock = synced_stock""",
+                [(product_id, int(product['stock']), int(product['stock'])) for product_id, product in self.products.items()]
+            )
+
+    def available(self, product_id):
+        with self.db_lock:
+            row = self.connection.execute(
+                "SELECT stock - reserved FROM inventory WHERE product_id = ?", (str(product_id),)
+            ).fetchone()
+        return 0 if row is None else row[0]
+
+    def _change(self, product_id, stock_change, reserved_change, allowed=lambda stock, reserved: True):
+        # The row is only written if no other worker changed it since it was read
+        product_id = str(product_id)
+        with self.db_lock:
+            while True:
+                row = self.connection.execute(
+                    "SELECT stock, reserved, version FROM inventory WHERE product_id = ?", (product_id,)
+                ).fetchone()
+                if row is None or not allowed(row[0], row[1]):
+                    return False
+                stock, reserved, version = row
+                updated = self.connection.execute(
+                    "UPDATE inventory SET stock = ?, reserved = ?, version = ? WHERE product_id = ? AND version = ?",
+                    (stock + stock_change, reserved + reserved_change, version + 1, product_id, version)
+                ).rowcount
+                if updated:
+                    return True
+                metrics.count("inventory_conflicts")
+
+    def reserve(self, product_id, quantity):
+        return self._change(product_id, 0, quantity, lambda stock, reserved: stock - reserved >= quantity)
+
+    def release(self, product_id, quantity):
+        self._change(product_id, 0, -quantity)
+
+    def commit(self, product_id, quantity):
+        self._change(product_id, -quantity, -quantity)
+
+    def flush(self, sheet_products):
+        # The stock reaches the sheet through the coordinator, see sync()
+        pass
+
+    def sync(self, sheet_products):
+        with self.db_lock:
+            changed = self.connection.execute(
+                "SELECT product_id, stock FROM inventory WHERE stock != synced_stock"
+            ).fetchall()
+            for product_id, stock in changed:
+                product = self.products.get(product_id)
+                if product is not None:
+                    sheet_products.update_cell(product['sheet_row'], self.stock_col, stock)
+                self.connection.execute("UPDATE inventory SET synced_stock = ? WHERE product_id = ?", (stock, product_id))
+        return len(changed)
+
+    def close(self):
+        self.connection.close()
+
+# === Dead-letter queue of the emails whose processing failed ===
+class DeadLetterQueue:
+    """SQLite store of the failed emails, with their last error and failed attempts.
+
+    Failed emails are retried by the next runs until they failed max_attempts
+    times, then left aside until retry_all() (--retry-dead-letters). The order
+    status of an order is kept once its stock is applied (stock_applied), so
+    that a retry after a failure in a later step only writes the response.
+    """
+
+    def __init__(self, path=DEAD_LETTER_PATH, max_attempts=MAX_EMAIL_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # Shared by the worker processes
+        self.connection = connect_shared_db(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS dead_letters (
+            email_id TEXT PRIMARY KEY,
+            category TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            order_status TEXT,
+            failed_at REAL
+        )""")
+
+    def record(self, email_id, category, error):
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO dead_letters (email_id, category, attempts, error, failed_at) VALUES (?, ?, 1, ?, ?)
+                ON CONFLICT (email_id) DO UPDATE SET attempts = attempts + 1, category = COALESCE(excluded.category, category),
+                error = excluded.error, failed_at = excluded.failed_at""",
+                (str(email_id), category, f"{type(error).__name__}: {error}", time.time())
+            )
+        metrics.count("dead_letters")
+
+    def stock_applied(self, email_id, order_status):
+        with self.lock:
+            self.connection.execute(
+                """INSERT INTO dead_letters (email_id, category, order_status) VALUES (?, 'order', ?)
+                ON CONFLICT (email_id) DO UPDATE SET order_status = excluded.order_status""",
+                (str(email_id), json.dumps(order_status, default=plain_value))
+            )
+
+    def order_status(self, email_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT order_status FROM dead_letters WHERE email_id = ?", (str(email_id),)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def resolve(self, email_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM dead_letters WHERE email_id = ?", (str(email_id),))
+
+    def given_up(self):
+        with self.lock:
+            return {
+                email_id for (email_id,) in self.connection.execute(
+                    "SELECT email_id FROM dead_letters WHERE attempts >= ?", (self.max_attempts,)
+                )
+            }
+
+    def retry_all(self):
+        with self.lock:
+            count = self.connection.execute("UPDATE dead_letters SET attempts = 0 WHERE attempts > 0").rowcount
+        logging.info(f"{count} emails of the dead-letter queue will be retried.")
+
+    def log_stats(self):
+        with self.lock:
+            failed, given_up = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(attempts >= ?), 0) FROM dead_letters WHERE attempts > 0", (self.max_attempts,)
+            ).fetchone()
+        if failed:
+            logging.warning(
+                f"{failed} failed emails in the dead-letter queue, {given_up} of them left aside after "
+                f"{self.max_attempts} attempts (--retry-dead-letters to retry them)."
+            )
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+from .metrics import metrics
+from .settings import CHROMA_PATH
+from .sheets import plain_value
+
+# === Embedding model ===
+def default_embedding_function():
+    # The Chroma default (ONNX) model, used when no embedding function is given
+    import chromadb.utils.embedding_functions
+    return chromadb.utils.embedding_functions.DefaultEmbeddingFunction()
+
+def embedding_function_id(embedding_function):
+    # Name and settings of an embedding model, e.g. "default {}" or "hashing {"dimensions": 384}"
+    try:
+        return f"{embedding_function.name()} {json.dumps(embedding_function.get_config(), sort_keys=True, default=str)}"
+    except (AttributeError, NotImplementedError):
+        return type(embedding_function).__name__
+
+def embed_texts(embedding_function, texts, batch_size=256):
+    batches = [
+        np.asarray(embedding_function(list(texts[start:start + batch_size])), dtype=np.float32)
+        for start in range(0, len(texts), batch_size)
+    ]
+    embeddings = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+# === In-process vector index ===
+class NumpyCollection:
+    """Products collection held in memory as a float32 matrix, with the subset
+    of the Chroma collection API used here (get, upsert, update, delete, query).
+
+    Embeddings are normalized when added, so a query is one matrix product
+    followed by a top-k selection, with cosine distances as in Chroma. where
+    filters (field equality, $eq, $ne, $gt, $gte, $lt, $lte, $in, $nin, $and,
+    $or) are evaluated on metadata columns before scoring. With a path, the
+    index is saved by persist() and memory-mapped back when opened.
+    """
+
+    def __init__(self, path=None, embedding_function=None):
+        self.path = path
+        self.embedding_function = embedding_function or default_embedding_function()
+        self.lock = threading.Lock()
+        self.ids, self.documents, self.metadatas = [], [], []
+        self.index = {}
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+        self.columns = {}
+        if path and os.path.exists(os.path.join(path, "products.json")):
+            with open(os.path.join(path, "products.json"), encoding="utf-8") as f:
+                stored = json.load(f)
+            self.ids, self.documents, self.metadatas = stored["ids"], stored["documents"], stored["metadatas"]
+            self.index = {product_id: row for row, product_id in enumerate(self.ids)}
+            # Read-only mapping: pages are loaded on first use, and copied on the first write
+            self.vectors = np.load(os.path.join(path, "products.npy"), mmap_mode="r")
+            self.size = len(self.ids)
+
+    def count(self):
+        return self.size
+
+    def _embed(self, documents, embeddings):
+        if embeddings is None:
+            embeddings = self.embedding_function(list(documents))
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _reserve(self, rows, dimensions):
+        # Capacity doubles, so bulk loads in batches copy the matrix a logarithmic number of times
+        if isinstance(self.vectors, np.memmap) or self.vectors.shape[0] < rows or self.vectors.shape[1] != dimensions:
+            capacity = max(rows, 2 * self.vectors.shape[0], 1024)
+            vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+            if self.size:
+                vectors[:self.size] = self.vectors[:self.size]
+            self.vectors = vectors
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        vectors = self._embed(documents, embeddings)
+        with self.lock:
+            self._reserve(self.size + len(ids), vectors.shape[1])
+            for position, product_id in enumerate(ids):
+                row = self.index.get(product_id)
+                if row is None:
+                    row = self.size
+                    self.size += 1
+                    self.index[product_id] = row
+                    self.ids.append(product_id)
+                    self.documents.append(None)
+                    self.metadatas.append(None)
+                self.vectors[row] = vectors[position]
+                self.documents[row] = documents[position] if documents is not None else None
+                self.metadatas[row] = metadatas[position] if metadatas is not None else None
+            self.columns = {}
+
+    def update(self, ids, documents=None, metadatas=None, embeddings=None):
+        vectors = self._embed(documents, embeddings) if documents is not None or embeddings is not None else None
+        with self.lock:
+            if vectors is not None:
+                self._reserve(self.size, vectors.shape[1])
+            for position, product_id in enumerate(ids):
+                row = self.index.get(product_id)
+                if row is None:
+                    continue  # Chroma ignores unknown ids too
+                if vectors is not None:
+                    self.vectors[row] = vectors[position]
+                if documents is not None:
+                    self.documents[row] = documents[position]
+                if metadatas is not None:
+                    self.metadatas[row] = metadatas[position]
+            self.columns = {}
+
+    def delete(self, ids):
+        with self.lock:
+            removed = {self.index[product_id] for product_id in ids if product_id in self.index}
+            if not removed:
+                return
+            keep = np.array([row not in removed for row in range(self.size)], dtype=bool)
+            self.vectors = np.ascontiguousarray(self.vectors[:self.size][keep])
+            self.ids = [product_id for row, product_id in enumerate(self.ids) if keep[row]]
+            self.documents = [document for row, document in enumerate(self.documents) if keep[row]]
+            self.metadatas = [metadata for row, metadata in enumerate(self.metadatas) if keep[row]]
+            self.index = {product_id: row for row, product_id in enumerate(self.ids)}
+            self.size = len(self.ids)
+            self.columns = {}
+
+    def _column(self, field):
+        # Numbers as a float array, anything else as integer codes of its distinct values
+        column = self.columns.get(field)
+        if column is None:
+            values = [(metadata or {}).get(field) for metadata in self.metadatas]
+            if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values if value is not None):
+                column = ("number", np.array([np.nan if value is None else value for value in values], dtype=np.float64))
+            else:
+                codes = {}
+                column = ("text", np.array([codes.setdefault(value, len(codes)) for value in values], dtype=np.int64), codes)
+            self.columns[field] = column
+        return column
+
+    def _condition(self, field, condition):
+        column = self._column(field)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = np.ones(self.size, dtype=bool)
+        for operator, value in condition.items():
+            if column[0] == "text":
+                codes, known = column[1], column[2]
+                if operator in ("$eq", "$ne"):
+                    found = codes == known.get(value, -1)
+                elif operator in ("$in", "$nin"):
+                    found = np.isin(codes, [known[item] for item in value if item in known])
+                else:
+                    raise ValueError(f"{operator} only applies to numeric metadata, not {field}")
+                mask &= ~found if operator in ("$ne", "$nin") else found
+            else:
+                numbers = column[1]
+                if operator == "$in":
+                    mask &= np.isin(numbers, value)
+                elif operator == "$nin":
+                    mask &= ~np.isin(numbers, value)
+                else:
+                    mask &= WHERE_COMPARISONS[operator](numbers, value)
+        return mask
+
+    def _mask(self, where):
+        masks = []
+        for field, condition in where.items():
+            if field == "$and":
+                masks.append(np.logical_and.reduce([self._mask(clause) for clause in condition]))
+            elif field == "$or":
+                masks.append(np.logical_or.reduce([self._mask(clause) for clause in condition]))
+            else:
+                masks.append(self._condition(field, condition))
+        return np.logical_and.reduce(masks)
+
+    def _fields(self, rows, include, vectors=None):
+        found = {"ids": [self.ids[row] for row in rows]}
+        if "documents" in include:
+            found["documents"] = [self.documents[row] for row in rows]
+        if "metadatas" in include:
+            found["metadatas"] = [self.metadatas[row] for row in rows]
+        if "embeddings" in include:
+            found["embeddings"] = np.array(self.vectors[rows]) if vectors is None else vectors
+        return found
+
+    def get(self, ids=None, where=None, include=("documents", "metadatas")):
+        with self.lock:
+            if ids is not None:
+                rows = [self.index[product_id] for product_id in ids if product_id in self.index]
+            elif where:
+                rows = np.flatnonzero(self._mask(where)).tolist()
+            else:
+                rows = list(range(self.size))
+            return self._fields(rows, include)
+
+    def query(self, query_embeddings, n_results=10, where=None, include=("documents", "metadatas", "distances")):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        results = {"ids": []}
+        for field in include:
+            results[field] = []
+        with self.lock:
+            # Pre-filtering: only the rows matching where are scored
+            if where:
+                rows = np.flatnonzero(self._mask(where))
+                vectors = self.vectors[rows]
+            else:
+                rows = np.arange(self.size)
+                vectors = self.vectors[:self.size]
+            count = min(n_results, len(rows))
+            if count:
+                similarities = queries @ vectors.T
+                top = np.argpartition(-similarities, count - 1, axis=1)[:, :count]
+                order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind="stable")
+                top = np.take_along_axis(top, order, axis=1)
+            for position in range(len(queries)):
+                columns = top[position] if count else np.zeros(0, dtype=np.int64)
+                found = self._fields(rows[columns].tolist(), include)
+                for field in include:
+                    if field == "distances":
+                        found[field] = (1 - similarities[position, columns]).tolist() if count else []
+                    results[field].append(found[field])
+                results["ids"].append(found["ids"])
+        return results
+
+    def persist(self):
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            # Written aside then renamed, so a crash never leaves a half-written index
+            vectors_path = os.path.join(self.path, "products.npy")
+            with open(vectors_path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(self.vectors[:self.size]))
+            with open(os.path.join(self.path, "products.json.tmp"), "w", encoding="utf-8") as f:
+                json.dump({"ids": self.ids, "documents": self.documents, "metadatas": self.metadatas}, f, default=plain_value)
+            os.replace(vectors_path + ".tmp", vectors_path)
+            os.replace(os.path.join(self.path, "products.json.tmp"), os.path.join(self.path, "products.json"))
+
+WHERE_COMPARISONS = {
+    "$eq": np.equal, "$ne": np.not_equal, "$gt": np.greater, "$gte": np.greater_equal, "$lt": np.less, "$lte": np.less_equal,
+}
+
+# === Open the products collection in the vector database ===
+def open_product_collection(path=CHROMA_PATH, backend="chroma", embedding_function=None):
+    # backend: one of VECTOR_BACKENDS (--vector-backend)
+    embedding_function = embedding_function or default_embedding_function()
+    if backend == "numpy":
+        return NumpyCollection(path or None, embedding_function)
+    import chromadb
+    # Without a path the collection only lives in memory
+    client_chroma = chromadb.PersistentClient(path=path) if path else chromadb.EphemeralClient()
+    return client_chroma.get_or_create_collection(
+        name="products_data",
+        metadata={"hnsw:space":"cosine"},
+        embedding_function=embedding_function
+    )
+
+def persist_collection(collection):
+    # Chroma writes through; the NumPy index is saved once per catalog sync
+    if isinstance(collection, NumpyCollection):
+        with metrics.stage("catalog:persist"):
+            collection.persist()
@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from .pipeline import Pipeline, StockTurnstile, email_coroutine, llm_client, tracked
+from .settings import INGESTION_STATE_PATH
+from .sheets import init_worksheets, read_rows
+
+# === Incremental email ingestion ===
+class IngestionState:
+    """SQLite store of the emails sheet watermark and of the emails ingested so far.
+
+    Rows of the emails sheet up to the watermark have been ingested. Each
+    ingested email keeps its category once classified and is marked done once
+    answered, so a restart only fetches newer rows and retries unfinished emails.
+    The email ID of the watermark row is kept with it: the row numbers only
+    hold while the sheet is append-only, and a different ID at the watermark
+    (rows deleted or sorted above it) makes the next fetch read the whole sheet.
+    """
+
+    def __init__(self, path=INGESTION_STATE_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+            sheet TEXT PRIMARY KEY,
+            row INTEGER,
+            email_id TEXT
+        )""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS emails (
+            email_id TEXT PRIMARY KEY,
+            row INTEGER,
+            subject TEXT,
+            message TEXT,
+            category TEXT,
+            done INTEGER DEFAULT 0
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS emails_pending ON emails (done, row)")
+        self.connection.commit()
+
+    def watermark(self, sheet="emails"):
+        # (row, email ID of that row), None until the state is bootstrapped
+        with self.lock:
+            return self.connection.execute("SELECT row, email_id FROM watermarks WHERE sheet = ?", (sheet,)).fetchone()
+
+    def ingest(self, emails, watermark, watermark_id, sheet="emails"):
+        # New emails and the watermark are committed together; known emails only get their current row
+        with self.lock:
+            self.connection.executemany(
+                """INSERT INTO emails (email_id, row, subject, message, category, done) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (email_id) DO UPDATE SET row = excluded.row""",
+                [
+                    (email['email_id'], email['row'], email['subject'], email['message'], email.get('category'), int(email.get('done', False)))
+                    for email in emails
+                ]
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO watermarks (sheet, row, email_id) VALUES (?, ?, ?)", (sheet, watermark, watermark_id)
+            )
+            self.connection.commit()
+
+    def ingested(self):
+        with self.lock:
+            return {email_id for (email_id,) in self.connection.execute("SELECT email_id FROM emails")}
+
+    def classified(self, email_id, category):
+        with self.lock:
+            self.connection.execute("UPDATE emails SET category = ? WHERE email_id = ?", (category, str(email_id)))
+            self.connection.commit()
+
+    def done(self, email_id):
+        with self.lock:
+            self.connection.execute("UPDATE emails SET done = 1 WHERE email_id = ?", (str(email_id),))
+            self.connection.commit()
+
+    def pending(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT email_id, subject, message, category FROM emails WHERE done = 0 ORDER BY row"
+            ).fetchall()
+        return [{"email_id": email_id, "subject": subject, "message": message, "category": category} for email_id, subject, message, category in rows]
+
+    def close(self):
+        self.connection.close()
+
+def row_email_id(header, cells):
+    # Email ID of a row of the emails sheet, "" for a blank row
+    column = header.index("email_id")
+    return str(cells[column]) if column < len(cells) else ""
+
+def email_records(header, rows, first_row):
+    columns = {name: header.index(name) for name in ("email_id", "subject", "message")}
+    emails = []
+    for number, cells in enumerate(rows, start=first_row):
+        cells = list(cells) + [""] * (len(header) - len(cells))
+        # Blank rows are skipped
+        if not str(cells[columns["email_id"]]).strip():
+            continue
+        emails.append({
+            "email_id": str(cells[columns["email_id"]]),
+            "subject": cells[columns["subject"]],
+            "message": cells[columns["message"]],
+            "row": number,
+        })
+    return emails
+
+def bootstrap_ingestion(spreadsheet, state, header):
+    # First start only: the whole history is read once to set the watermark
+    rows = read_rows(spreadsheet, "emails")[1:]
+    categories = {
+        str(cells[0]): cells[1] for cells in read_rows(spreadsheet, "email-classification", "A:B")[1:] if len(cells) > 1
+    }
+    answered = {
+        str(cells[0])
+        for worksheet_name in ("order-response", "inquiry-response")
+        for cells in read_rows(spreadsheet, worksheet_name, "A:A")[1:] if cells
+    }
+    emails = email_records(header, rows, 2)
+    for email in emails:
+        email['category'] = categories.get(email['email_id'])
+        email['done'] = email['category'] is not None and (
+            email['category'] not in ('order', 'inquiry') or email['email_id'] in answered
+        )
+    state.ingest(emails, len(rows) + 1, row_email_id(header, rows[-1]) if rows else "email_id")
+    logging.info(f"Ingestion state bootstrapped: {len(emails)} emails, {sum(not email['done'] for email in emails)} pending.")
+    return emails
+
+def fetch_new_emails(spreadsheet, state, header):
+    # Only the rows appended below the watermark are downloaded, with the watermark row itself
+    watermark, watermark_id = state.watermark()
+    rows = read_rows(spreadsheet, "emails", f"A{watermark}:Z")
+    if not rows or row_email_id(header, rows[0]) != watermark_id:
+        # Rows deleted or sorted above the watermark shifted the rows: the whole sheet is read again
+        logging.warning(f"Row {watermark} of the emails sheet is no longer email {watermark_id}, reading the whole sheet again.")
+        ingested = state.ingested()
+        return [email for email in bootstrap_ingestion(spreadsheet, state, header) if email['email_id'] not in ingested]
+    emails = email_records(header, rows[1:], watermark + 1)
+    if len(rows) > 1:
+        state.ingest(emails, watermark + len(rows) - 1, row_email_id(header, rows[-1]))
+    return emails
+
+# === Process the pending ingested emails ===
+async def process_ingested(pipeline, pending, state):
+    tasks = []
+    emails = []
+    turn = 0
+    given_up = pipeline.services.given_up()
+    for email in pending:
+        if email['email_id'] in given_up:
+            continue
+        task = email_coroutine(pipeline, email, turn, state)
+        if task is None:
+            state.done(email['email_id'])
+            continue
+        if email['category'] in (None, 'order'):
+            turn += 1
+        tasks.append(tracked(email['email_id'], email['category'], task))
+        emails.append(email)
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failures = 0
+    for email, result in zip(emails, results):
+        if isinstance(result, BaseException):
+            failures += 1
+            pipeline.services.failed(email['email_id'], email['category'], result)
+        else:
+            state.done(email['email_id'])
+            pipeline.services.processed(email['email_id'])
+    return len(emails) - failures, failures
+
+# === Watch the emails sheet and process new emails as they arrive ===
+async def watch(spreadsheet, openai_client, writer, args, services):
+    llm = llm_client(openai_client, args, services)
+    state = IngestionState(args.state_path)
+    try:
+        sheets = await asyncio.to_thread(init_worksheets, spreadsheet, writer)
+        header = (await asyncio.to_thread(read_rows, spreadsheet, "emails", "1:1"))[0]
+        if state.watermark() is None:
+            await asyncio.to_thread(writer.flush)
+            await asyncio.to_thread(bootstrap_ingestion, spreadsheet, state, header)
+
+        catalog = None
+        catalog_loaded_at = 0.0
+        interval = args.poll_interval
+        cycle = 0
+        while True:
+            cycle += 1
+            try:
+                new_emails = await asyncio.to_thread(fetch_new_emails, spreadsheet, state, header)
+                pending = state.pending()
+                if pending:
+                    # Each cycle orders the stock changes of its own emails
+                    pipeline = Pipeline(services, llm, sheets, StockTurnstile(), catalog)
+                    if catalog is None or time.monotonic() - catalog_loaded_at > args.catalog_refresh:
+                        # Stock written by earlier cycles has to reach the sheet before it is read back
+                        await asyncio.to_thread(writer.flush)
+                        catalog = pipeline.load_catalog(spreadsheet, args)
+                        catalog_loaded_at = time.monotonic()
+                    processed, failures = await process_ingested(pipeline, pending, state)
+                    await asyncio.to_thread(writer.flush)
+                    logging.info(f"Cycle {cycle}: {len(new_emails)} new emails, {processed} processed, {failures} failed.")
+                # Polls slow down while no mail arrives
+                interval = args.poll_interval if new_emails else min(interval * 2, args.max_poll_interval)
+            except Exception:
+                logging.exception(f"Cycle {cycle} failed.")
+                catalog = None
+                interval = min(interval * 2, args.max_poll_interval)
+
+            if args.max_cycles and cycle >= args.max_cycles:
+                break
+            await asyncio.sleep(interval)
+    finally:
+        llm.log_stats()
+        state.close()
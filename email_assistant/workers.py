@@ -0,0 +1,284 @@
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+
+from .catalog import load_products_to_chromadb
+from .metrics import metrics
+from .pipeline import Pipeline, email_coroutine, find_pending_work, email_rows, llm_client, tracked
+from .services import configure, connect
+from .settings import QUEUE_POLL_INTERVAL, WORK_QUEUE_PATH, WORKER_PRELOAD_MODULES
+from .sheets import SheetWriter, close_writer, init_worksheets, load_data
+from .stores import SQLiteProductStore, connect_shared_db, immediate_transaction
+from .vectors import open_product_collection
+
+# === Work queue shared by the worker processes ===
+class WorkQueue:
+    """SQLite queue of the emails to process, shared by the worker processes.
+
+    Emails are numbered (seq) in the order of the sequential run. Workers claim
+    them with a lease renewed while they run, so the emails of a crashed worker
+    are claimed again once the lease expires. stock_done records that the stock
+    step of an email is over, which orders the stock changes (QueueTurnstile).
+    """
+
+    def __init__(self, path=WORK_QUEUE_PATH):
+        self.lock = threading.Lock()
+        self.connection = connect_shared_db(path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS queue (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_id TEXT UNIQUE,
+            subject TEXT,
+            message TEXT,
+            category TEXT,
+            status TEXT DEFAULT 'pending',
+            worker TEXT,
+            lease_until REAL,
+            stock_done INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0
+        )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS queue_status ON queue (status, seq)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS queue_stock ON queue (stock_done, seq)")
+
+    def enqueue(self, emails):
+        # Finished emails of earlier runs make room; emails still queued keep their number
+        with self.lock, immediate_transaction(self.connection):
+            self.connection.execute("DELETE FROM queue WHERE status IN ('done', 'failed')")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO queue (email_id, subject, message, category, stock_done) VALUES (?, ?, ?, ?, ?)",
+                [
+                    # Only orders and unclassified emails take a stock turn
+                    (str(email['email_id']), email['subject'], email['message'], email['category'], int(email['category'] not in (None, 'order')))
+                    for email in emails
+                ]
+            )
+
+    def claim(self, worker, limit, lease):
+        now = time.time()
+        columns = "seq, email_id, subject, message, category"
+        with self.lock, immediate_transaction(self.connection):
+            # Emails of crashed workers are taken back whatever the limit: later orders wait for their stock turn
+            rows = self.connection.execute(
+                f"SELECT {columns} FROM queue WHERE status = 'claimed' AND lease_until < ? ORDER BY seq", (now,)
+            ).fetchall()
+            if limit > 0:
+                rows += self.connection.execute(
+                    f"SELECT {columns} FROM queue WHERE status = 'pending' ORDER BY seq LIMIT ?", (limit,)
+                ).fetchall()
+            self.connection.executemany(
+                "UPDATE queue SET status = 'claimed', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE seq = ?",
+                [(worker, now + lease, row[0]) for row in rows]
+            )
+        return [dict(zip(("seq", "email_id", "subject", "message", "category"), row)) for row in rows]
+
+    def renew(self, worker, lease):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE queue SET lease_until = ? WHERE worker = ? AND status = 'claimed'", (time.time() + lease, worker)
+            )
+
+    def classified(self, email_id, category):
+        with self.lock:
+            self.connection.execute("UPDATE queue SET category = ? WHERE email_id = ?", (category, str(email_id)))
+
+    def finish(self, email_id, status):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE queue SET status = ?, stock_done = 1 WHERE email_id = ?", (status, str(email_id))
+            )
+
+    def stock_frontier(self):
+        # First email whose stock step is not over: the stock step of an email can run once the frontier reaches it
+        with self.lock:
+            seq = self.connection.execute("SELECT MIN(seq) FROM queue WHERE stock_done = 0").fetchone()[0]
+        return math.inf if seq is None else seq
+
+    def stock_done(self, seq):
+        with self.lock:
+            self.connection.execute("UPDATE queue SET stock_done = 1 WHERE seq = ?", (seq,))
+
+    def remaining(self):
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM queue WHERE status IN ('pending', 'claimed')"
+            ).fetchone()[0]
+
+    def counts(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT status, COUNT(*) FROM queue GROUP BY status").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+class QueueTurnstile:
+    """StockTurnstile across processes: the turns are the seq numbers of the work queue.
+
+    The orders waiting in a worker share a single poll of the stock frontier
+    of the queue, at most every poll_interval; a turn done in the worker
+    makes the next poll immediate. Turns are skipped by marking them done.
+    """
+
+    def __init__(self, queue, poll_interval=QUEUE_POLL_INTERVAL):
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self.frontier = 0
+        self.polled_at = 0.0
+        self.poll = None
+
+    async def _poll(self):
+        delay = self.polled_at + self.poll_interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.frontier = self.queue.stock_frontier()
+        self.polled_at = time.monotonic()
+
+    async def wait(self, turn):
+        while self.frontier < turn:
+            if self.poll is None or self.poll.done():
+                self.poll = asyncio.ensure_future(self._poll())
+            await asyncio.shield(self.poll)
+
+    async def advance(self, turn):
+        self.queue.stock_done(turn)
+        self.polled_at = 0.0
+
+    async def skip(self, turn):
+        await self.advance(turn)
+
+# === Process the emails claimed from the work queue ===
+async def work(spreadsheet, openai_client, writer, args, services, worker_id):
+    queue = WorkQueue(args.queue_path)
+    llm = llm_client(openai_client, args, services)
+    sheets = await asyncio.to_thread(init_worksheets, spreadsheet, writer)
+    pipeline = Pipeline(services, llm, sheets, QueueTurnstile(queue))
+    pipeline.load_catalog(spreadsheet, args)
+
+    tasks = {}
+    processed = failures = 0
+    renewed_at = time.monotonic()
+    drained = False
+    try:
+        while True:
+            # Claims take the write lock of the queue: they are only made for free room, and for the
+            # emails of crashed workers when the leases are renewed
+            room = 0 if drained else args.claim_batch - len(tasks)
+            renewing = time.monotonic() - renewed_at > args.lease / 3
+            claimed = queue.claim(worker_id, room, args.lease) if room > 0 or renewing else []
+            drained = drained or len(claimed) < room
+            for email in claimed:
+                coroutine = email_coroutine(pipeline, email, email['seq'], queue)
+                if coroutine is None:
+                    queue.finish(email['email_id'], 'done')
+                    continue
+                tasks[asyncio.create_task(tracked(email['email_id'], email['category'], coroutine))] = email
+
+            if not tasks:
+                # Claimed emails of other workers may still come back if their lease expires
+                if queue.remaining() == 0:
+                    break
+                await asyncio.sleep(QUEUE_POLL_INTERVAL)
+                continue
+
+            # Room is only made by finished emails
+            done, _ = await asyncio.wait(tasks, timeout=args.lease / 3, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                email = tasks.pop(task)
+                if task.exception() is not None:
+                    failures += 1
+                    services.failed(email['email_id'], email['category'], task.exception())
+                    queue.finish(email['email_id'], 'failed')
+                else:
+                    processed += 1
+                    queue.finish(email['email_id'], 'done')
+                    services.processed(email['email_id'])
+
+            if renewing:
+                queue.renew(worker_id, args.lease)
+                renewed_at = time.monotonic()
+    finally:
+        queue.close()
+    llm.log_stats()
+    logging.info(f"Worker {worker_id}: {processed} emails processed, {failures} failed.")
+
+def worker_main(args, worker_id):
+    # Entry point of the worker processes, started by run_workers or with --worker on other nodes
+    args.worker = True
+    spreadsheet, openai_client = connect(args)
+    services = configure(args)
+    # Each worker replays its own journal after a crash
+    writer = SheetWriter(
+        spreadsheet, max_rows=args.flush_rows, flush_interval=args.flush_interval,
+        journal_path=f"sheet_writes.{worker_id}.journal"
+    )
+    failed = True
+    try:
+        asyncio.run(work(spreadsheet, openai_client, writer, args, services, worker_id))
+        failed = False
+    finally:
+        try:
+            close_writer(writer, failed)
+        finally:
+            services.close()
+            metrics.log_summary()
+
+# === Run the pipeline on several worker processes ===
+def run_workers(spreadsheet, writer, args, services):
+    sheets = init_worksheets(spreadsheet, writer)
+    pending_orders, new_emails, pending_inquiries = find_pending_work(spreadsheet, services)
+
+    # Queued in the order of the sequential run: pending orders, new emails, then inquiries
+    queue = WorkQueue(args.queue_path)
+    queue.enqueue(
+        [{**row, 'category': 'order'} for row in email_rows(pending_orders)]
+        + [{**row, 'category': None} for row in email_rows(new_emails)]
+        + [{**row, 'category': 'inquiry'} for row in email_rows(pending_inquiries)]
+    )
+
+    # The vector database is synced once for all workers, and the shared stock imported from the sheet
+    df_products = load_data(spreadsheet, "products")
+    if args.chroma_path:
+        load_products_to_chromadb(
+            df_products, open_product_collection(args.chroma_path, args.vector_backend, services.embedding_function)
+        )
+    products = SQLiteProductStore(df_products, args.queue_path)
+    products.import_stock()
+
+    # Workers share the rate limits of the account
+    worker_args = argparse.Namespace(**vars(args))
+    worker_args.workers = 0
+    worker_args.rpm = max(1, args.rpm // args.workers)
+    worker_args.tpm = max(1, args.tpm // args.workers)
+    # Workers are forked from a server process that imported the heavy modules once, instead of each
+    # importing them again (spawn), which costs seconds of CPU per worker; spawn where fork is missing
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__] + WORKER_PRELOAD_MODULES + (["offline"] if args.offline else []))
+    else:
+        context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=worker_main, args=(worker_args, f"worker-{index}"), name=f"worker-{index}")
+        for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        # The stock changed by the workers is written to the sheet as they go
+        while any(process.is_alive() for process in processes):
+            multiprocessing.connection.wait([process.sentinel for process in processes], timeout=args.flush_interval)
+            products.sync(sheets["products"])
+    finally:
+        for process in processes:
+            process.join()
+        products.sync(sheets["products"])
+        products.close()
+
+    counts = queue.counts()
+    queue.close()
+    crashed = [process.name for process in processes if process.exitcode != 0]
+    if crashed:
+        logging.error(f"Workers {', '.join(crashed)} exited with an error.")
+    logging.info(f"Workers finished: {counts.get('done', 0)} emails processed, {counts.get('failed', 0)} failed.")
@@ -0,0 +1,454 @@
+import asyncio
+import collections
+import csv
+import fcntl
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import types
+
+import gspread
+import httpx
+import numpy as np
+import openai
+from chromadb.api.types import EmbeddingFunction
+
+# Offline stand-ins for Google Sheets, OpenAI and the embedding model, used to
+# run the pipeline and its benchmarks without network access.
+
+# === In-memory spreadsheet ===
+class InMemoryWorksheet:
+    """Worksheet holding its values in memory, with the gspread calls used by the pipeline."""
+
+    def __init__(self, spreadsheet, title, values=None, rows=1000, cols=26):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.values = [list(row) for row in values or []]
+        self.row_count = max(rows, len(self.values))
+        self.col_count = max([cols] + [len(row) for row in self.values])
+
+    def _set(self, row, col, value):
+        while len(self.values) < row:
+            self.values.append([])
+        cells = self.values[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = value
+        self.row_count = max(self.row_count, row)
+        self.col_count = max(self.col_count, col)
+
+    def get_all_values(self):
+        self.spreadsheet.record_call("get_all_values")
+        return [list(row) for row in self.values]
+
+    def update(self, values, range_name="A1", **kwargs):
+        self.spreadsheet.record_call("update")
+        self.spreadsheet.changing(self)
+        row, col = gspread.utils.a1_to_rowcol(range_name)
+        for i, cells in enumerate(values):
+            for j, value in enumerate(cells):
+                self._set(row + i, col + j, value)
+        self.spreadsheet.changed(self)
+
+    def append_row(self, values, **kwargs):
+        self.spreadsheet.record_call("append_row")
+        self.spreadsheet.changing(self)
+        self.values.append(list(values))
+        self.row_count = max(self.row_count, len(self.values))
+        self.spreadsheet.changed(self)
+
+    def append_rows(self, values, **kwargs):
+        self.spreadsheet.record_call("append_rows")
+        self.spreadsheet.changing(self)
+        self.values.extend(list(row) for row in values)
+        self.row_count = max(self.row_count, len(self.values))
+        self.spreadsheet.changed(self)
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet.record_call("update_cell")
+        self.spreadsheet.changing(self)
+        self._set(row, col, value)
+        self.spreadsheet.changed(self)
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet.record_call("batch_update")
+        self.spreadsheet.changing(self)
+        for update in data:
+            row, col = gspread.utils.a1_to_rowcol(update["range"])
+            for i, cells in enumerate(update["values"]):
+                for j, value in enumerate(cells):
+                    self._set(row + i, col + j, value)
+        self.spreadsheet.changed(self)
+
+
+class InMemorySpreadsheet:
+    """Spreadsheet of InMemoryWorksheet, counting the API calls a real one would make."""
+
+    def __init__(self, worksheets=None):
+        self.worksheets = {}
+        self.api_calls = collections.Counter()
+        for title, values in (worksheets or {}).items():
+            self.worksheets[title] = InMemoryWorksheet(self, title, values)
+
+    def record_call(self, name):
+        self.api_calls[name] += 1
+
+    def changing(self, worksheet):
+        pass
+
+    def changed(self, worksheet):
+        pass
+
+    def worksheet(self, title):
+        self.record_call("worksheet")
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.record_call("add_worksheet")
+        self.worksheets[title] = InMemoryWorksheet(self, title, rows=rows, cols=cols)
+        self.changing(self.worksheets[title])
+        self.changed(self.worksheets[title])
+        return self.worksheets[title]
+
+    def values_get(self, range_name, params=None):
+        # Used by gspread_dataframe.get_as_dataframe and the incremental email reads
+        self.record_call("values_get")
+        title, _, cells = range_name.partition("!")
+        values = self.worksheets[title.strip("'").replace("''", "'")].values
+        if cells:
+            grid = gspread.utils.a1_range_to_grid_range(cells)
+            values = [
+                row[grid.get("startColumnIndex", 0):grid.get("endColumnIndex")]
+                for row in values[grid.get("startRowIndex", 0):grid.get("endRowIndex")]
+            ]
+        # Like the Sheets API, no "values" key for an empty range
+        return {"values": [list(row) for row in values]} if values else {}
+
+
+class CsvSpreadsheet(InMemorySpreadsheet):
+    """In-memory spreadsheet loaded from and saved to one CSV file per worksheet.
+
+    Several processes can share the directory: changes are made under a file
+    lock, on a worksheet reloaded first if another process saved it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.mtimes = {}
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.RLock()
+        self.lock_file = open(os.path.join(directory, ".lock"), "a")
+        super().__init__()
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(".csv"):
+                title = filename[:-len(".csv")]
+                self.worksheets[title] = InMemoryWorksheet(self, title, self.read(title))
+
+    def path(self, title):
+        return os.path.join(self.directory, f"{title}.csv")
+
+    def read(self, title):
+        self.mtimes[title] = os.stat(self.path(title)).st_mtime_ns
+        with open(self.path(title), newline="", encoding="utf-8") as f:
+            return list(csv.reader(f))
+
+    def reload(self, worksheet):
+        # Picks up the changes saved by another process or program
+        path = self.path(worksheet.title)
+        if os.path.exists(path) and os.stat(path).st_mtime_ns != self.mtimes.get(worksheet.title):
+            worksheet.values = self.read(worksheet.title)
+            worksheet.row_count = max(worksheet.row_count, len(worksheet.values))
+
+    def values_get(self, range_name, params=None):
+        title = range_name.partition("!")[0].strip("'").replace("''", "'")
+        if title in self.worksheets:
+            with self.lock:
+                self.reload(self.worksheets[title])
+        return super().values_get(range_name, params)
+
+    def changing(self, worksheet):
+        self.lock.acquire()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.reload(worksheet)
+
+    def changed(self, worksheet):
+        try:
+            path = self.path(worksheet.title)
+            with open(path + ".tmp", "w", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(worksheet.values)
+            os.replace(path + ".tmp", path)
+            self.mtimes[worksheet.title] = os.stat(path).st_mtime_ns
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock.release()
+
+# === Deterministic fake OpenAI client ===
+def detect_stage(messages):
+    system = messages[0]["content"]
+    if "email classification assistant" in system:
+        return "classification"
+    if "Generate suborders" in system:
+        return "suborders"
+    if "Generate a list of orders" in system:
+        return "order-request"
+    if "Extract the orders" in system:
+        return "order-extraction"
+    if "opening paragraphs" in system:
+        return "order-prose"
+    if "customers orders via email" in system:
+        return "order-response"
+    return "inquiry-response"
+
+PRODUCT_ID_PATTERN = re.compile(r"\[([A-Z]{3}\d+)\]")
+ORDER_LINE_PATTERN = re.compile(r"(\d+) x [^\[\]]*\[([A-Z]{3}\d+)\]")
+
+def fake_answer(stage, messages, completion_tokens):
+    prompt = messages[-1]["content"]
+    if stage == "classification":
+        return "order" if re.search(r"\b(buy|order|purchase)\b", prompt, re.IGNORECASE) else "inquiry"
+    if stage == "suborders":
+        return json.dumps({"data": [
+            {"product_data": f"[{product_id}]", "quantity": int(quantity)}
+            for quantity, product_id in ORDER_LINE_PATTERN.findall(prompt)
+        ]})
+    if stage == "order-request":
+        hypothesis = prompt.split("<ORDERS HYPOTESIS>")[-1].split("</ORDERS HYPOTESIS>")[0]
+        products = prompt.split("<PRODUCTS LIST>")[-1]
+        quantities = dict(
+            (product_id, int(quantity))
+            for product_id, quantity in re.findall(r"\[([A-Z]{3}\d+)\][^<]*</PRODUCT DESCRIPTION><PRODUCT QUANTITY>(\d+)", hypothesis)
+        )
+        return json.dumps({"data": [
+            {"product_id": product_id, "quantity": quantity}
+            for product_id, quantity in quantities.items()
+            if product_id in products
+        ]})
+    if stage == "order-extraction":
+        email = prompt.split("<MESSAGE>")[-1].split("</MESSAGE>")[0]
+        products = prompt.split("<PRODUCTS LIST>")[-1]
+        return json.dumps({"data": [
+            {"product_id": product_id, "quantity": int(quantity)}
+            for quantity, product_id in ORDER_LINE_PATTERN.findall(email)
+            if f'<PRODUCT id="{product_id}"' in products
+        ]})
+    # Replies: deterministic filler of the configured length
+    seed = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    body = (seed + " ") * max(1, completion_tokens * 4 // (len(seed) + 1))
+    if stage == "order-prose":
+        return f"Dear customer,\n\n{body.strip()}"
+    return f"<html><body><p>Dear customer,</p><p>{body.strip()}</p><p>Customer Service Team</p></body></html>"
+
+def fake_confidence(stage, messages):
+    # Probability of the answer: classifications of emails mixing an order and a question are unsure
+    prompt = messages[-1]["content"]
+    if stage == "classification" and "?" in prompt and re.search(r"\b(buy|order|purchase)\b", prompt, re.IGNORECASE):
+        return 0.6
+    return 0.99
+
+
+class FakeCompletions:
+    def __init__(self, client):
+        self.client = client
+
+    def _respond(self, kwargs):
+        messages = kwargs["messages"]
+        stage = detect_stage(messages)
+        completion_tokens = self.client.completion_tokens.get(stage, 20)
+        content = fake_answer(stage, messages, completion_tokens)
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        completion_tokens = max(1, len(content) // 4)
+        self.client.calls[stage] += 1
+        self.client.model_calls[kwargs.get("model")] += 1
+        # Smaller models answer faster
+        speed = self.client.model_speed.get(kwargs.get("model"), 1.0)
+        delay = (self.client.latency + completion_tokens * self.client.latency_per_token) * speed
+        if kwargs.get("tools"):
+            # Forced function call: the answer comes as the arguments of the first tool
+            function = types.SimpleNamespace(name=kwargs["tools"][0]["function"]["name"], arguments=content)
+            message = types.SimpleNamespace(
+                role="assistant", content=None,
+                tool_calls=[types.SimpleNamespace(id=f"call_{sum(self.client.calls.values())}", type="function", function=function)]
+            )
+        else:
+            message = types.SimpleNamespace(role="assistant", content=content, tool_calls=None)
+        logprobs = None
+        if kwargs.get("logprobs"):
+            # The whole answer counts as its first token
+            token = types.SimpleNamespace(token=content, logprob=math.log(fake_confidence(stage, messages)))
+            logprobs = types.SimpleNamespace(content=[token])
+        response = types.SimpleNamespace(
+            model=kwargs.get("model"),
+            choices=[types.SimpleNamespace(
+                message=message, logprobs=logprobs, finish_reason="tool_calls" if kwargs.get("tools") else "stop"
+            )],
+            usage=types.SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens
+            )
+        )
+        return response, delay
+
+    def _enter(self):
+        # Above max_in_flight concurrent calls, the call is rate limited like a 429 of the API
+        with self.client.lock:
+            if self.client.max_in_flight and self.client.in_flight >= self.client.max_in_flight:
+                self.client.rate_limited += 1
+                raise rate_limit_error(self.client.retry_after)
+            self.client.in_flight += 1
+
+    def _exit(self):
+        with self.client.lock:
+            self.client.in_flight -= 1
+
+    def create(self, **kwargs):
+        self._enter()
+        try:
+            response, delay = self._respond(kwargs)
+            time.sleep(delay)
+        finally:
+            self._exit()
+        return response
+
+
+class AsyncFakeCompletions(FakeCompletions):
+    async def create(self, **kwargs):
+        self._enter()
+        try:
+            response, delay = self._respond(kwargs)
+            await asyncio.sleep(delay)
+        finally:
+            self._exit()
+        return response
+
+
+def rate_limit_error(retry_after):
+    headers = {"retry-after-ms": str(int(retry_after * 1000))} if retry_after else {}
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers=headers, request=request)
+    return openai.RateLimitError("Rate limit reached (fake)", response=response, body=None)
+
+
+class FakeOpenAI:
+    """Stand-in for OpenAI() answering every pipeline stage deterministically from the prompt.
+
+    Each call sleeps latency + latency_per_token * completion tokens, times the
+    model_speed factor of the requested model (1 for unknown models).
+    completion_tokens sets the length of the order and inquiry replies per stage.
+    Calls beyond max_in_flight concurrent ones fail with a RateLimitError
+    carrying a retry_after seconds Retry-After (0: unlimited).
+    """
+
+    completions_class = FakeCompletions
+
+    def __init__(self, latency=0.0, latency_per_token=0.0, completion_tokens=None, model_speed=None, max_in_flight=0, retry_after=0.0):
+        self.latency = latency
+        self.latency_per_token = latency_per_token
+        self.completion_tokens = {"order-response": 400, "order-prose": 60, "inquiry-response": 300, **(completion_tokens or {})}
+        self.model_speed = {"gpt-4o-mini": 0.3, "gpt-4o": 0.5, **(model_speed or {})}
+        self.calls = collections.Counter()
+        self.model_calls = collections.Counter()
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self.completions_class(self))
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    """Stand-in for AsyncOpenAI() with the same answers as FakeOpenAI."""
+
+    completions_class = AsyncFakeCompletions
+
+# === File-based batch provider ===
+def plain(value):
+    # Fake responses as the JSON of the real API
+    if isinstance(value, types.SimpleNamespace):
+        return {name: plain(item) for name, item in vars(value).items()}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    return value
+
+
+class FileBatchProvider:
+    """Stand-in for the OpenAI Batch API keeping the jobs as files in a directory.
+
+    submit() copies the request file into the directory; once turnaround
+    seconds have passed, collect() answers every request with the (sync) fake
+    client and writes the output file in the format of the real API.
+    """
+
+    def __init__(self, directory, client, turnaround=0.0):
+        self.directory = directory
+        self.client = client
+        self.turnaround = turnaround
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, batch_id, kind):
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    def submit(self, path):
+        batch_id = f"batch_{os.urandom(8).hex()}"
+        with open(path, encoding="utf-8") as source, open(self.path(batch_id, "input"), "w", encoding="utf-8") as target:
+            target.write(source.read())
+        return batch_id
+
+    def collect(self, batch_id):
+        output_path = self.path(batch_id, "output")
+        if not os.path.exists(output_path):
+            input_path = self.path(batch_id, "input")
+            if time.time() - os.path.getmtime(input_path) < self.turnaround:
+                return None
+            lines = []
+            with open(input_path, encoding="utf-8") as f:
+                for number, line in enumerate(f):
+                    request = json.loads(line)
+                    response = self.client.chat.completions.create(**request["body"])
+                    lines.append({
+                        "id": f"{batch_id}_req_{number}",
+                        "custom_id": request["custom_id"],
+                        "response": {"status_code": 200, "body": plain(response)},
+                        "error": None,
+                    })
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(line) + "\n" for line in lines)
+        with open(output_path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+# === Hashing embedding function ===
+class HashingEmbeddingFunction(EmbeddingFunction):
+    """Offline embedding: hashed word unigrams and bigrams, L2 normalized."""
+
+    def __init__(self, dimensions=384):
+        self.dimensions = dimensions
+
+    def __call__(self, input):
+        embeddings = []
+        for text in input:
+            words = re.findall(r"\w+", text.lower())
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+            for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                vector[digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+            norm = np.linalg.norm(vector)
+            embeddings.append(vector / norm if norm else vector)
+        return embeddings
+
+    @staticmethod
+    def name():
+        return "hashing"
+
+    def get_config(self):
+        return {"dimensions": self.dimensions}
+
+    @staticmethod
+    def build_from_config(config):
+        return HashingEmbeddingFunction(config.get("dimensions", 384))
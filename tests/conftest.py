@@ -0,0 +1,35 @@
+import csv
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The tests import the pipeline and the offline stand-ins from the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark
+
+@pytest.fixture
+def dataset(tmp_path):
+    # Synthetic CSV dataset, with near-duplicate inquiries
+    directory = tmp_path / "data"
+    benchmark.write_dataset(str(directory), 40, 30, seed=0, repeated_share=0.3)
+    return directory
+
+def run_app(directory, *options):
+    # One offline run of the command line, from the dataset directory (journals and traces stay there)
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "app.py"), "--offline", ".", "--vector-backend", "numpy",
+         "--fake-llm-latency", "0", "--trace-dir", "", *options],
+        cwd=directory, capture_output=True, text=True, timeout=600
+    )
+    assert result.returncode == 0, result.stderr[-4000:]
+    return result
+
+def sheet_rows(directory, title):
+    # Rows of a worksheet below its header, in a stable order
+    with open(os.path.join(directory, f"{title}.csv"), newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    return sorted(rows[1:])
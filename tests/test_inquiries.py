@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+from email_assistant.inquiries import InquiryClusters
+from email_assistant.llm import BatchPending
+from email_assistant.stores import ProductStore
+
+INQUIRY = {"email_id": "E1", "subject": "Leather boots", "message": "Are the leather boots waterproof and warm enough for winter hiking?"}
+# Same questions, other wording of the greeting
+NEAR_DUPLICATE = {"email_id": "E2", "subject": "Leather boots", "message": "Hello, are the leather boots waterproof and warm enough for winter hiking?"}
+OTHER = {"email_id": "E3", "subject": "Silk scarf", "message": "Which colours does the silk scarf come in, and is it machine washable?"}
+
+@pytest.fixture
+def products():
+    return ProductStore(pd.DataFrame([
+        {"product_id": "P1", "name": "Leather Boots", "description": "Waterproof boots", "category": "Men's Shoes",
+         "seasons": "Winter", "price": 120.0, "stock": 4},
+        {"product_id": "P2", "name": "Silk Scarf", "description": "Light scarf", "category": "Accessories",
+         "seasons": "Spring", "price": 30.0, "stock": 10},
+    ]))
+
+@pytest.fixture
+def clusters(tmp_path):
+    clusters = InquiryClusters(str(tmp_path / "inquiry_clusters.sqlite"))
+    yield clusters
+    clusters.close()
+
+def answer(clusters, row, products, response, product_ids):
+    # The inquiry holding the claim of a new or stale cluster generates its answer
+    cluster_id, reused, shared = clusters.claim(row, products)
+    assert reused is None and shared is None
+    clusters.resolve(cluster_id, response, product_ids, products)
+    return cluster_id
+
+def test_near_duplicates_reuse_the_answer(clusters, products):
+    cluster_id = answer(clusters, INQUIRY, products, "<p>Yes, they are.</p>", ["P1"])
+
+    assert clusters.claim(NEAR_DUPLICATE, products) == (cluster_id, "<p>Yes, they are.</p>", None)
+    # Another question starts its own cluster
+    other_id, reused, shared = clusters.claim(OTHER, products)
+    assert other_id != cluster_id and reused is None and shared is None
+    assert clusters.counts["reused"] == 1 and clusters.counts["new"] == 2
+
+def test_answer_is_generated_again_when_its_products_change(clusters, products):
+    cluster_id = answer(clusters, INQUIRY, products, "<p>4 pairs left.</p>", ["P1"])
+    # Stock of a product the answer was grounded on
+    assert products.reserve("P1", 1)
+    products.commit("P1", 1)
+    assert answer(clusters, NEAR_DUPLICATE, products, "<p>3 pairs left.</p>", ["P1"]) == cluster_id
+    assert clusters.counts["stale"] == 1
+
+    # Stock of another product leaves it valid
+    assert products.reserve("P2", 1)
+    products.commit("P2", 1)
+    assert clusters.claim(INQUIRY, products) == (cluster_id, "<p>3 pairs left.</p>", None)
+
+def test_concurrent_inquiries_share_the_pending_answer(clusters, products):
+    cluster_id, _, _ = clusters.claim(INQUIRY, products)
+    _, reused, shared = clusters.claim(NEAR_DUPLICATE, products)
+    assert reused is None and not shared.done()
+
+    clusters.resolve(cluster_id, "<p>Yes.</p>", ["P1"], products)
+    assert shared.result() == "<p>Yes.</p>"
+
+def test_abandoned_claim_fails_the_waiting_inquiries(clusters, products):
+    cluster_id, _, _ = clusters.claim(INQUIRY, products)
+    _, _, shared = clusters.claim(NEAR_DUPLICATE, products)
+    clusters.abandon(cluster_id, RuntimeError("LLM down"))
+    with pytest.raises(RuntimeError):
+        shared.result()
+    # The next inquiry of the cluster takes the claim over
+    assert answer(clusters, NEAR_DUPLICATE, products, "<p>Yes.</p>", ["P1"]) == cluster_id
+
+def test_batch_answer_keeps_the_claim_for_the_next_passes(tmp_path, products):
+    clusters = InquiryClusters(str(tmp_path / "inquiry_clusters.sqlite"), batch=True)
+    cluster_id, _, _ = clusters.claim(INQUIRY, products)
+    clusters.defer(cluster_id, BatchPending("E1:inquiry-response"))
+    with pytest.raises(BatchPending):
+        clusters.claim(NEAR_DUPLICATE, products)
+    clusters.close()
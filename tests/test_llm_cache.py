@@ -0,0 +1,49 @@
+import types
+
+import pytest
+
+from email_assistant import llm
+from email_assistant.llm import LLMCache
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm, "time", types.SimpleNamespace(time=lambda: now[0]))
+    return now
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.put("suborders", "first", "1")
+    clock[0] += 1
+    cache.put("suborders", "second", "2")
+    clock[0] += 1
+    # Reading an entry makes it the most recently used
+    assert cache.get("suborders", "first") == "1"
+    clock[0] += 1
+    cache.put("suborders", "third", "3")
+
+    assert cache.get("suborders", "second") is None
+    assert cache.get("suborders", "first") == "1"
+    assert cache.get("suborders", "third") == "3"
+    cache.close()
+
+def test_expired_entries_are_ignored_and_purged(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), ttl=60)
+    cache.put("classification", "old", "order")
+    clock[0] += 30
+    cache.put("classification", "recent", "inquiry")
+    assert cache.get("classification", "old") == "order"
+
+    clock[0] += 45
+    assert cache.get("classification", "old") is None
+    assert cache.get("classification", "recent") == "inquiry"
+    cache.put("classification", "new", "order")
+    assert cache.connection.execute("SELECT key FROM responses ORDER BY key").fetchall() == [("new",), ("recent",)]
+    assert cache.hits["classification"] == 2 and cache.misses["classification"] == 1
+    cache.close()
+
+def test_only_the_cached_stages_are_enabled(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite"), stages=["classification"])
+    assert cache.enabled("classification")
+    assert not cache.enabled("order-response")
+    cache.close()
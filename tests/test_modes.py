@@ -0,0 +1,38 @@
+import shutil
+
+from conftest import run_app, sheet_rows
+
+def copy_dataset(dataset, tmp_path, name):
+    directory = tmp_path / name
+    shutil.copytree(dataset, directory)
+    return directory
+
+def test_sequential_async_and_workers_apply_the_same_stock(dataset, tmp_path):
+    sequential = copy_dataset(dataset, tmp_path, "sequential")
+    # The sequential run answers the emails classified by the previous run
+    run_app(sequential)
+    run_app(sequential)
+    concurrent = copy_dataset(dataset, tmp_path, "async")
+    run_app(concurrent, "--async")
+    workers = copy_dataset(dataset, tmp_path, "workers")
+    run_app(workers, "--workers", "2")
+
+    order_status = sheet_rows(sequential, "order-status")
+    products = sheet_rows(sequential, "products")
+    assert order_status
+    assert any(status == "out of stock" for *_, status in order_status)
+    for directory in (concurrent, workers):
+        assert sheet_rows(directory, "order-status") == order_status
+        assert sheet_rows(directory, "products") == products
+        assert sheet_rows(directory, "email-classification") == sheet_rows(sequential, "email-classification")
+
+def test_batch_passes_advance_the_emails(dataset):
+    # Each pass answers the requests the previous pass submitted
+    run_app(dataset, "--batch")
+    assert sheet_rows(dataset, "email-classification") == []
+    assert list((dataset / "batches").glob("requests-*.jsonl"))
+
+    run_app(dataset, "--batch")
+    classified = sheet_rows(dataset, "email-classification")
+    assert len(classified) == len(sheet_rows(dataset, "emails"))
+    assert sheet_rows(dataset, "order-status") == []
@@ -0,0 +1,48 @@
+import json
+
+import offline
+from email_assistant.sheets import SheetWriter
+
+HEADER = ["email ID", "product ID", "quantity", "status"]
+
+def crashed_writer(spreadsheet, journal_path):
+    # A writer whose run stops without flushing: its writes are only in the journal
+    writer = SheetWriter(spreadsheet, max_rows=1000, flush_interval=3600, journal_path=journal_path)
+    writer.stopped.set()
+    writer.flusher.join()
+    return writer
+
+def test_writes_of_a_crashed_run_are_replayed(tmp_path):
+    journal_path = str(tmp_path / "sheet_writes.journal")
+    spreadsheet = offline.InMemorySpreadsheet({"order-status": [HEADER], "products": [["product_id", "stock"], ["P1", 5]]})
+    writer = crashed_writer(spreadsheet, journal_path)
+    order_status = writer.wrap(spreadsheet.worksheet("order-status"))
+    order_status.append_row(["E1", "P1", 2, "created"])
+    order_status.append_row(["E2", "P1", 9, "out of stock"])
+    writer.wrap(spreadsheet.worksheet("products")).update_cell(2, 2, 3)
+    writer.journal.close()
+    assert spreadsheet.worksheet("order-status").get_all_values() == [HEADER]
+
+    SheetWriter(spreadsheet, journal_path=journal_path).close()
+    assert spreadsheet.worksheet("order-status").get_all_values() == [
+        HEADER, ["E1", "P1", 2, "created"], ["E2", "P1", 9, "out of stock"]
+    ]
+    assert spreadsheet.worksheet("products").get_all_values()[1] == ["P1", 3]
+
+def test_rows_in_flight_are_only_sent_again_when_missing(tmp_path):
+    journal_path = tmp_path / "sheet_writes.journal"
+    # The append was cut after the first row reached the sheet, which reads its values back as text
+    spreadsheet = offline.InMemorySpreadsheet({"order-status": [HEADER, ["E1", "P1", "2", "created"]]})
+    journal_path.write_text("".join(json.dumps(entry) + "\n" for entry in [
+        {"sheet": "order-status", "row": ["E1", "P1", 2, "created"], "inflight": True},
+        {"sheet": "order-status", "row": ["E2", "P2", 1, "created"], "inflight": True},
+        {"sheet": "order-status", "row": ["E3", "P3", 4, "out of stock"]},
+    ]))
+
+    writer = SheetWriter(spreadsheet, journal_path=str(journal_path))
+    assert writer.pending() == 0
+    writer.close()
+    assert spreadsheet.worksheet("order-status").get_all_values() == [
+        HEADER, ["E1", "P1", "2", "created"], ["E2", "P2", 1, "created"], ["E3", "P3", 4, "out of stock"]
+    ]
+    assert not journal_path.exists()